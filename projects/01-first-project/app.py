@@ -5,10 +5,17 @@
 # No memory, no extra features — just reliable book-topic answers
 
 import gradio as gr
-import ollama
+from llm_client import LLMClient
+
+LLM_MAX_IN_FLIGHT = 4   # Chats sent to Ollama at once (set OLLAMA_NUM_PARALLEL to match)
+UI_CONCURRENCY = 16     # Chats Gradio handles at once; beyond LLM_MAX_IN_FLIGHT they wait in the client's queue
+LLM_QUEUE_TIMEOUT = 120 * UI_CONCURRENCY // LLM_MAX_IN_FLIGHT  # Seconds a request may wait for a slot: 2 min per round of requests ahead
+
+# One shared connection pool to Ollama for every user
+llm = LLMClient(max_in_flight=LLM_MAX_IN_FLIGHT, queue_timeout=LLM_QUEUE_TIMEOUT)
 
 def chat_with_ai(message, history):
-    response = ollama.chat(
+    response = llm.chat(
         model='tinyllama',
         messages=[
             {
@@ -50,4 +57,5 @@ demo = gr.ChatInterface(
     ]
 )
 
+demo.queue(default_concurrency_limit=UI_CONCURRENCY)
 demo.launch()
\ No newline at end of file
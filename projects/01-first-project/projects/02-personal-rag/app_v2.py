@@ -1,90 +1,195 @@
 import gradio as gr
 from sentence_transformers import SentenceTransformer
-import faiss
 import numpy as np
-from pypdf import PdfReader
 import os
-import ollama
+import time
+from index_store import IndexStore, parse_ranges, read_tags
+from embedding_cache import EmbeddingCache
+from extraction import extract_documents
+from chunker import Chunker
+from streaming import stream_generate
+from llm_client import LLMClient
+from response_cache import ResponseCache
+from reranker import Reranker
 
 # === CONFIG ===
 MODEL_NAME = 'all-MiniLM-L6-v2'  # Fast, good embedding model
 DOCUMENTS_FOLDER = "documents"   # Your files go here
-CHUNK_SIZE = 500                 # Characters per chunk
-CHUNK_OVERLAP = 100              # Overlap for context
+CHUNK_TOKENS = 200               # Max embedding-model tokens per chunk (all-MiniLM-L6-v2 reads 256)
+CHUNK_OVERLAP_TOKENS = 30        # Whole sentences repeated from the previous chunk, up to this many tokens
 TOP_K = 3                        # Retrieve top 3 chunks
+EMBED_BATCH_SIZE = 256           # Chunks embedded per batch while loading
+INDEX_FOLDER = "index"           # Saved index, only changed files get re-embedded
+EMBEDDING_CACHE = "cache/embeddings.sqlite"  # Every vector computed so far, keyed by text
+INDEX_TYPE = "flat"              # "flat" (exact), "ivf_flat", "ivf_pq" or "hnsw" for big collections
+NPROBE = 16                      # IVF: clusters searched per question (higher = better recall, slower)
+EF_SEARCH = 64                   # HNSW: candidates kept per question (higher = better recall, slower)
+HYBRID_SEARCH = True             # BM25 keyword search next to vector search (finds exact terms like "Chapter 11")
+LEXICAL_PREFILTER = 0            # Queries whose words occur together in at most this many chunks skip FAISS (0 = off)
+LLM_MAX_IN_FLIGHT = 4            # Requests sent to Ollama at once (set OLLAMA_NUM_PARALLEL to match)
+UI_CONCURRENCY = 16              # Questions Gradio handles at once; their LLM calls queue in llm_client
+LLM_QUEUE_TIMEOUT = 120 * UI_CONCURRENCY // LLM_MAX_IN_FLIGHT  # Seconds a request may wait for a slot: 2 min per round of requests ahead
+RESPONSE_CACHE_THRESHOLD = 0.95  # Cosine similarity at which two questions count as the same
+RESPONSE_CACHE_TTL = 24 * 3600   # Seconds a cached answer stays valid
+RESPONSE_CACHE_ITEMS = 1000      # Answers kept in memory (least recently used are dropped)
+RERANK = True                    # Rerank a larger candidate pool with a cross-encoder before answering
+RERANK_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+RERANK_POOL = 20                 # Candidates retrieved per question for the reranker (more = better recall, slower)
 
 # Load embedding model (runs locally)
 embedder = SentenceTransformer(MODEL_NAME)
+embedding_cache = EmbeddingCache(embedder, MODEL_NAME, EMBEDDING_CACHE)
+
+# Chunks follow headings, paragraphs and sentences and are sized with the embedder's own tokenizer
+chunker = Chunker(embedder.tokenizer, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+
+# One shared connection pool to Ollama for every user
+llm = LLMClient(max_in_flight=LLM_MAX_IN_FLIGHT, queue_timeout=LLM_QUEUE_TIMEOUT)
+
+# Answers to questions asked before (same meaning, same retrieved chunks)
+response_cache = ResponseCache(RESPONSE_CACHE_THRESHOLD, RESPONSE_CACHE_TTL, RESPONSE_CACHE_ITEMS)
+
+# Second stage: a cross-encoder picks the TOP_K best of RERANK_POOL candidates
+reranker = Reranker(RERANK_MODEL) if RERANK else None
 
 # Global variables for vector store
 index = None
-chunks = []
-metadata = []
+store = IndexStore(INDEX_FOLDER, {"model": MODEL_NAME, "chunk_tokens": CHUNK_TOKENS, "chunk_overlap_tokens": CHUNK_OVERLAP_TOKENS},
+                   INDEX_TYPE, NPROBE, EF_SEARCH, lexical=HYBRID_SEARCH)
+
+def load_saved_index():
+    """Open the index saved by an earlier run (without checking for changed files)."""
+    global index
+    with store.lock.write():
+        store.load()
+        index = store.index
+    return index is not None
+
+def read_documents(changed):
+    """Yield (filename, file_info, chunks) for each file that could be read."""
+    # PDFs are parsed in parallel worker processes; results come back in order
+    paths = [os.path.join(DOCUMENTS_FOLDER, filename) for filename, _ in changed]
+    for (filename, file_info), (path, pages, error) in zip(changed, extract_documents(paths)):
+        if error:
+            print(f"Skipping {filename}: {error}")
+            continue
+        yield filename, file_info, chunker.chunk_pages(pages)
 
 def load_documents():
-    global index, chunks, metadata
-    chunks = []
-    metadata = []
-
-    for filename in os.listdir(DOCUMENTS_FOLDER):
-        path = os.path.join(DOCUMENTS_FOLDER, filename)
-        text = ""
-
-        if filename.endswith(".pdf"):
-            reader = PdfReader(path)
-            for page in reader.pages:
-                text += page.extract_text() or ""
-        elif filename.endswith((".txt", ".md")):
-            with open(path, "r", encoding="utf-8") as f:
-                text = f.read()
-
-        if not text.strip():
-            continue
+    global index
+    # Searches wait until the store is consistent again (chunk ids may be renumbered on save)
+    with store.lock.write():
+        store.load()
 
-        # Simple chunking with overlap
-        for i in range(0, len(text), CHUNK_SIZE - CHUNK_OVERLAP):
-            chunk = text[i:i + CHUNK_SIZE]
-            chunks.append(chunk)
-            metadata.append({"file": filename, "start": i, "chunk_text": chunk})
+        # Only new or modified files are read and embedded again
+        changed, deleted = store.scan(DOCUMENTS_FOLDER)
+        store.remove_files(deleted + [filename for filename, _ in changed])
 
-    if not chunks:
-        return "No documents loaded or text extracted."
+        # Read -> chunk -> embed in batches -> add to the FAISS index, one step at a time
+        store.ingest(read_documents(changed), embedding_cache.encode, EMBED_BATCH_SIZE)
 
-    # Create embeddings
-    embeddings = embedder.encode(chunks, show_progress_bar=True)
-    embeddings = np.array(embeddings).astype('float32')
+        # Tags from documents/tags.json, for filtering sources
+        store.set_tags(read_tags(DOCUMENTS_FOLDER))
 
-    # Build FAISS index
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
+        # Save so the next start (or Load click) only has to look at changed files
+        store.save()
+        index = store.index
 
-    return f"Loaded {len(chunks)} chunks from {len(os.listdir(DOCUMENTS_FOLDER))} files."
+        # Chunk ids now point at other text (or nowhere): cached answers are stale
+        if changed or deleted:
+            response_cache.clear()
+            if reranker is not None:
+                reranker.clear()
 
-def search(question):
-    if index is None:
-        return "Please load documents first.", ""
-
-    # Embed question
-    q_embedding = embedder.encode([question])[0].astype('float32')
+        if index is None or not store.chunk_count():
+            return "No documents loaded or text extracted."
 
-    # Search top K
-    distances, indices = index.search(np.array([q_embedding]), TOP_K)
+        return (f"Loaded {store.chunk_count()} chunks from {len(store.files)} files "
+                f"({len(changed)} new or changed, {len(deleted)} removed). {embedding_cache.summary()}. "
+                f"{response_cache.summary()}" + (f". {reranker.summary()}" if reranker is not None else ""))
 
-    retrieved_chunks = []
-    retrieved_display = []
+def source_filters(files=None, tags=None, pages="", chapters=""):
+    """Filter settings from the UI as keyword arguments for store.filter_ids() (ValueError for bad ranges)."""
+    return {"files": files or None, "tags": tags or None,
+            "pages": parse_ranges(pages), "chapters": parse_ranges(chapters)}
 
-    for idx, dist in zip(indices[0], distances[0]):
-        if idx == -1:
-            continue
-        chunk_info = metadata[idx]
-        retrieved_chunks.append(chunk_info["chunk_text"])
-        retrieved_display.append(f"**From {chunk_info['file']}** (chunk starting at {chunk_info['start']}):\n{chunk_info['chunk_text'][:300]}...")
+def source_choices():
+    """Refresh the file and tag lists of the source filter."""
+    if index is None:
+        load_saved_index()
+    with store.lock.read():
+        return gr.update(choices=sorted(store.files)), gr.update(choices=store.tag_names())
+
+def search_batch(questions, k=TOP_K, filters=None):
+    """Retrieve for many questions at once. Returns (context, sources, chunk_ids) per question.
+
+    filters: keyword arguments for store.filter_ids() (see source_filters()), applied to every question.
+    """
+    if index is None and not load_saved_index():
+        return [("Please load documents first.", "", [])] * len(questions)
+
+    # Any number of searches at a time; loading documents waits for them (and they for it)
+    with store.lock.read():
+        if store.index is None:   # Never load in here: a read lock can't become a write lock
+            return [("Please load documents first.", "", [])] * len(questions)
+
+        # Only chunks of the chosen files / tags / pages / chapters are searched
+        ids = store.filter_ids(**filters) if filters else None
+        if ids is not None and not len(ids):
+            return [("No chunks match the source filter.", "", [])] * len(questions)
+
+        # Embed all questions in one pass
+        started = time.perf_counter()
+        q_embeddings = embedding_cache.encode(list(questions))
+
+        # Search top K (or the rerank pool) for every question with a single index search
+        # Vector and keyword search at the same time, fused by reciprocal rank
+        pool = max(k, RERANK_POOL) if reranker is not None else k
+        scores, indices = store.hybrid_search(questions, np.asarray(q_embeddings), pool, LEXICAL_PREFILTER, ids)
+
+        # Cross-encoder scores all question / candidate pairs in one batch and keeps the best k
+        if reranker is not None:
+            reranker.add_time("retrieve", time.perf_counter() - started)
+            scores, indices = reranker.rerank(questions, indices, store.chunk_text, k)
+
+        results = []
+        for row in indices:
+            retrieved_chunks = []
+            retrieved_display = []
+            chunk_ids = []
+            for idx in row:
+                if idx == -1:
+                    continue
+                chunk_ids.append(int(idx))
+                chunk_info = store.chunk(idx)
+                retrieved_chunks.append(chunk_info.text)
+                chapter = f", chapter {chunk_info.chapter}" if chunk_info.chapter else ""
+                retrieved_display.append(f"**From {chunk_info.file}** (page {chunk_info.page}{chapter}):\n{chunk_info.text[:300]}...")
+            results.append(("\n\n".join(retrieved_chunks), "\n\n---\n\n".join(retrieved_display), chunk_ids))
+        return results
 
-    return "\n\n".join(retrieved_chunks), "\n\n---\n\n".join(retrieved_display)
+def search(question):
+    context, sources, _ = search_batch([question])[0]
+    return context, sources
 
-def answer(question):
-    context, sources = search(question)
+def answer(question, files=None, tags=None, pages="", chapters=""):
+    """Generator for Gradio: sources appear right after retrieval, then the answer grows token by token."""
+    try:
+        filters = source_filters(files, tags, pages, chapters)
+    except ValueError as e:
+        yield f"Invalid filter: {e}", ""
+        return
+    context, sources, chunk_ids = search_batch([question], filters=filters)[0]
+
+    # Same question in other words over the same chunks: reuse the earlier answer
+    # (the question's embedding is already in the embedding cache from the search above)
+    q_vector = embedding_cache.encode(question)
+    cached = response_cache.lookup(q_vector, chunk_ids) if chunk_ids else None
+    if cached is not None:
+        print(response_cache.summary())
+        yield cached, sources
+        return
+    yield "", sources
 
     # Stronger system prompt: forces concise answers + citations
     prompt = f"""You are a helpful assistant answering questions about the AI Engineering book.
@@ -100,15 +205,18 @@ Question: {question}
 
 Answer (keep short, use bullet points if helpful):"""
 
+    started = time.perf_counter()
     try:
-        response = ollama.generate(
-            model='tinyllama',  # change to 'phi3.5' if you prefer better quality
-            prompt=prompt
-        )
-        full_answer = response['response'].strip()
-        return full_answer, sources
+        # change to 'phi3.5' if you prefer better quality
+        # Time to first token and tokens/sec of every answer go to logs/generation_metrics.csv
+        partial_answer = ""
+        for partial_answer in stream_generate(llm, 'tinyllama', prompt):
+            yield partial_answer.strip(), sources
     except Exception as e:
-        return f"Error generating answer: {str(e)}", sources
+        yield f"Error generating answer: {str(e)}", sources
+        return
+    if partial_answer.strip():
+        response_cache.store(q_vector, chunk_ids, partial_answer.strip(), time.perf_counter() - started)
 
 # Gradio interface
 with gr.Blocks() as demo:
@@ -119,12 +227,25 @@ with gr.Blocks() as demo:
     status = gr.Textbox(label="Status", interactive=False)
 
     question = gr.Textbox(label="Your Question")
+    with gr.Accordion("Filter sources", open=False):
+        with gr.Row():
+            files_filter = gr.Dropdown(label="Files", multiselect=True, choices=[])
+            tags_filter = gr.Dropdown(label="Tags (documents/tags.json)", multiselect=True, choices=[])
+        with gr.Row():
+            pages_filter = gr.Textbox(label="Pages", placeholder="e.g. 10-40 or 100-")
+            chapters_filter = gr.Textbox(label="Chapters", placeholder="e.g. 3, 2-4 or 1,5,7")
     ask_btn = gr.Button("Ask")
 
     output = gr.Textbox(label="Answer", lines=8)
     sources_box = gr.Markdown(label="Sources (what the AI actually used)")
 
-    load_btn.click(load_documents, outputs=status)
-    ask_btn.click(answer, inputs=question, outputs=[output, sources_box])
+    # Only one load at a time: it rewrites the saved index
+    load_btn.click(load_documents, outputs=status, concurrency_limit=1).then(
+        source_choices, outputs=[files_filter, tags_filter])
+    ask_btn.click(answer, inputs=[question, files_filter, tags_filter, pages_filter, chapters_filter],
+                  outputs=[output, sources_box])
+    demo.load(source_choices, outputs=[files_filter, tags_filter])
 
-demo.launch()
+if __name__ == "__main__":
+    demo.queue(default_concurrency_limit=UI_CONCURRENCY)
+    demo.launch()
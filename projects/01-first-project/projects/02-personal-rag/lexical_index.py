@@ -0,0 +1,213 @@
+"""BM25 keyword index over the chunks, saved next to the FAISS index.
+
+Vector search finds chunks with the same meaning but can miss exact terms
+("Chapter 11", an error message, a function name). This inverted index maps
+every word to the chunks containing it and ranks them with BM25.
+
+It is stored in segments under index/lexical/. Each load that adds chunks
+writes one new segment (a sorted word list plus NumPy arrays of postings,
+opened memory-mapped), so nothing already indexed is rewritten. Deleted
+chunks stay in their segment and are skipped through the live mask passed
+to search; once there are more than MAX_SEGMENTS segments they are merged
+into one. Building a segment is vectorized: the words of a batch are numbered
+through one dict, and all (word, chunk) pairs go through one np.unique call.
+Words longer than MAX_WORD_CHARS (base64 blobs, hashes, runs of digits) are
+left out: nobody searches for them.
+"""
+import json
+import os
+import re
+import shutil
+from itertools import chain
+
+import numpy as np
+
+WORD = re.compile(r"\w+")
+STOPWORDS = frozenset("""a an and are as at be by do does for from how in is it of on or that the this to was what
+when where which who why with about can""".split())
+SEGMENT_CHUNKS = 50000   # Chunks per segment when (re)building
+MAX_SEGMENTS = 8         # More segments than this are merged into one
+MAX_WORD_CHARS = 64      # Longer words are not indexed
+BM25_K1 = 1.2
+BM25_B = 0.75
+MANIFEST_FILE = "lexical.json"
+
+
+def tokenize(text):
+    return [word for word in WORD.findall(text.lower()) if word not in STOPWORDS and len(word) <= MAX_WORD_CHARS]
+
+
+class Segment:
+    """Postings of one batch of chunks: word -> (chunk ids, term frequencies)."""
+
+    def __init__(self, folder):
+        with open(os.path.join(folder, "terms.txt"), "r", encoding="utf-8") as f:
+            self.terms = {term: i for i, term in enumerate(f.read().split("\n"))}
+        load = lambda name: np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+        self.offsets = load("offsets")    # Postings of term i are [offsets[i], offsets[i + 1])
+        self.docs = load("docs")          # Position in doc_ids of each posting
+        self.tfs = load("tfs")            # How often the term occurs in that chunk
+        self.doc_ids = load("doc_ids")    # Chunk id of every chunk in the segment
+        self.lengths = load("lengths")    # Words per chunk
+
+    def postings(self, term):
+        """(chunk ids, term frequencies, chunk lengths) of one word."""
+        i = self.terms.get(term)
+        if i is None:
+            return None
+        docs = self.docs[self.offsets[i]:self.offsets[i + 1]]
+        return self.doc_ids[docs], self.tfs[docs], self.lengths[docs]
+
+    @staticmethod
+    def write(folder, doc_ids, texts):
+        """Build and save the segment for chunks doc_ids with these texts. Returns False if it has no words."""
+        tokens = [tokenize(text) for text in texts]
+        lengths = np.array([len(words) for words in tokens], dtype="int32")
+        if not lengths.sum():
+            return False
+        # Number the words in order of appearance, then renumber them in sorted order (a dict, not
+        # np.unique over one fixed-width string array, which is as wide as the longest word)
+        vocabulary = {}
+        word_index = np.fromiter((vocabulary.setdefault(word, len(vocabulary)) for word in chain.from_iterable(tokens)),
+                                 dtype="int64", count=int(lengths.sum()))
+        words = sorted(vocabulary)
+        rank = np.empty(len(words), dtype="int64")
+        rank[[vocabulary[word] for word in words]] = np.arange(len(words))
+        word_index = rank[word_index]
+        # (word, chunk) pairs sorted by word then chunk; their counts are the term frequencies
+        docs = np.repeat(np.arange(len(texts), dtype="int64"), lengths)
+        pairs, tfs = np.unique(word_index * len(texts) + docs, return_counts=True)
+        pair_words, pair_docs = np.divmod(pairs, len(texts))
+
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, "terms.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(words))
+        np.save(os.path.join(folder, "offsets.npy"), np.searchsorted(pair_words, np.arange(len(words) + 1)))
+        np.save(os.path.join(folder, "docs.npy"), pair_docs.astype("int32"))
+        np.save(os.path.join(folder, "tfs.npy"), np.minimum(tfs, 65535).astype("uint16"))
+        np.save(os.path.join(folder, "doc_ids.npy"), np.asarray(doc_ids, dtype="int64"))
+        np.save(os.path.join(folder, "lengths.npy"), lengths)
+        return True
+
+
+class LexicalIndex:
+    """Segmented on-disk BM25 index, kept in step with an IndexStore."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.segments = {}        # segment name -> Segment
+        self.indexed_until = 0    # Chunk ids below this are indexed (or deleted)
+        self.next_segment = 0
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def load(self):
+        self.segments = {}
+        try:
+            with open(self.path(MANIFEST_FILE), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            for name in manifest["segments"]:
+                self.segments[name] = Segment(self.path(name))
+        except (OSError, KeyError, ValueError):
+            self.clear()
+            return False
+        self.indexed_until = manifest["indexed_until"]
+        self.next_segment = manifest["next_segment"]
+        return True
+
+    def clear(self):
+        """Forget everything (the chunk ids were renumbered or the store was reset)."""
+        self.segments = {}
+        self.indexed_until = 0
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _save_manifest(self):
+        os.makedirs(self.folder, exist_ok=True)
+        manifest = {"segments": list(self.segments), "indexed_until": self.indexed_until,
+                    "next_segment": self.next_segment}
+        with open(self.path(MANIFEST_FILE + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(self.path(MANIFEST_FILE + ".tmp"), self.path(MANIFEST_FILE))
+
+    def _add_segments(self, ids, text_of):
+        for start in range(0, len(ids), SEGMENT_CHUNKS):
+            batch = ids[start:start + SEGMENT_CHUNKS]
+            name = f"segment_{self.next_segment:06d}"
+            self.next_segment += 1
+            if Segment.write(self.path(name), batch, [text_of(int(i)) for i in batch]):
+                self.segments[name] = Segment(self.path(name))
+
+    def update(self, live_ids, next_id, text_of):
+        """Index the live chunks added since the last update; text_of(chunk_id) returns a chunk's text."""
+        if self.indexed_until > next_id:
+            self.clear()
+        new_ids = live_ids[live_ids >= self.indexed_until]
+        if not len(new_ids) and self.indexed_until == next_id:
+            return
+        old_segments = list(self.segments)
+
+        if len(self.segments) + -(-len(new_ids) // SEGMENT_CHUNKS) > MAX_SEGMENTS:
+            # Too many small segments: rewrite all live chunks into as few as possible
+            print(f"Merging {len(self.segments)} keyword index segments...")
+            self.segments = {}
+            self._add_segments(live_ids, text_of)
+        else:
+            old_segments = []
+            self._add_segments(new_ids, text_of)
+        self.indexed_until = next_id
+        self._save_manifest()
+        for name in old_segments:
+            if name not in self.segments:
+                shutil.rmtree(self.path(name), ignore_errors=True)
+
+    def search_batch(self, queries, k, live):
+        """search() for every query, with the collection statistics computed once."""
+        live_count = max(int(live.sum()), 1)
+        words = sum(float(segment.lengths[live[segment.doc_ids]].sum()) for segment in self.segments.values())
+        stats = (live_count, max(words / live_count, 1.0))
+        return [self.search(query, k, live, stats) for query in queries]
+
+    def search(self, query, k, live, stats=None):
+        """Top k chunks for query by BM25, skipping chunk ids where live is False.
+
+        Returns (ids, scores, ids_with_every_word), best first; the last array
+        lists every live chunk that contains all words of the query.
+        """
+        words = sorted(set(tokenize(query)))
+        empty = np.zeros(0, dtype="int64")
+        if not words or not self.segments:
+            return empty, np.zeros(0, dtype="float32"), empty
+        if stats is None:
+            return self.search_batch([query], k, live)[0]
+        live_count, average_length = stats
+
+        ids, scores = [], []
+        for word in words:
+            found = [segment.postings(word) for segment in self.segments.values()]
+            found = [p for p in found if p is not None]
+            if not found:
+                continue
+            doc_ids = np.concatenate([p[0] for p in found])
+            keep = live[doc_ids]
+            doc_ids = doc_ids[keep]
+            tfs = np.concatenate([p[1] for p in found])[keep].astype("float32")
+            doc_lengths = np.concatenate([p[2] for p in found])[keep]
+            idf = np.log(1 + (live_count - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            ids.append(doc_ids)
+            scores.append(idf * tfs * (BM25_K1 + 1)
+                          / (tfs + BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / average_length)))
+
+        if not ids:
+            return empty, np.zeros(0, dtype="float32"), empty
+        unique_ids, position = np.unique(np.concatenate(ids), return_inverse=True)
+        totals = np.bincount(position, weights=np.concatenate(scores))
+        word_counts = np.bincount(position)
+        every_word = unique_ids[word_counts == len(words)] if len(ids) == len(words) else empty
+
+        if len(totals) > k:
+            top = np.argpartition(-totals, k - 1)[:k]
+            top = top[np.argsort(-totals[top])]
+        else:
+            top = np.argsort(-totals)
+        return unique_ids[top], totals[top].astype("float32"), every_word
@@ -1,99 +1,184 @@
 import gradio as gr
 from sentence_transformers import SentenceTransformer
-import faiss
 import numpy as np
-from pypdf import PdfReader
 import os
-import ollama
+import time
 import pandas as pd
+from index_store import IndexStore, parse_ranges, read_tags
+from embedding_cache import EmbeddingCache
+from extraction import extract_documents
+from chunker import Chunker
+from eval_runner import run_evaluation_rows
+from eval_cache import EvalCache, prompt_hash
+from streaming import stream_generate
+from llm_client import LLMClient
+from response_cache import ResponseCache
+from reranker import Reranker
 
 # ====================
 # CONFIGURATION
 # ====================
 EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
 DOCUMENTS_FOLDER = "documents"
-CHUNK_SIZE = 500
-CHUNK_OVERLAP = 100
+CHUNK_TOKENS = 200      # Max embedding-model tokens per chunk (all-MiniLM-L6-v2 reads 256)
+CHUNK_OVERLAP_TOKENS = 30  # Whole sentences repeated from the previous chunk, up to this many tokens
 TOP_K = 3
+LLM_MODEL = 'tinyllama'
+JUDGE_MODEL = 'tinyllama'
+EMBED_BATCH_SIZE = 256  # Chunks embedded per batch while loading
+INDEX_FOLDER = "index"  # Saved index (shared with eval.py), only changed files get re-embedded
+INDEX_TYPE = "flat"     # "flat" (exact), "ivf_flat", "ivf_pq" or "hnsw" for big collections
+NPROBE = 16             # IVF: clusters searched per question (higher = better recall, slower)
+EF_SEARCH = 64          # HNSW: candidates kept per question (higher = better recall, slower)
+HYBRID_SEARCH = True    # BM25 keyword search next to vector search (finds exact terms like "Chapter 11")
+LEXICAL_PREFILTER = 0   # Queries whose words occur together in at most this many chunks skip FAISS (0 = off)
+EVAL_CONCURRENCY = 4    # LLM calls in flight during evaluation (set OLLAMA_NUM_PARALLEL to match)
+EVAL_CHECKPOINT = "evaluation_checkpoint.jsonl"  # Finished questions, so an interrupted run can resume
+EMBEDDING_CACHE = "cache/embeddings.sqlite"  # Every vector computed so far (shared with eval.py)
+EVAL_CACHE = "cache/eval_results.sqlite"  # Earlier evaluation results (shared with eval.py)
+LLM_MAX_IN_FLIGHT = 4   # Requests sent to Ollama at once (set OLLAMA_NUM_PARALLEL to match)
+UI_CONCURRENCY = 16     # Questions Gradio handles at once; their LLM calls queue in llm_client
+LLM_QUEUE_TIMEOUT = 120 * UI_CONCURRENCY // LLM_MAX_IN_FLIGHT  # Seconds a request may wait for a slot: 2 min per round of requests ahead
+RESPONSE_CACHE_THRESHOLD = 0.95  # Cosine similarity at which two chat questions count as the same
+RESPONSE_CACHE_TTL = 24 * 3600   # Seconds a cached chat answer stays valid
+RESPONSE_CACHE_ITEMS = 1000      # Chat answers kept in memory (least recently used are dropped)
+RERANK = True           # Rerank a larger candidate pool with a cross-encoder before answering
+RERANK_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+RERANK_POOL = 20        # Candidates retrieved per question for the reranker (more = better recall, slower)
 
 # Load embedding model once
 embedder = SentenceTransformer(EMBEDDING_MODEL)
+embedding_cache = EmbeddingCache(embedder, EMBEDDING_MODEL, EMBEDDING_CACHE)
+# Chunks follow headings, paragraphs and sentences and are sized with the embedder's own tokenizer
+chunker = Chunker(embedder.tokenizer, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+eval_cache = EvalCache(EVAL_CACHE)
 
-# Global vector store
-index = None
-chunks = []
-metadata = []
-
-def load_documents():
-    global index, chunks, metadata
-    chunks = []
-    metadata = []
-
-    for filename in os.listdir(DOCUMENTS_FOLDER):
-        path = os.path.join(DOCUMENTS_FOLDER, filename)
-        text = ""
-
-        if filename.endswith(".pdf"):
-            try:
-                reader = PdfReader(path)
-                for page in reader.pages:
-                    text += page.extract_text() or ""
-            except Exception as e:
-                print(f"PDF error {filename}: {e}")
-                continue
-
-        elif filename.endswith((".txt", ".md")):
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    text = f.read()
-            except Exception as e:
-                print(f"Text error {filename}: {e}")
-                continue
-
-        if not text.strip():
-            continue
-
-        for i in range(0, len(text), CHUNK_SIZE - CHUNK_OVERLAP):
-            chunk = text[i:i + CHUNK_SIZE]
-            chunks.append(chunk)
-            metadata.append({"file": filename, "start": i, "chunk_text": chunk})
+# One shared connection pool to Ollama for chat users and the evaluation
+llm = LLMClient(max_in_flight=LLM_MAX_IN_FLIGHT, queue_timeout=LLM_QUEUE_TIMEOUT)
 
-    if not chunks:
-        return "No documents loaded."
-
-    embeddings = embedder.encode(chunks, show_progress_bar=True)
-    embeddings = np.array(embeddings).astype('float32')
-
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
-
-    return f"Loaded {len(chunks)} chunks from {len(os.listdir(DOCUMENTS_FOLDER))} files."
-
-def search(question):
-    if index is None:
-        return "", ""
+# Chat answers to questions asked before (same meaning, same retrieved chunks)
+response_cache = ResponseCache(RESPONSE_CACHE_THRESHOLD, RESPONSE_CACHE_TTL, RESPONSE_CACHE_ITEMS)
 
-    q_embedding = embedder.encode([question])[0].astype('float32')
-    distances, indices = index.search(np.array([q_embedding]), TOP_K)
+# Second stage: a cross-encoder picks the TOP_K best of RERANK_POOL candidates
+reranker = Reranker(RERANK_MODEL) if RERANK else None
 
-    retrieved_chunks = []
-    retrieved_display = []
-
-    for idx, dist in zip(indices[0], distances[0]):
-        if idx == -1:
+# Global vector store
+index = None
+store = IndexStore(INDEX_FOLDER, {"model": EMBEDDING_MODEL, "chunk_tokens": CHUNK_TOKENS,
+                                   "chunk_overlap_tokens": CHUNK_OVERLAP_TOKENS},
+                   INDEX_TYPE, NPROBE, EF_SEARCH, lexical=HYBRID_SEARCH)
+
+def load_saved_index():
+    """Open the index saved by an earlier run (without checking for changed files)."""
+    global index
+    with store.lock.write():
+        store.load()
+        index = store.index
+    return index is not None
+
+def read_documents(changed):
+    # PDFs are parsed in parallel worker processes; a bad file is skipped
+    paths = [os.path.join(DOCUMENTS_FOLDER, filename) for filename, _ in changed]
+    for (filename, file_info), (path, pages, error) in zip(changed, extract_documents(paths)):
+        if error:
+            print(f"Read error {filename}: {error}")
             continue
-        chunk_info = metadata[idx]
-        retrieved_chunks.append(chunk_info["chunk_text"])
-        display_text = f"**From {chunk_info['file']}** (chunk {chunk_info['start']}):\n{chunk_info['chunk_text'][:300]}..."
-        retrieved_display.append(display_text)
+        yield filename, file_info, chunker.chunk_pages(pages)
 
-    return "\n\n".join(retrieved_chunks), "\n\n---\n\n".join(retrieved_display)
+def load_documents():
+    global index
+    # Searches wait until the store is consistent again (chunk ids may be renumbered on save)
+    with store.lock.write():
+        store.load()
+
+        # Only new or modified files are read and embedded again
+        changed, deleted = store.scan(DOCUMENTS_FOLDER)
+        store.remove_files(deleted + [filename for filename, _ in changed])
+
+        # Streamed: read -> chunk -> embed in batches -> add to index
+        store.ingest(read_documents(changed), embedding_cache.encode, EMBED_BATCH_SIZE)
+
+        # Tags from documents/tags.json, for filtering sources
+        store.set_tags(read_tags(DOCUMENTS_FOLDER))
+        store.save()
+        index = store.index
+
+        # Chunk ids now point at other text (or nowhere): cached answers are stale
+        if changed or deleted:
+            response_cache.clear()
+            if reranker is not None:
+                reranker.clear()
+
+        if index is None or not store.chunk_count():
+            return "No documents loaded."
+
+        return (f"Loaded {store.chunk_count()} chunks from {len(store.files)} files "
+                f"({len(changed)} new or changed, {len(deleted)} removed). {embedding_cache.summary()}. "
+                f"{response_cache.summary()}" + (f". {reranker.summary()}" if reranker is not None else ""))
+
+def source_filters(files=None, tags=None, pages="", chapters=""):
+    """Filter settings from the UI as keyword arguments for store.filter_ids() (ValueError for bad ranges)."""
+    return {"files": files or None, "tags": tags or None,
+            "pages": parse_ranges(pages), "chapters": parse_ranges(chapters)}
+
+def source_choices():
+    """Refresh the file and tag lists of the source filter."""
+    if index is None:
+        load_saved_index()
+    with store.lock.read():
+        return gr.update(choices=sorted(store.files)), gr.update(choices=store.tag_names())
+
+def search_batch(questions, k=TOP_K, filters=None):
+    """Retrieve for many questions at once: one embedding pass and one index search.
+
+    Returns (context, sources, chunk_ids) per question, in the same order.
+    filters: keyword arguments for store.filter_ids() (see source_filters()), applied to every question.
+    """
+    if index is None and not load_saved_index():
+        return [("", "", [])] * len(questions)
+
+    # Any number of searches at a time; loading documents waits for them (and they for it)
+    with store.lock.read():
+        if store.index is None:   # Never load in here: a read lock can't become a write lock
+            return [("", "", [])] * len(questions)
+
+        # Only chunks of the chosen files / tags / pages / chapters are searched
+        ids = store.filter_ids(**filters) if filters else None
+        if ids is not None and not len(ids):
+            return [("", "", [])] * len(questions)
+
+        started = time.perf_counter()
+        q_embeddings = embedding_cache.encode(list(questions))
+        # Vector and keyword search at the same time, fused by reciprocal rank
+        pool = max(k, RERANK_POOL) if reranker is not None else k
+        scores, indices = store.hybrid_search(questions, np.asarray(q_embeddings), pool, LEXICAL_PREFILTER, ids)
+
+        # Cross-encoder scores all question / candidate pairs in one batch and keeps the best k
+        if reranker is not None:
+            reranker.add_time("retrieve", time.perf_counter() - started)
+            scores, indices = reranker.rerank(questions, indices, store.chunk_text, k)
+
+        results = []
+        for row in indices:
+            retrieved_chunks = []
+            retrieved_display = []
+            for idx in row:
+                if idx == -1:
+                    continue
+                chunk_info = store.chunk(idx)
+                retrieved_chunks.append(chunk_info.text)
+                chapter = f", chapter {chunk_info.chapter}" if chunk_info.chapter else ""
+                display_text = f"**From {chunk_info.file}** (page {chunk_info.page}{chapter}):\n{chunk_info.text[:300]}..."
+                retrieved_display.append(display_text)
+            results.append(("\n\n".join(retrieved_chunks), "\n\n---\n\n".join(retrieved_display),
+                            [int(idx) for idx in row if idx != -1]))
+        return results
 
-def answer(question):
-    context, sources = search(question)
+def search(question):
+    context, sources, _ = search_batch([question])[0]
+    return context, sources
 
-    prompt = f"""You are a helpful assistant answering questions strictly based on the AI Engineering book.
+ANSWER_PROMPT = """You are a helpful assistant answering questions strictly based on the AI Engineering book.
 Use ONLY the provided context. Be concise, accurate.
 If not in context, say: "I don't have enough information from the documents."
 
@@ -106,17 +191,55 @@ Question: {question}
 
 Answer (short, bullet points if helpful):"""
 
+def answer_stream(question, retrieved=None, use_cache=True):
+    """Generator for Gradio: sources appear right after retrieval, then the answer grows token by token."""
+    # retrieved: (context, sources, chunk_ids) already looked up by search_batch()
+    context, sources, chunk_ids = retrieved if retrieved else search_batch([question])[0]
+
+    # Same question in other words over the same chunks: reuse the earlier answer
+    # (the question's embedding is already in the embedding cache from the search above)
+    use_cache = use_cache and bool(chunk_ids)
+    if use_cache:
+        q_vector = embedding_cache.encode(question)
+        cached = response_cache.lookup(q_vector, chunk_ids)
+        if cached is not None:
+            print(response_cache.summary())
+            yield cached, sources
+            return
+    yield "", sources
+    prompt = ANSWER_PROMPT.format(context=context, question=question)
+
+    started = time.perf_counter()
+    partial_answer = ""
     try:
-        response = ollama.generate(model='tinyllama', prompt=prompt)
-        return response['response'].strip(), sources
+        # Time to first token and tokens/sec of every answer go to logs/generation_metrics.csv
+        for partial_answer in stream_generate(llm, LLM_MODEL, prompt):
+            yield partial_answer.strip(), sources
     except Exception as e:
-        return f"Error: {str(e)}", sources
+        yield f"Error: {str(e)}", sources
+        return
+    if use_cache and partial_answer.strip():
+        response_cache.store(q_vector, chunk_ids, partial_answer.strip(), time.perf_counter() - started)
+
+def ask(question, files=None, tags=None, pages="", chapters=""):
+    """Chat tab: answer_stream() over the sources chosen in the filter."""
+    try:
+        filters = source_filters(files, tags, pages, chapters)
+    except ValueError as e:
+        yield f"Invalid filter: {e}", ""
+        return
+    yield from answer_stream(question, search_batch([question], filters=filters)[0])
+
+def answer(question, retrieved=None):
+    """The complete answer at once (used by the evaluation, which always asks the model)."""
+    for full_answer, sources in answer_stream(question, retrieved, use_cache=False):
+        pass
+    return full_answer, sources
 
 # ====================
 # EVALUATION FUNCTIONS
 # ====================
-def judge_answer(question, answer_text, expected_behavior, model='tinyllama'):
-    prompt = f"""You are an impartial judge.
+JUDGE_PROMPT = """You are an impartial judge.
 Question: {question}
 AI Answer: {answer_text}
 Expected: {expected_behavior}
@@ -132,8 +255,11 @@ Score: X/5
 Reason: [1-2 sentences]
 """
 
+def judge_answer(question, answer_text, expected_behavior, model=JUDGE_MODEL):
+    prompt = JUDGE_PROMPT.format(question=question, answer_text=answer_text, expected_behavior=expected_behavior)
+
     try:
-        response = ollama.generate(model=model, prompt=prompt)
+        response = llm.generate(model=model, prompt=prompt)
         return response['response'].strip()
     except Exception as e:
         return f"Judge error: {str(e)}"
@@ -144,21 +270,37 @@ def run_evaluation():
     except FileNotFoundError:
         return None, "test_set.csv not found."
 
-    results = []
-
-    for idx, row in test_df.iterrows():
-        real_answer, sources = answer(row['question'])
-        score = judge_answer(row['question'], real_answer, row['expected_behavior'])
-        results.append({
-            'question': row['question'],
-            'category': row['category'],
-            'answer': real_answer,
-            'sources': sources,
-            'score': score
-        })
+    rows = test_df.to_dict("records")
+
+    # Retrieval for the whole test set in one batch, before any LLM call
+    if index is None and not load_saved_index():   # Before the read lock: opening needs the write lock
+        return None, "Please load documents first."
+    with store.lock.read():   # Chunk ids and their texts from the same version of the store
+        retrieved = search_batch([row['question'] for row in rows])
+
+        # A row is only re-run if its question, retrieved chunks, prompts or models changed
+        prompts = prompt_hash(ANSWER_PROMPT, JUDGE_PROMPT)
+        cache_keys = [eval_cache.key(row['question'], row['expected_behavior'],
+                                     [store.chunk_text(i) for i in chunk_ids], prompts, LLM_MODEL, JUDGE_MODEL)
+                      for row, (_, _, chunk_ids) in zip(rows, retrieved)]
+
+    # Answers and judgements run concurrently; finished questions are checkpointed
+    results, stats = run_evaluation_rows(
+        rows,
+        generate=lambda i, row: answer(row['question'], retrieved[i]),
+        judge=lambda row, answer_text: judge_answer(row['question'], answer_text, row['expected_behavior']),
+        checkpoint=EVAL_CHECKPOINT,
+        concurrency=EVAL_CONCURRENCY,
+        cache=eval_cache,
+        cache_keys=cache_keys,
+    )
+    if reranker is not None:
+        print(reranker.summary())
 
     results_df = pd.DataFrame(results)
-    return results_df, "Evaluation complete!"
+    return results_df, (f"Evaluation complete! {stats['answered']} questions in {stats['seconds']}s "
+                        f"({stats['questions_per_minute']} questions/min, {stats['from_checkpoint']} from checkpoint, "
+                        f"{stats['from_cache']} unchanged and taken from the cache)")
 
 # ====================
 # GRADIO UI
@@ -172,13 +314,23 @@ with gr.Blocks() as demo:
         status = gr.Textbox(label="Status", interactive=False)
 
         question = gr.Textbox(label="Your Question")
+        with gr.Accordion("Filter sources", open=False):
+            with gr.Row():
+                files_filter = gr.Dropdown(label="Files", multiselect=True, choices=[])
+                tags_filter = gr.Dropdown(label="Tags (documents/tags.json)", multiselect=True, choices=[])
+            with gr.Row():
+                pages_filter = gr.Textbox(label="Pages", placeholder="e.g. 10-40 or 100-")
+                chapters_filter = gr.Textbox(label="Chapters", placeholder="e.g. 3, 2-4 or 1,5,7")
         ask_btn = gr.Button("Ask")
 
         output = gr.Textbox(label="Answer", lines=8)
         sources_box = gr.Markdown(label="Sources")
 
-        load_btn.click(load_documents, outputs=status)
-        ask_btn.click(answer, inputs=question, outputs=[output, sources_box])
+        # Only one load at a time: it rewrites the saved index
+        load_btn.click(load_documents, outputs=status, concurrency_limit=1).then(
+            source_choices, outputs=[files_filter, tags_filter])
+        ask_btn.click(ask, inputs=[question, files_filter, tags_filter, pages_filter, chapters_filter],
+                      outputs=[output, sources_box])
 
     with gr.Tab("Evaluation"):
         gr.Markdown("Run offline evaluation on test_set.csv")
@@ -190,6 +342,10 @@ with gr.Blocks() as demo:
             df, msg = run_evaluation()
             return df, msg
 
-        eval_btn.click(run_eval_ui, outputs=[eval_output, eval_status])
+        eval_btn.click(run_eval_ui, outputs=[eval_output, eval_status], concurrency_limit=1)
+
+    demo.load(source_choices, outputs=[files_filter, tags_filter])
 
-demo.launch()
\ No newline at end of file
+if __name__ == "__main__":
+    demo.queue(default_concurrency_limit=UI_CONCURRENCY)
+    demo.launch()
\ No newline at end of file
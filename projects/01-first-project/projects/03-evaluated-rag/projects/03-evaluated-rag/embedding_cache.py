@@ -0,0 +1,105 @@
+"""Cache for SentenceTransformer embeddings.
+
+Vectors are keyed on (model name, sha256 of the text). A small in-memory LRU
+sits in front of a SQLite file, so repeated questions and chunks that were
+already embedded are lookups instead of another run of the model.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """Drop-in for embedder.encode() that remembers every vector it computed."""
+
+    def __init__(self, embedder, model_name, path="cache/embeddings.sqlite", memory_items=10000):
+        self.embedder = embedder
+        self.model_name = model_name
+        self.memory_items = memory_items
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.db.commit()
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\n{text}".encode("utf-8")).hexdigest()
+
+    def encode(self, texts, **kwargs):
+        """Same as embedder.encode(texts), but only texts never seen before reach the model."""
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+
+        keys = [self.key(text) for text in texts]
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+
+            # Everything not in memory: one query to the SQLite file per 500 keys
+            wanted = list({key for key in keys if key not in found})
+            for start in range(0, len(wanted), 500):
+                batch = wanted[start:start + 500]
+                rows = self.db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype="float32")
+                    self._remember(key, found[key])
+                    self.disk_hits += 1
+
+        # Embed the missing texts in a single call to the model
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = np.asarray(self.embedder.encode(list(missing.values()), **kwargs), dtype="float32")
+            with self.lock:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                    [(key, vector.tobytes()) for key, vector in zip(missing, vectors)],
+                )
+                self.db.commit()
+                for key, vector in zip(missing, vectors):
+                    found[key] = vector
+                    self._remember(key, vector)
+
+        with self.lock:
+            self.misses += len(missing)
+            self.hits += len(keys) - len(missing)
+
+        result = np.stack([found[key] for key in keys]) if keys else np.zeros((0, 0), dtype="float32")
+        return result[0] if single else result
+
+    def _remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "memory_items": len(self.memory),
+        }
+
+    def summary(self):
+        s = self.stats()
+        return f"Embedding cache: {s['hits']} hits ({s['disk_hits']} from disk), {s['misses']} misses, hit rate {s['hit_rate']:.0%}"
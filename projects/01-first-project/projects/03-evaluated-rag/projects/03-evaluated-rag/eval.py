@@ -1,123 +1,141 @@
 import pandas as pd
-import ollama
 from sentence_transformers import SentenceTransformer
-import faiss
 import numpy as np
-from pypdf import PdfReader
 import os
+import time
+from index_store import IndexStore
+from embedding_cache import EmbeddingCache
+from extraction import extract_documents
+from chunker import Chunker
+from eval_runner import run_evaluation_rows
+from eval_cache import EvalCache, prompt_hash
+from llm_client import LLMClient
+from reranker import Reranker
 
 # ====================
 # CONFIGURATION
 # ====================
 EMBEDDING_MODEL = 'all-MiniLM-L6-v2'      # Fast & good quality
 DOCUMENTS_FOLDER = "documents"             # Folder with your PDFs/text files
-CHUNK_SIZE = 500                           # Characters per chunk
-CHUNK_OVERLAP = 100                        # Overlap between chunks
+CHUNK_TOKENS = 200                         # Max embedding-model tokens per chunk (same as app.py)
+CHUNK_OVERLAP_TOKENS = 30                  # Sentences repeated from the previous chunk, up to this many tokens
 TOP_K = 3                                  # Retrieve top 3 chunks
+LLM_MODEL = 'tinyllama'                    # Model that answers the questions
 JUDGE_MODEL = 'tinyllama'                  # Can change to 'phi3.5' later
+EMBED_BATCH_SIZE = 256                     # Chunks embedded per batch while loading
+INDEX_FOLDER = "index"                     # Saved index (shared with app.py)
+INDEX_TYPE = "flat"                        # Keep the same as app.py ("flat", "ivf_flat", "ivf_pq", "hnsw")
+NPROBE = 16                                # IVF: clusters searched per question
+EF_SEARCH = 64                             # HNSW: candidates kept per question
+HYBRID_SEARCH = True                       # BM25 keyword search next to vector search (finds exact terms like "Chapter 11")
+LEXICAL_PREFILTER = 0                      # Queries whose words occur together in at most this many chunks skip FAISS (0 = off)
+RERANK = True                              # Rerank a larger candidate pool with a cross-encoder (same as app.py)
+RERANK_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+RERANK_POOL = 20                           # Candidates retrieved per question for the reranker
+EMBEDDING_CACHE = "cache/embeddings.sqlite"  # Cached vectors (shared with app.py)
+EVAL_CONCURRENCY = 4                       # LLM calls in flight at once (set OLLAMA_NUM_PARALLEL to match)
+EVAL_CHECKPOINT = "evaluation_checkpoint.jsonl"  # Finished questions, so an interrupted run can resume
+EVAL_CACHE = "cache/eval_results.sqlite"   # Results of earlier runs, reused while nothing they depend on changed
+LLM_MAX_IN_FLIGHT = EVAL_CONCURRENCY       # Requests sent to Ollama at once
 
 # Load embedding model once
 embedder = SentenceTransformer(EMBEDDING_MODEL)
+embedding_cache = EmbeddingCache(embedder, EMBEDDING_MODEL, EMBEDDING_CACHE)
+chunker = Chunker(embedder.tokenizer, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+reranker = Reranker(RERANK_MODEL) if RERANK else None
+eval_cache = EvalCache(EVAL_CACHE)
+# Queue size matches the runner, which never has more than EVAL_CONCURRENCY calls waiting
+llm = LLMClient(max_in_flight=LLM_MAX_IN_FLIGHT, max_queue=EVAL_CONCURRENCY)
 
 # Global vector store variables
 index = None
-chunks = []
-metadata = []
+store = IndexStore(INDEX_FOLDER, {"model": EMBEDDING_MODEL, "chunk_tokens": CHUNK_TOKENS,
+                                   "chunk_overlap_tokens": CHUNK_OVERLAP_TOKENS},
+                   INDEX_TYPE, NPROBE, EF_SEARCH, lexical=HYBRID_SEARCH)
 
 # ====================
 # LOAD DOCUMENTS & BUILD INDEX
 # ====================
+def read_documents(changed):
+    """Read PDFs/txt/md (PDFs are parsed in parallel worker processes)."""
+    paths = [os.path.join(DOCUMENTS_FOLDER, filename) for filename, _ in changed]
+    for (filename, file_info), (path, pages, error) in zip(changed, extract_documents(paths)):
+        if error:
+            print(f"Error reading {filename}: {error}")
+            continue
+        # Split at headings, paragraphs and sentences (see chunker.py)
+        yield filename, file_info, chunker.chunk_pages(pages)
+
 def load_documents():
-    global index, chunks, metadata
-    chunks = []
-    metadata = []
-
-    print("Loading documents...")
-
-    for filename in os.listdir(DOCUMENTS_FOLDER):
-        path = os.path.join(DOCUMENTS_FOLDER, filename)
-        text = ""
-
-        # Read PDF
-        if filename.endswith(".pdf"):
-            try:
-                reader = PdfReader(path)
-                for page in reader.pages:
-                    text += page.extract_text() or ""
-            except Exception as e:
-                print(f"Error reading PDF {filename}: {e}")
-                continue
+    global index
 
-        # Read txt/md
-        elif filename.endswith((".txt", ".md")):
-            try:
-                with open(path, "r", encoding="utf-8") as f:
-                    text = f.read()
-            except Exception as e:
-                print(f"Error reading {filename}: {e}")
-                continue
+    # Reuse the saved index: only new or modified files are read and embedded again
+    store.load()
+    changed, deleted = store.scan(DOCUMENTS_FOLDER)
+    store.remove_files(deleted + [filename for filename, _ in changed])
 
-        if not text.strip():
-            continue
+    print(f"Loading documents ({len(changed)} new or changed, {len(deleted)} removed)...")
 
-        # Chunking with overlap
-        for i in range(0, len(text), CHUNK_SIZE - CHUNK_OVERLAP):
-            chunk = text[i:i + CHUNK_SIZE]
-            chunks.append(chunk)
-            metadata.append({
-                "file": filename,
-                "start": i,
-                "chunk_text": chunk
-            })
-
-    if not chunks:
-        return "No documents loaded or no text extracted."
+    # Streamed, so memory stays flat: read -> chunk -> embed in batches -> add to the FAISS index
+    store.ingest(read_documents(changed), embedding_cache.encode, EMBED_BATCH_SIZE)
 
-    # Embed all chunks
-    print("Creating embeddings...")
-    embeddings = embedder.encode(chunks, show_progress_bar=True)
-    embeddings = np.array(embeddings).astype('float32')
+    # Save index + embeddings + chunks for the next run
+    store.save()
+    index = store.index
 
-    # Build FAISS index
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
+    if index is None or not store.chunk_count():
+        return "No documents loaded or no text extracted."
 
-    return f"Loaded {len(chunks)} chunks from {len(os.listdir(DOCUMENTS_FOLDER))} files."
+    return f"Loaded {store.chunk_count()} chunks from {len(store.files)} files."
 
 # ====================
 # RETRIEVAL
 # ====================
-def search(question):
+def search_batch(questions, k=TOP_K):
+    """Retrieve for many questions at once: one embedding pass and one index search.
+
+    Returns (context, sources, chunk_ids) per question, in the same order.
+    """
     if index is None:
-        return "", ""
+        return [("", "", [])] * len(questions)
 
-    q_embedding = embedder.encode([question])[0].astype('float32')
-    distances, indices = index.search(np.array([q_embedding]), TOP_K)
+    started = time.perf_counter()
+    q_embeddings = embedding_cache.encode(list(questions))
+    # Vector and keyword search at the same time, fused by reciprocal rank
+    pool = max(k, RERANK_POOL) if reranker is not None else k
+    scores, indices = store.hybrid_search(questions, np.asarray(q_embeddings), pool, LEXICAL_PREFILTER)
 
-    retrieved_chunks = []
-    retrieved_display = []
+    # Cross-encoder scores all question / candidate pairs in one batch and keeps the best k
+    if reranker is not None:
+        reranker.add_time("retrieve", time.perf_counter() - started)
+        scores, indices = reranker.rerank(questions, indices, store.chunk_text, k)
 
-    for idx, dist in zip(indices[0], distances[0]):
-        if idx == -1:
-            continue
-        chunk_info = metadata[idx]
-        retrieved_chunks.append(chunk_info["chunk_text"])
-        display_text = (
-            f"**From {chunk_info['file']}** (chunk starting at {chunk_info['start']}):\n"
-            f"{chunk_info['chunk_text'][:300]}..."
-        )
-        retrieved_display.append(display_text)
+    results = []
+    for row in indices:
+        retrieved_chunks = []
+        retrieved_display = []
+        for idx in row:
+            if idx == -1:
+                continue
+            chunk_info = store.chunk(idx)
+            retrieved_chunks.append(chunk_info.text)
+            display_text = (
+                f"**From {chunk_info.file}** (page {chunk_info.page}):\n"
+                f"{chunk_info.text[:300]}..."
+            )
+            retrieved_display.append(display_text)
+        results.append(("\n\n".join(retrieved_chunks), "\n\n---\n\n".join(retrieved_display),
+                        [int(idx) for idx in row if idx != -1]))
+    return results
 
-    return "\n\n".join(retrieved_chunks), "\n\n---\n\n".join(retrieved_display)
+def search(question):
+    context, sources, _ = search_batch([question])[0]
+    return context, sources
 
 # ====================
 # ANSWER GENERATION
 # ====================
-def answer(question):
-    context, sources = search(question)
-
-    prompt = f"""You are a helpful assistant answering questions strictly based on the AI Engineering book.
+ANSWER_PROMPT = """You are a helpful assistant answering questions strictly based on the AI Engineering book.
 Use ONLY the provided context below to answer. Be concise, clear, accurate, and professional.
 If the information is not in the context, say exactly: "I don't have enough information from the documents."
 
@@ -130,9 +148,14 @@ Question: {question}
 
 Answer (keep short, use bullet points if helpful):"""
 
+def answer(question, retrieved=None):
+    # retrieved: (context, sources, chunk_ids) already looked up by search_batch()
+    context, sources = retrieved[:2] if retrieved else search(question)
+    prompt = ANSWER_PROMPT.format(context=context, question=question)
+
     try:
-        response = ollama.generate(
-            model='tinyllama',
+        response = llm.generate(
+            model=LLM_MODEL,
             prompt=prompt
         )
         full_answer = response['response'].strip()
@@ -143,8 +166,7 @@ Answer (keep short, use bullet points if helpful):"""
 # ====================
 # LLM-AS-A-JUDGE
 # ====================
-def judge_answer(question, answer_text, expected_behavior, model='tinyllama'):
-    prompt = f"""You are an impartial judge evaluating an AI answer against expected behavior.
+JUDGE_PROMPT = """You are an impartial judge evaluating an AI answer against expected behavior.
 Question: {question}
 AI Answer: {answer_text}
 Expected Behavior: {expected_behavior}
@@ -160,8 +182,11 @@ Score: X/5
 Reason: [short explanation, 1-2 sentences]
 """
 
+def judge_answer(question, answer_text, expected_behavior, model=JUDGE_MODEL):
+    prompt = JUDGE_PROMPT.format(question=question, answer_text=answer_text, expected_behavior=expected_behavior)
+
     try:
-        response = ollama.generate(
+        response = llm.generate(
             model=model,
             prompt=prompt
         )
@@ -179,28 +204,39 @@ def run_evaluation():
         print("Error: test_set.csv not found in the folder.")
         return
 
-    results = []
-
-    for idx, row in test_df.iterrows():
-        print(f"Evaluating question {idx+1}/{len(test_df)}: {row['question']}")
-        real_answer, sources = answer(row['question'])
-        score = judge_answer(
-            row['question'],
-            real_answer,
-            row['expected_behavior']
-        )
-        results.append({
-            'question': row['question'],
-            'category': row['category'],
-            'answer': real_answer,
-            'sources': sources,
-            'score': score
-        })
+    rows = test_df.to_dict("records")
+
+    # Retrieval for the whole test set in one batch, before any LLM call
+    print(f"Retrieving context for {len(rows)} questions...")
+    retrieved = search_batch([row['question'] for row in rows])
+
+    # A row is only re-run if its question, retrieved chunks, prompts or models changed
+    prompts = prompt_hash(ANSWER_PROMPT, JUDGE_PROMPT)
+    cache_keys = [eval_cache.key(row['question'], row['expected_behavior'],
+                                 [store.chunk_text(i) for i in chunk_ids], prompts, LLM_MODEL, JUDGE_MODEL)
+                  for row, (_, _, chunk_ids) in zip(rows, retrieved)]
+
+    # Answers and judgements run concurrently; finished questions are checkpointed
+    results, stats = run_evaluation_rows(
+        rows,
+        generate=lambda i, row: answer(row['question'], retrieved[i]),
+        judge=lambda row, answer_text: judge_answer(row['question'], answer_text, row['expected_behavior']),
+        checkpoint=EVAL_CHECKPOINT,
+        concurrency=EVAL_CONCURRENCY,
+        cache=eval_cache,
+        cache_keys=cache_keys,
+    )
 
     results_df = pd.DataFrame(results)
     print("\nEvaluation Results:")
     print(results_df)
     results_df.to_csv("evaluation_results.csv", index=False)
+    print(embedding_cache.summary())
+    print(eval_cache.summary())
+    if reranker is not None:
+        print(reranker.summary())
+    print(f"{stats['answered']} questions in {stats['seconds']}s ({stats['questions_per_minute']} questions/min), "
+          f"{stats['from_checkpoint']} taken from the checkpoint")
     print("\nEvaluation complete. Results saved to evaluation_results.csv")
 
 if __name__ == "__main__":
@@ -208,4 +244,4 @@ if __name__ == "__main__":
     load_status = load_documents()
     print(load_status)
     print("\nStarting evaluation...")
-    run_evaluation()
\ No newline at end of file
+    run_evaluation()
\ No newline at end of file
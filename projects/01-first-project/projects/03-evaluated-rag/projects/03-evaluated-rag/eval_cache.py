@@ -0,0 +1,57 @@
+"""Cache of evaluation results.
+
+A row's answer and score only depend on the question, its expected
+behaviour, the chunks retrieved for it, the prompt templates and the two
+models. The finished result is stored in a SQLite file under a hash of all of
+those, so a re-run only calls the LLM for rows where one of them changed.
+Chunks count by their text, not their FAISS id: ids are renumbered when the
+index is compacted or rebuilt, and then point at other text.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+def prompt_hash(*templates):
+    """Short hash of the prompt templates, changes whenever one word of a prompt does."""
+    return hashlib.sha256("\n\n".join(templates).encode("utf-8")).hexdigest()[:16]
+
+
+class EvalCache:
+    """Finished evaluation rows, keyed on everything that went into them."""
+
+    def __init__(self, path="cache/eval_results.sqlite"):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, result TEXT)")
+        self.db.commit()
+
+    def key(self, question, expected_behavior, chunk_texts, prompts, model, judge_model):
+        chunks = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in chunk_texts]
+        parts = [question, expected_behavior, chunks, prompts, model, judge_model]
+        return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.hits += 1
+                return json.loads(row[0])
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO results (key, result) VALUES (?, ?)", (key, json.dumps(result)))
+            self.db.commit()
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return f"Eval cache: {self.hits} of {lookups} rows reused ({rate:.0%})"
@@ -0,0 +1,143 @@
+"""Run an evaluation with several questions in flight at once.
+
+Each question needs two LLM calls: generate the answer, then judge it. Done
+one after the other, the Ollama server sits idle while Python waits. Here a
+thread pool keeps `concurrency` calls running: as soon as an answer is back
+its judge call is started, and a new question takes the freed slot, so
+generation and judging overlap. Every finished question is appended to a
+JSONL checkpoint with its cache key; if the run is interrupted, the next run
+skips the rows whose key is still the same (a row whose retrieved chunks,
+prompts or models changed meanwhile is run again). With an EvalCache, rows
+whose inputs haven't changed since an earlier run are taken from the cache
+without any LLM call.
+Results come back in test set order.
+"""
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+def read_checkpoint(path, rows, keys=None):
+    """Results saved by an interrupted run, by row number.
+
+    Only rows whose saved cache key is still keys[i] are kept (without keys:
+    rows that still ask the same question).
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Half-written last line of a crashed run
+            i = record.pop("row", None)
+            key = record.pop("cache_key", None)
+            if not isinstance(i, int) or i >= len(rows):
+                continue
+            if keys is not None and key != keys[i]:
+                continue
+            if keys is None and record.get("question") != rows[i]["question"]:
+                continue
+            done[i] = record
+    return done
+
+
+def run_evaluation_rows(rows, generate, judge, checkpoint="evaluation_checkpoint.jsonl", concurrency=4,
+                        progress=print, cache=None, cache_keys=None):
+    """Answer and judge every row, concurrency LLM calls at a time.
+
+    rows are dicts with at least "question" (e.g. test_df.to_dict("records")).
+    generate(i, row) returns (answer, sources), judge(row, answer) returns the
+    score text. cache_keys[i] is the EvalCache key of row i. Returns (results
+    in row order, stats), where stats has the questions answered now, the ones
+    taken from the checkpoint and from the cache, the seconds taken and
+    questions per minute. The checkpoint is removed once every row is done.
+    """
+    def checkpoint_line(i):
+        return json.dumps(dict(done[i], row=i, cache_key=cache_keys[i] if cache_keys is not None else None)) + "\n"
+
+    done = read_checkpoint(checkpoint, rows, cache_keys)
+    if done:
+        progress(f"Resuming: {len(done)} of {len(rows)} questions already in {checkpoint}")
+    cached = 0
+    if cache is not None:
+        for i in range(len(rows)):
+            if i not in done:
+                record = cache.get(cache_keys[i])
+                if record is not None:
+                    done[i] = record
+                    cached += 1
+        progress(f"{cached} of {len(rows)} questions unchanged since an earlier run, taken from the cache")
+    todo = iter([i for i in range(len(rows)) if i not in done])
+
+    started = time.perf_counter()
+    finished = 0
+    pending = {}  # future -> (stage, row number, answer, sources)
+
+    def generate_row(i):
+        try:
+            return generate(i, rows[i])
+        except Exception as e:
+            return f"Error: {e}", ""
+
+    def judge_row(i, answer):
+        try:
+            return judge(rows[i], answer)
+        except Exception as e:
+            return f"Judge error: {e}"
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool, open(checkpoint, "w", encoding="utf-8") as log:
+        # Start the checkpoint again from the good records (drops a half-written line from a crash)
+        for i in sorted(done):
+            log.write(checkpoint_line(i))
+
+        def fill():
+            # One question per worker: each one is either generating or being judged
+            while len(pending) < concurrency:
+                i = next(todo, None)
+                if i is None:
+                    return
+                pending[pool.submit(generate_row, i)] = ("generate", i, None, None)
+
+        fill()
+        while pending:
+            completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                stage, i, answer, sources = pending.pop(future)
+                if stage == "generate":
+                    answer, sources = future.result()
+                    pending[pool.submit(judge_row, i, answer)] = ("judge", i, answer, sources)
+                    continue
+
+                row = rows[i]
+                done[i] = {
+                    "question": row["question"],
+                    "category": row.get("category", ""),
+                    "answer": answer,
+                    "sources": sources,
+                    "score": future.result(),
+                }
+                log.write(checkpoint_line(i))
+                log.flush()
+                # Failed calls are not cached, so they are tried again next time
+                if cache is not None and not answer.startswith("Error") and "Judge error" not in done[i]["score"]:
+                    cache.put(cache_keys[i], done[i])
+                finished += 1
+                minutes = (time.perf_counter() - started) / 60
+                progress(f"Evaluated {len(done)}/{len(rows)} ({finished / minutes:.1f} questions/min)")
+            fill()
+
+    seconds = time.perf_counter() - started
+    if len(done) == len(rows):
+        os.remove(checkpoint)
+    stats = {
+        "answered": finished,
+        "from_checkpoint": len(done) - finished - cached,
+        "from_cache": cached,
+        "seconds": round(seconds, 1),
+        "questions_per_minute": round(finished / (seconds / 60), 1) if finished else 0.0,
+    }
+    return [done[i] for i in sorted(done)], stats
@@ -0,0 +1,821 @@
+"""Saved FAISS index that is updated file by file.
+
+The index folder holds:
+- index.faiss     FAISS index that uses our own chunk ids (IndexIDMap2)
+- embeddings.f32  chunk embeddings, row = chunk id
+- chunks.txt      the text of every chunk, back to back (UTF-8)
+- chunk_*.bin     one NumPy column per chunk field (file id, start, text offset, ...), row = chunk id
+- manifest.json   index settings, file names, and size, mtime, sha256 and chunk ids of every file
+
+Everything except the FAISS index is opened memory-mapped, so looking up a
+chunk by id is O(1) and no Python object is kept per chunk.
+
+load_documents() asks the store which files were added, changed or deleted
+and only re-reads and re-embeds those. Unchanged files keep their vectors.
+New chunks are streamed through ingest(): they are embedded in fixed-size
+batches and appended to disk and to the index batch by batch, so memory use
+doesn't grow with the size of the corpus being loaded.
+
+The FAISS index is only a search structure over embeddings.f32, so its type
+can be changed without re-embedding anything:
+- flat      exact search, cost grows linearly with the number of chunks
+- ivf_flat  vectors grouped in clusters, only the nprobe nearest clusters are searched
+- ivf_pq    like ivf_flat, but vectors are compressed (much less memory, a bit less recall)
+- hnsw      graph search, tuned with ef_search (can't delete vectors, rebuilt instead)
+IVF types are trained on a random sample of the chunks. `python index_store.py`
+prints recall vs. latency of each type against exact search on a saved index.
+
+search() and hybrid_search() take an optional list of chunk ids to search in,
+made by filter_ids() from file names, tags, a page range or a chapter range.
+Files are contiguous id ranges and pages / chapters are columns, so building
+the list never touches the vectors. Small selections are compared directly
+with their embeddings; larger ones use a FAISS ID selector.
+
+With lexical=True a BM25 keyword index (lexical_index.py) is kept in step with
+the chunks, and hybrid_search() runs it next to the vector search and fuses
+both rankings with reciprocal rank fusion.
+
+Loading changes the files, columns and index in place, and save() may
+renumber every chunk id. store.lock is a ReadWriteLock: searches hold it
+for reading (any number at a time), load / ingest / save for writing, so a
+search never sees a half-updated store.
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import faiss
+import numpy as np
+
+from lexical_index import LexicalIndex
+
+FORMAT_VERSION = 4
+INDEX_FILE = "index.faiss"
+EMBEDDINGS_FILE = "embeddings.f32"
+TEXT_FILE = "chunks.txt"
+MANIFEST_FILE = "manifest.json"
+TAGS_FILE = "tags.json"   # Optional, in the documents folder: {"file.pdf": ["tag", ...]}
+RANGE = re.compile(r"(\d+)(?:-(\d*))?")   # "12", "10-40" or "10-" (no upper bound)
+
+# One file per column, row i describes chunk id i
+COLUMNS = {
+    "file_id": "int32",       # Position in the manifest's file_names list
+    "start": "int64",         # Character position of the chunk in its document
+    "page": "int32",          # Page of the document the chunk starts on (1-based, 0 = unknown)
+    "byte_start": "int64",    # Byte position of the chunk in its document's UTF-8 text
+    "chapter": "int32",       # Chapter the chunk is in (0 = unknown / before the first chapter)
+    "text_offset": "int64",   # Byte position of the chunk in chunks.txt
+    "text_length": "int32",   # Byte length of the chunk in chunks.txt
+}
+
+SUPPORTED_FILES = (".pdf", ".txt", ".md")
+EMBED_BATCH_SIZE = 256
+COMPACT_RATIO = 0.5  # Rewrite the files once more than half of the rows belong to deleted chunks
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+TRAINED_TYPES = ("ivf_flat", "ivf_pq")
+MIN_TRAIN_CHUNKS = 10000   # Below this IVF can't be trained well (and flat is fast anyway)
+TRAIN_SAMPLE = 100000      # Chunks used to train IVF clusters / PQ codebooks
+RETRAIN_GROWTH = 4         # Retrain once the index holds 4x the chunks it was trained on
+HNSW_M = 32                # Links per node in the HNSW graph
+RRF_K = 60                 # Reciprocal rank fusion: score = sum of 1 / (RRF_K + rank)
+HYBRID_DEPTH = 4           # Each search returns HYBRID_DEPTH * k candidates for the fusion
+DIRECT_SEARCH_MAX = 20000  # Filters selecting fewer chunks than this skip FAISS and compare embeddings directly
+
+Chunk = namedtuple("Chunk", ["file", "start", "page", "text", "chapter"])
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def column_file(name):
+    return f"chunk_{name}.bin"
+
+
+def new_index(index_type, dimension, count):
+    """Empty FAISS index of index_type, sized for about count vectors."""
+    if index_type == "flat":
+        return faiss.IndexIDMap2(faiss.IndexFlatL2(dimension))
+    if index_type == "hnsw":
+        return faiss.IndexIDMap2(faiss.IndexHNSWFlat(dimension, HNSW_M))
+    if index_type not in TRAINED_TYPES:
+        raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+    # Rule of thumb: about 4 * sqrt(n) clusters, with at least 39 training vectors per cluster
+    nlist = max(1, min(int(4 * count ** 0.5), count // 39))
+    quantizer = faiss.IndexFlatL2(dimension)
+    if index_type == "ivf_flat":
+        return faiss.IndexIVFFlat(quantizer, dimension, nlist)
+    # Split vectors into sub-vectors of ~8 dimensions, each stored as one byte
+    sub_vectors = max(m for m in range(1, dimension // 8 + 1) if dimension % m == 0)
+    return faiss.IndexIVFPQ(quantizer, dimension, nlist, sub_vectors, 8)
+
+
+def build_index(index_type, embeddings, ids):
+    """Index of index_type holding embeddings[ids] under those ids, trained on a sample if needed."""
+    index = new_index(index_type, embeddings.shape[1], len(ids))
+    if not index.is_trained:
+        sample = np.random.default_rng(0).choice(ids, min(len(ids), TRAIN_SAMPLE), replace=False)
+        print(f"Training {index_type} index on {len(sample)} of {len(ids)} chunks...")
+        index.train(np.ascontiguousarray(embeddings[np.sort(sample)]))
+    for start in range(0, len(ids), 10000):
+        batch = ids[start:start + 10000]
+        index.add_with_ids(np.ascontiguousarray(embeddings[batch]), batch)
+    return index
+
+
+def parse_ranges(text):
+    """Page / chapter filter text as a list of (first, last) ranges, last = None for no upper bound.
+
+    "12" -> [(12, 12)], "10-40" -> [(10, 40)], "10-" -> [(10, None)],
+    "3,5,7-9" -> [(3, 3), (5, 5), (7, 9)], "" -> None. Raises ValueError for anything else.
+    """
+    if not text or not text.strip():
+        return None
+    ranges = []
+    for part in text.replace(" ", "").split(","):
+        match = RANGE.fullmatch(part)
+        if not match:
+            raise ValueError(f"{text.strip()!r} is not a number or range (e.g. 12, 10-40, 10- or 3,5,7-9)")
+        first, last = int(match.group(1)), match.group(2)
+        last = first if last is None else int(last) if last else None
+        ranges.append((first, last) if last is None or first <= last else (last, first))
+    return ranges
+
+
+def read_tags(documents_folder):
+    """Tags per file name from documents/tags.json ({} if there is none)."""
+    try:
+        with open(os.path.join(documents_folder, TAGS_FILE), "r", encoding="utf-8") as f:
+            return {name: list(tags) for name, tags in json.load(f).items()}
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def reciprocal_rank_fusion(rankings, k_constant=RRF_K):
+    """Fuse several best-first id lists. Returns (ids, scores), best first."""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[int(chunk_id)] = scores.get(int(chunk_id), 0.0) + 1.0 / (k_constant + rank + 1)
+    ids = sorted(scores, key=scores.get, reverse=True)
+    return ids, [scores[chunk_id] for chunk_id in ids]
+
+
+def set_search_params(index, nprobe, ef_search, k=1):
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap2) else index
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = nprobe
+    if isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = max(ef_search, k)
+
+
+class ReadWriteLock:
+    """Many readers or one writer. A waiting writer holds off new readers.
+
+    Nested reads in one thread are fine; writing while holding a read lock
+    raises RuntimeError (it would wait for itself forever).
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+        self.local = threading.local()   # Read depth of the current thread
+
+    @contextmanager
+    def read(self):
+        depth = getattr(self.local, "depth", 0)
+        if not depth:
+            with self.condition:
+                while self.writer or self.writers_waiting:
+                    self.condition.wait()
+                self.readers += 1
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+            if not depth:
+                with self.condition:
+                    self.readers -= 1
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        if getattr(self.local, "depth", 0):
+            raise RuntimeError("Can't take the write lock while holding the read lock")
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+class IndexStore:
+    """FAISS index + embeddings + chunk columns, saved in one folder and updated per file."""
+
+    def __init__(self, folder, settings, index_type="flat", nprobe=16, ef_search=64, lexical=False):
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+        self.folder = folder
+        self.settings = settings
+        self.index_type = index_type
+        self.nprobe = nprobe        # IVF: clusters searched per query
+        self.ef_search = ef_search  # HNSW: candidates kept per query
+        self.index = None
+        self.built_type = None      # Type of self.index (flat while there are too few chunks to train IVF)
+        self.trained_on = 0         # Chunks in the index when it was built
+        self.indexed_until = 0      # Chunk ids below this are in the index (or deleted)
+        self.index_stale = False    # HNSW had files removed and must be rebuilt
+        self.embeddings = None
+        self.files = {}        # filename -> {"size", "mtime_ns", "sha256", "file_id", "first_id", "count", "tags"}
+        self.file_names = []   # file_id -> filename (each name is stored once, chunks only keep the id)
+        self.file_ids = {}
+        self.next_id = 0
+        self.dimension = None
+        self.text_bytes = 0    # Valid length of chunks.txt (anything after it is left over from a crash)
+        self.columns = {}
+        self.text = None
+        self.loaded = False
+        self.lock = ReadWriteLock()   # Read: searches and chunk lookups; write: load, ingest, save
+        # BM25 keyword index in <folder>/lexical, searched next to FAISS by hybrid_search()
+        self.lexical = LexicalIndex(self.path("lexical")) if lexical else None
+        self.search_pool = ThreadPoolExecutor(max_workers=2) if lexical else None
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def chunk_count(self):
+        return sum(info["count"] for info in self.files.values())
+
+    # --------------------
+    # Looking up chunks
+    # --------------------
+    def column(self, name):
+        """Memory-mapped column for all chunk ids (deleted ones included)."""
+        if name not in self.columns:
+            dtype = np.dtype(COLUMNS[name])
+            if self.next_id:
+                self.columns[name] = np.memmap(self.path(column_file(name)), dtype=dtype, mode="r",
+                                               shape=(self.next_id,))
+            else:
+                self.columns[name] = np.zeros(0, dtype=dtype)
+        return self.columns[name]
+
+    def chunk_text(self, chunk_id):
+        if self.text is None:
+            self.text = (np.memmap(self.path(TEXT_FILE), dtype="uint8", mode="r", shape=(self.text_bytes,))
+                         if self.text_bytes else np.zeros(0, dtype="uint8"))
+        offset = int(self.column("text_offset")[chunk_id])
+        length = int(self.column("text_length")[chunk_id])
+        return self.text[offset:offset + length].tobytes().decode("utf-8")
+
+    def chunk(self, chunk_id):
+        """File name, start position, page, text and chapter of one chunk."""
+        file_name = self.file_names[self.column("file_id")[chunk_id]]
+        return Chunk(file_name, int(self.column("start")[chunk_id]), int(self.column("page")[chunk_id]),
+                     self.chunk_text(chunk_id), int(self.column("chapter")[chunk_id]))
+
+    def tag_names(self):
+        return sorted({tag for info in self.files.values() for tag in info.get("tags", [])})
+
+    def set_tags(self, tags):
+        """Replace the tags of every file ({filename: [tag, ...]}); saved with the manifest on save()."""
+        for filename, info in self.files.items():
+            info["tags"] = sorted(set(tags.get(filename, [])))
+
+    def filter_ids(self, files=None, tags=None, pages=None, chapters=None):
+        """Chunk ids matching all given filters, or None when no filter is given.
+
+        files: file names; tags: files with any of these tags; pages and
+        chapters: lists of (first, last) ranges (see parse_ranges()), both
+        ends included, last = None for no upper bound.
+        """
+        if not (files or tags or pages or chapters):
+            return None
+        ranges = [np.arange(info["first_id"], info["first_id"] + info["count"], dtype="int64")
+                  for filename, info in self.files.items()
+                  if info["count"] and (not files or filename in files)
+                  and (not tags or set(tags) & set(info.get("tags", [])))]
+        ids = np.concatenate(ranges) if ranges else np.zeros(0, dtype="int64")
+        for name, ranges in (("page", pages), ("chapter", chapters)):
+            if ranges and len(ids):
+                values = np.asarray(self.column(name)[ids])
+                keep = np.zeros(len(ids), dtype=bool)
+                for first, last in ranges:
+                    keep |= (values >= first) if last is None else (values >= first) & (values <= last)
+                ids = ids[keep]
+        return ids
+
+    def search(self, vectors, k, ids=None):
+        """index.search() with nprobe / ef_search applied. Returns (distances, ids).
+
+        ids: only search these chunk ids (from filter_ids()).
+        """
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        if ids is None:
+            set_search_params(self.index, self.nprobe, self.ef_search, k)
+            return self.index.search(vectors, k)
+        if len(ids) <= DIRECT_SEARCH_MAX:
+            return self._search_subset(vectors, k, ids)
+        return self.index.search(vectors, k, params=self._selector_params(ids, k))
+
+    def _search_subset(self, vectors, k, ids):
+        """Exact search over the embeddings of a few chunks, without the FAISS index."""
+        distances = np.full((len(vectors), k), np.inf, dtype="float32")
+        found = np.full((len(vectors), k), -1, dtype="int64")
+        if not len(ids):
+            return distances, found
+        if self.embeddings is None:
+            self._open_embeddings()
+        subset = np.asarray(self.embeddings[ids])
+        all_distances = ((vectors ** 2).sum(axis=1)[:, None] - 2 * vectors @ subset.T
+                         + (subset ** 2).sum(axis=1)[None, :])
+        top = np.argsort(all_distances, axis=1)[:, :k]
+        distances[:, :top.shape[1]] = np.take_along_axis(all_distances, top, axis=1)
+        found[:, :top.shape[1]] = ids[top]
+        return distances, found
+
+    def _selector_params(self, ids, k):
+        """FAISS search parameters that only visit ids, keeping nprobe / ef_search."""
+        selector = faiss.IDSelectorBatch(np.ascontiguousarray(ids, dtype="int64"))
+        inner = faiss.downcast_index(self.index.index) if isinstance(self.index, faiss.IndexIDMap2) else self.index
+        if isinstance(inner, faiss.IndexIVF):
+            return faiss.SearchParametersIVF(sel=selector, nprobe=self.nprobe)
+        if isinstance(inner, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(sel=selector, efSearch=max(self.ef_search, k))
+        return faiss.SearchParameters(sel=selector)
+
+    def hybrid_search(self, queries, vectors, k, prefilter=0, ids=None):
+        """Vector and BM25 keyword search for the same queries, fused with reciprocal rank fusion.
+
+        Both searches run at the same time. With prefilter > 0, a query whose
+        words all occur together in at most prefilter chunks skips the vector
+        index: only those chunks' embeddings are compared with it (the keyword
+        search then has to finish first). ids limits both searches to those
+        chunk ids. Returns (scores, ids) like search(), but the scores are
+        fusion scores (higher is better). Without a keyword index this is just
+        search().
+        """
+        if self.lexical is None or not self.lexical.segments:
+            return self.search(vectors, k, ids)
+        vectors = np.ascontiguousarray(vectors, dtype="float32")
+        depth = k * HYBRID_DEPTH
+        if ids is None:
+            allowed = self._live_mask()
+        else:
+            allowed = np.zeros(self.next_id, dtype=bool)
+            allowed[ids] = True
+        keyword = self.search_pool.submit(self.lexical.search_batch, list(queries), depth, allowed)
+
+        narrow = {}
+        if prefilter:
+            narrow = {i: result[2] for i, result in enumerate(keyword.result()) if 0 < len(result[2]) <= prefilter}
+        broad = [i for i in range(len(vectors)) if i not in narrow]
+
+        dense = {}
+        if broad:
+            _, found = self.search(vectors[broad], depth, ids)
+            for row, i in zip(found, broad):
+                dense[i] = row[row != -1]
+        if narrow and self.embeddings is None:
+            self._open_embeddings()
+        for i, candidates in narrow.items():
+            distances = ((self.embeddings[candidates] - vectors[i]) ** 2).sum(axis=1)
+            dense[i] = candidates[np.argsort(distances)[:depth]]
+
+        keyword_results = keyword.result()
+        scores = np.zeros((len(vectors), k), dtype="float32")
+        fused = np.full((len(vectors), k), -1, dtype="int64")
+        for i in range(len(vectors)):
+            fused_ids, fused_scores = reciprocal_rank_fusion([dense[i], keyword_results[i][0]])
+            fused[i, :len(fused_ids[:k])] = fused_ids[:k]
+            scores[i, :len(fused_scores[:k])] = fused_scores[:k]
+        return scores, fused
+
+    # --------------------
+    # Loading
+    # --------------------
+    def load(self):
+        """Open the saved index (once). Returns False if there is none or it used other settings."""
+        if self.loaded:
+            return bool(self.files)
+        self.loaded = True
+
+        try:
+            with open(self.path(MANIFEST_FILE), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if manifest.get("format") != FORMAT_VERSION or manifest.get("settings") != self.settings:
+            print("Index settings changed, the saved index will be rebuilt.")
+            if self.lexical is not None:
+                self.lexical.clear()
+            return False
+
+        try:
+            self.files = manifest["files"]
+            self.file_names = manifest["file_names"]
+            self.next_id = manifest["next_id"]
+            self.text_bytes = manifest["text_bytes"]
+            self.dimension = manifest["dimension"]
+            self._check_sizes()
+            self._open_embeddings()
+            self.index = faiss.read_index(self.path(INDEX_FILE)) if self.dimension else None
+            self.built_type = manifest.get("index_type", "flat")
+            self.trained_on = manifest.get("trained_on", 0)
+            self.indexed_until = self.next_id
+        except (OSError, KeyError, RuntimeError, ValueError) as e:
+            print(f"Saved index unreadable, rebuilding: {e}")
+            self._reset()
+            return False
+
+        # A crash between writing the index and the manifest leaves them out of sync
+        if self.index is not None and self.index.ntotal != self.chunk_count():
+            print("Saved index out of sync with manifest, rebuilding it from saved embeddings.")
+            self._rebuild_index()
+        elif self.index is not None and self.built_type != self._type_for(self.chunk_count()):
+            print(f"Index type changed to {self.index_type}, rebuilding it from saved embeddings.")
+            self._rebuild_index()
+
+        # The keyword index is missing (just switched on) or behind the manifest: catch up
+        if self.lexical is not None and (not self.lexical.load() or self.lexical.indexed_until != self.next_id):
+            print("Updating the keyword index...")
+            self._update_lexical()
+        return True
+
+    def _check_sizes(self):
+        # Longer files are fine (a crashed run appended rows after the last manifest); shorter ones are not
+        expected = {TEXT_FILE: self.text_bytes}
+        if self.dimension:
+            expected[EMBEDDINGS_FILE] = self.next_id * self.dimension * 4
+        for name, dtype in COLUMNS.items():
+            expected[column_file(name)] = self.next_id * np.dtype(dtype).itemsize
+        for name, size in expected.items():
+            if size and (not os.path.exists(self.path(name)) or os.path.getsize(self.path(name)) < size):
+                raise ValueError(f"{name} is shorter than the manifest")
+
+    def _reset(self):
+        self._close_maps()
+        self.index = None
+        self.built_type = None
+        self.trained_on = 0
+        self.indexed_until = 0
+        self.index_stale = False
+        self.files = {}
+        self.file_names = []
+        self.file_ids = {}
+        self.next_id = 0
+        self.dimension = None
+        self.text_bytes = 0
+        if self.lexical is not None:
+            self.lexical.clear()
+
+    def _close_maps(self):
+        # Windows can't resize or replace a file that is still memory-mapped
+        self.embeddings = None
+        self.columns = {}
+        self.text = None
+
+    def _open_embeddings(self):
+        if not self.next_id:
+            self.embeddings = np.zeros((0, self.dimension or 0), dtype="float32")
+            return
+        self.embeddings = np.memmap(self.path(EMBEDDINGS_FILE), dtype="float32", mode="r",
+                                    shape=(self.next_id, self.dimension))
+
+    def _live_ids(self):
+        ranges = [np.arange(info["first_id"], info["first_id"] + info["count"], dtype="int64")
+                  for info in self.files.values() if info["count"]]
+        return np.concatenate(ranges) if ranges else np.zeros(0, dtype="int64")
+
+    def _live_mask(self):
+        """True for every chunk id that belongs to a file still in the manifest."""
+        mask = np.zeros(self.next_id, dtype=bool)
+        for info in self.files.values():
+            mask[info["first_id"]:info["first_id"] + info["count"]] = True
+        return mask
+
+    def _update_lexical(self):
+        self.lexical.update(self._live_ids(), self.next_id, self.chunk_text)
+
+    def _type_for(self, count):
+        # IVF needs enough chunks to train on; until then a flat index is used
+        if self.index_type in TRAINED_TYPES and count < MIN_TRAIN_CHUNKS:
+            return "flat"
+        return self.index_type
+
+    def _rebuild_index(self):
+        ids = self._live_ids()
+        index_type = self._type_for(len(ids))
+        if index_type != self.index_type:
+            print(f"Only {len(ids)} chunks, using a flat index until there are {MIN_TRAIN_CHUNKS} to train {self.index_type}.")
+        self.index = build_index(index_type, self.embeddings, ids)
+        self.built_type = index_type
+        self.trained_on = len(ids)
+        self.indexed_until = self.next_id
+        self.index_stale = False
+
+    def _update_index(self):
+        """Add chunks ingested since the last update, or rebuild the index if that is not enough."""
+        self._open_embeddings()
+        count = self.chunk_count()
+        if (self.index is None or self.index_stale or self.built_type != self._type_for(count)
+                or (self.built_type in TRAINED_TYPES and count > self.trained_on * RETRAIN_GROWTH)):
+            self._rebuild_index()
+            return
+        ids = self._live_ids()
+        ids = ids[ids >= self.indexed_until]
+        for start in range(0, len(ids), 10000):
+            batch = ids[start:start + 10000]
+            self.index.add_with_ids(np.ascontiguousarray(self.embeddings[batch]), batch)
+        self.indexed_until = self.next_id
+
+    # --------------------
+    # Finding what changed
+    # --------------------
+    def scan(self, documents_folder):
+        """Compare the folder with the manifest. Returns (changed, deleted).
+
+        changed is a list of (filename, file_info) for new or modified files,
+        deleted a list of filenames that are gone. The sha256 is only computed
+        when size or mtime differ, so an unchanged folder costs one stat per file.
+        """
+        changed = []
+        seen = set()
+        for filename in sorted(os.listdir(documents_folder)):
+            if not filename.endswith(SUPPORTED_FILES):
+                continue
+            path = os.path.join(documents_folder, filename)
+            stat = os.stat(path)
+            seen.add(filename)
+
+            known = self.files.get(filename)
+            if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+                continue
+
+            sha256 = file_sha256(path)
+            if known and known["sha256"] == sha256:
+                # Touched but not modified: remember the new mtime and move on
+                known["mtime_ns"] = stat.st_mtime_ns
+                continue
+            changed.append((filename, {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}))
+
+        deleted = [filename for filename in self.files if filename not in seen]
+        return changed, deleted
+
+    # --------------------
+    # Updating
+    # --------------------
+    def remove_files(self, filenames):
+        """Drop the vectors of deleted (or about to be re-added) files."""
+        ids = []
+        for filename in filenames:
+            info = self.files.pop(filename, None)
+            if info and info["count"]:
+                ids.append(np.arange(info["first_id"], info["first_id"] + info["count"], dtype="int64"))
+        if ids and self.index is not None:
+            if self.built_type == "hnsw":
+                self.index_stale = True  # HNSW graphs can't delete vectors, the index is rebuilt on save
+            else:
+                self.index.remove_ids(np.concatenate(ids))
+
+    def file_id(self, filename):
+        if len(self.file_ids) != len(self.file_names):
+            self.file_ids = {name: i for i, name in enumerate(self.file_names)}
+        if filename not in self.file_ids:
+            self.file_ids[filename] = len(self.file_names)
+            self.file_names.append(filename)
+        return self.file_ids[filename]
+
+    def ingest(self, documents, encode, batch_size=EMBED_BATCH_SIZE):
+        """Embed and add chunks as they are produced.
+
+        documents yields (filename, file_info, chunks) where chunks is an
+        iterable of dicts with "start" and "chunk_text" (and optionally "page"
+        "byte_start" and "chapter", as made by chunker.Chunker). Chunks are embedded
+        with encode(texts) batch_size at a time, across file boundaries.
+        Files without text are recorded too, so they aren't re-read every
+        time. New chunks become searchable on save(), where the FAISS index
+        is updated (or retrained) in one go. Returns the number of chunks added.
+        """
+        batch = []
+        added = 0
+        for filename, file_info, chunks in documents:
+            file_id = self.file_id(filename)
+            # A file's chunks get consecutive ids, starting after whatever is still waiting in the batch
+            info = dict(file_info, file_id=file_id, first_id=self.next_id + len(batch), count=0)
+            self.files[filename] = info
+            for item in chunks:
+                batch.append((file_id, item))
+                info["count"] += 1
+                if len(batch) == batch_size:
+                    added += self._add_batch(batch, encode)
+                    batch = []
+                    print(f"Embedded {added} new chunks...")
+        if batch:
+            added += self._add_batch(batch, encode)
+        return added
+
+    def _add_batch(self, batch, encode):
+        texts = [item["chunk_text"] for _, item in batch]
+        embeddings = np.ascontiguousarray(encode(texts), dtype="float32")
+        if self.dimension is None:
+            self.dimension = embeddings.shape[1]
+
+        encoded = [text.encode("utf-8") for text in texts]
+        lengths = np.array([len(data) for data in encoded], dtype="int64")
+        values = {
+            "file_id": [file_id for file_id, _ in batch],
+            "start": [item["start"] for _, item in batch],
+            "page": [item.get("page", 0) for _, item in batch],
+            "byte_start": [item.get("byte_start", item["start"]) for _, item in batch],
+            "chapter": [item.get("chapter", 0) for _, item in batch],
+            "text_offset": self.text_bytes + np.cumsum(lengths) - lengths,
+            "text_length": lengths,
+        }
+
+        os.makedirs(self.folder, exist_ok=True)
+        self._close_maps()
+        self._append_bytes(EMBEDDINGS_FILE, self.next_id * self.dimension * 4, embeddings.tobytes())
+        self._append_bytes(TEXT_FILE, self.text_bytes, b"".join(encoded))
+        for name, dtype in COLUMNS.items():
+            column = np.asarray(values[name], dtype=dtype)
+            self._append_bytes(column_file(name), self.next_id * column.itemsize, column.tobytes())
+
+        self.text_bytes += int(lengths.sum())
+        self.next_id += len(batch)
+        return len(batch)
+
+    def _append_bytes(self, name, valid_bytes, data):
+        mode = "r+b" if os.path.exists(self.path(name)) else "wb"
+        with open(self.path(name), mode) as f:
+            # Cut off anything a crashed run appended after the last saved manifest
+            if os.fstat(f.fileno()).st_size > valid_bytes:
+                f.truncate(valid_bytes)
+            f.seek(valid_bytes)
+            f.write(data)
+
+    def save(self):
+        """Write the index, then the manifest (the manifest is what marks the saved state as valid)."""
+        os.makedirs(self.folder, exist_ok=True)
+        if self.next_id and self.chunk_count() < self.next_id * COMPACT_RATIO:
+            self._compact()
+            if self.lexical is not None:
+                self.lexical.clear()  # Chunk ids were renumbered
+        elif self.dimension:
+            self._update_index()
+        if self.lexical is not None:
+            self._update_lexical()
+
+        if self.index is not None:
+            faiss.write_index(self.index, self.path(INDEX_FILE + ".tmp"))
+            os.replace(self.path(INDEX_FILE + ".tmp"), self.path(INDEX_FILE))
+
+        manifest = {
+            "format": FORMAT_VERSION,
+            "settings": self.settings,
+            "dimension": self.dimension,
+            "index_type": self.built_type,
+            "trained_on": self.trained_on,
+            "next_id": self.next_id,
+            "text_bytes": self.text_bytes,
+            "file_names": self.file_names,
+            "files": self.files,
+        }
+        with open(self.path(MANIFEST_FILE + ".tmp"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(self.path(MANIFEST_FILE + ".tmp"), self.path(MANIFEST_FILE))
+
+        self.loaded = True
+        if self.dimension:
+            self._open_embeddings()
+
+    def _compact(self):
+        """Rewrite embeddings, text and columns without the rows of deleted files, renumbering chunk ids."""
+        print("Compacting index (removing deleted chunks)...")
+        self._open_embeddings()
+        ids = self._live_ids()
+        columns = {name: np.asarray(self.column(name))[ids] for name in COLUMNS}
+        offsets, lengths = columns["text_offset"], columns["text_length"].astype("int64")
+        columns["text_offset"] = np.cumsum(lengths) - lengths
+
+        with open(self.path(EMBEDDINGS_FILE + ".tmp"), "wb") as f:
+            for start in range(0, len(ids), 10000):
+                f.write(np.ascontiguousarray(self.embeddings[ids[start:start + 10000]]).tobytes())
+        with open(self.path(TEXT_FILE), "rb") as src, open(self.path(TEXT_FILE + ".tmp"), "wb") as dst:
+            for offset, length in zip(offsets, lengths):
+                src.seek(int(offset))
+                dst.write(src.read(int(length)))
+        for name, values in columns.items():
+            values.astype(COLUMNS[name]).tofile(self.path(column_file(name) + ".tmp"))
+
+        self._close_maps()
+        for name in [EMBEDDINGS_FILE, TEXT_FILE] + [column_file(name) for name in COLUMNS]:
+            os.replace(self.path(name + ".tmp"), self.path(name))
+
+        new_id = 0
+        for info in self.files.values():
+            info["first_id"] = new_id
+            new_id += info["count"]
+        self.next_id = new_id
+        self.text_bytes = int(lengths.sum())
+        self._open_embeddings()
+        self._rebuild_index()
+
+
+# ====================
+# Recall vs. latency
+# ====================
+def recall_report(store, index_type, k=10, queries=200, values=None):
+    """Recall@k and ms per query of index_type against exact search on a loaded store.
+
+    The queries are stored chunk vectors picked at random, so no model is
+    needed (each one finds itself, so recall is a little optimistic).
+    values are the nprobe (IVF) or ef_search (HNSW) settings to try.
+    Returns a list of rows: {"index", "setting", "recall", "ms_per_query"}.
+    """
+    ids = store._live_ids()
+    if index_type in TRAINED_TYPES and len(ids) < MIN_TRAIN_CHUNKS:
+        raise ValueError(f"{index_type} needs at least {MIN_TRAIN_CHUNKS} chunks, the index has {len(ids)}")
+    store._open_embeddings()
+    picked = np.random.default_rng(1).choice(ids, min(queries, len(ids)), replace=False)
+    query_vectors = np.ascontiguousarray(store.embeddings[np.sort(picked)])
+    k = min(k, len(ids))
+
+    def measure(index, name, setting):
+        started = time.perf_counter()
+        _, found = index.search(query_vectors, k)
+        ms = (time.perf_counter() - started) * 1000 / len(query_vectors)
+        return found, {"index": name, "setting": setting, "ms_per_query": round(ms, 3)}
+
+    exact, row = measure(build_index("flat", store.embeddings, ids), "flat", "-")
+    rows = [dict(row, recall=1.0)]
+    if index_type == "flat":
+        return rows
+
+    index = build_index(index_type, store.embeddings, ids)
+    if values is None:
+        values = [16, 32, 64, 128, 256] if index_type == "hnsw" else [1, 4, 16, 64, 256]
+    for value in values:
+        if index_type == "hnsw":
+            set_search_params(index, 0, value, k)
+            setting = f"ef_search={value}"
+        else:
+            set_search_params(index, value, 0)
+            setting = f"nprobe={value}"
+        found, row = measure(index, index_type, setting)
+        hits = sum(len(set(a) & set(b)) for a, b in zip(found.tolist(), exact.tolist()))
+        rows.append(dict(row, recall=round(hits / (k * len(query_vectors)), 3)))
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Compare ANN index types with exact search on a saved index.")
+    parser.add_argument("folder", nargs="?", default="index", help="index folder (default: index)")
+    parser.add_argument("--type", choices=INDEX_TYPES[1:], action="append", help="index type to test (repeatable)")
+    parser.add_argument("-k", type=int, default=10, help="results per query (default: 10)")
+    parser.add_argument("--queries", type=int, default=200, help="number of test queries (default: 200)")
+    args = parser.parse_args()
+
+    with open(os.path.join(args.folder, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    store = IndexStore(args.folder, manifest["settings"], manifest.get("index_type") or "flat")
+    if not store.load():
+        raise SystemExit(f"No usable index in {args.folder}")
+
+    print(f"{store.chunk_count()} chunks, recall@{args.k} against exact search:")
+    print(f"{'index':<10} {'setting':<15} {'recall':>7} {'ms/query':>9}")
+    shown = set()
+    for index_type in args.type or INDEX_TYPES[1:]:
+        try:
+            rows = recall_report(store, index_type, args.k, args.queries)
+        except ValueError as e:
+            print(f"{index_type:<10} skipped: {e}")
+            continue
+        for row in rows:
+            if (row["index"], row["setting"]) in shown:
+                continue  # The flat baseline is part of every report, print it once
+            shown.add((row["index"], row["setting"]))
+            print(f"{row['index']:<10} {row['setting']:<15} {row['recall']:>7.3f} {row['ms_per_query']:>9.3f}")
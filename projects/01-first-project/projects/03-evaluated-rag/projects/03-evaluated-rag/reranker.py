@@ -0,0 +1,104 @@
+"""Rerank retrieved chunks with a cross-encoder before they reach the LLM.
+
+The first-stage search ranks chunks by embedding distance (and BM25), which
+is fast but coarse: the top 3 often contains a chunk that only looks related.
+A cross-encoder reads the question and a chunk together and scores how well
+the chunk answers it, which is much more precise but far slower, so it only
+sees a small candidate pool from the first stage:
+- all (question, chunk) pairs of a batch of questions go through the model in
+  one predict() call
+- scores are cached per (question, chunk id), so a repeated question or an
+  evaluation re-run only scores chunks it has not seen
+- the time spent retrieving and reranking is added up per stage, to tune the
+  pool size (more candidates = better recall, slower on CPU)
+Call clear() when the index changes: chunk ids may then point at other text.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from sentence_transformers import CrossEncoder
+
+
+class Reranker:
+    """Cross-encoder rerank stage with a (question, chunk id) score cache."""
+
+    def __init__(self, model_name="cross-encoder/ms-marco-MiniLM-L-6-v2", batch_size=64, cache_items=50000):
+        self.model = CrossEncoder(model_name)
+        self.batch_size = batch_size
+        self.cache_items = cache_items
+        self.scores = OrderedDict()   # (question, chunk id) -> score, least recently used first
+        self.lock = threading.Lock()
+        self.questions = 0
+        self.pairs = 0
+        self.cached_pairs = 0
+        self.seconds = {"retrieve": 0.0, "rerank": 0.0}
+
+    def rerank(self, questions, candidates, text_of, k):
+        """Best k candidates of every question by cross-encoder score.
+
+        candidates: chunk ids per question (a row of a FAISS result, -1 = none);
+        text_of(chunk_id) returns a chunk's text. Returns (scores, ids) of shape
+        (len(questions), k), best first and padded with -1 like a FAISS search.
+        """
+        started = time.perf_counter()
+        rows = [[int(i) for i in row if i != -1] for row in candidates]
+        keys = [(question, chunk_id) for question, row in zip(questions, rows) for chunk_id in row]
+
+        with self.lock:
+            known = {key: self.scores[key] for key in keys if key in self.scores}
+            for key in known:
+                self.scores.move_to_end(key)
+        # Pairs of the same chunk for two identical questions are scored once
+        missing = list(dict.fromkeys(key for key in keys if key not in known))
+        if missing:
+            predicted = self.model.predict([(question, text_of(chunk_id)) for question, chunk_id in missing],
+                                           batch_size=self.batch_size, show_progress_bar=False)
+            new = dict(zip(missing, np.asarray(predicted, dtype="float32").ravel().tolist()))
+            known.update(new)
+            with self.lock:
+                self.scores.update(new)
+                while len(self.scores) > self.cache_items:
+                    self.scores.popitem(last=False)
+
+        scores = np.full((len(questions), k), -np.inf, dtype="float32")
+        ids = np.full((len(questions), k), -1, dtype="int64")
+        for i, (question, row) in enumerate(zip(questions, rows)):
+            row_scores = np.array([known[(question, chunk_id)] for chunk_id in row], dtype="float32")
+            top = np.argsort(-row_scores, kind="stable")[:k]
+            scores[i, :len(top)] = row_scores[top]
+            ids[i, :len(top)] = np.array(row, dtype="int64")[top]
+
+        with self.lock:
+            self.questions += len(questions)
+            self.pairs += len(keys)
+            self.cached_pairs += len(keys) - len(missing)
+            self.seconds["rerank"] += time.perf_counter() - started
+        return scores, ids
+
+    def add_time(self, stage, seconds):
+        """Count time spent in another stage (e.g. "retrieve") next to the rerank time."""
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def clear(self):
+        """Forget every score (call after the index changed)."""
+        with self.lock:
+            self.scores.clear()
+
+    def stats(self):
+        per_question = max(self.questions, 1)
+        return {
+            "questions": self.questions,
+            "pairs": self.pairs,
+            "cached_pairs": self.cached_pairs,
+            "cache_rate": round(self.cached_pairs / self.pairs, 3) if self.pairs else 0.0,
+            **{f"{stage}_ms": round(seconds * 1000 / per_question, 1) for stage, seconds in self.seconds.items()},
+        }
+
+    def summary(self):
+        s = self.stats()
+        stages = ", ".join(f"{stage} {s[f'{stage}_ms']} ms" for stage in self.seconds)
+        return (f"Reranker: {stages} per question over {s['questions']} questions, "
+                f"{s['cached_pairs']} of {s['pairs']} pairs from cache ({s['cache_rate']:.0%})")
@@ -0,0 +1,119 @@
+"""Reuse answers to questions that were already asked.
+
+People ask the same few questions in slightly different words. An answer is
+stored with the question's embedding and the ids of the chunks it was
+generated from, plus a hash of the conversation before the question when
+the prompt includes one. A new question gets the stored answer when its
+embedding is at least `threshold` cosine-similar to a stored one AND
+retrieval returned exactly the same chunks after the same earlier turns, so
+the model would have seen the same prompt. A follow-up like "tell me more"
+therefore never gets an answer written for another conversation.
+Entries expire after `ttl` seconds, the least recently used go first when
+the cache is full, and clear() drops everything when the index changes.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ResponseCache:
+    """In-memory answer cache keyed on (question embedding, retrieved chunk ids, earlier conversation)."""
+
+    def __init__(self, threshold=0.95, ttl=24 * 3600, max_items=1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_items = max_items
+        self.entries = OrderedDict()   # entry id -> {"context", "vector", "answer", "created", "seconds"}
+        self.by_context = {}           # (conversation hash, chunk ids) -> set of entry ids
+        self.next_entry = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.seconds_saved = 0.0
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype="float32").ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _context(chunk_ids, conversation):
+        digest = hashlib.sha256(conversation.encode("utf-8")).hexdigest() if conversation else ""
+        return digest, tuple(int(i) for i in chunk_ids)
+
+    def lookup(self, query_vector, chunk_ids, conversation=""):
+        """Stored answer for a near-identical question over the same chunks and earlier turns, or None.
+
+        conversation: the history text the answer prompt includes ("" for single questions).
+        """
+        context = self._context(chunk_ids, conversation)
+        query = self._unit(query_vector)
+        now = time.time()
+        with self.lock:
+            best, best_similarity = None, self.threshold
+            for entry_id in list(self.by_context.get(context, ())):
+                entry = self.entries[entry_id]
+                if now - entry["created"] > self.ttl:
+                    self._drop(entry_id)
+                    continue
+                similarity = float(entry["vector"] @ query)
+                if similarity >= best_similarity:
+                    best, best_similarity = entry_id, similarity
+
+            if best is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(best)
+            entry = self.entries[best]
+            self.hits += 1
+            self.seconds_saved += entry["seconds"]
+            return entry["answer"]
+
+    def store(self, query_vector, chunk_ids, answer, seconds, conversation=""):
+        """Remember an answer; seconds is how long it took to generate (counted as saved on each hit)."""
+        context = self._context(chunk_ids, conversation)
+        with self.lock:
+            entry_id = self.next_entry
+            self.next_entry += 1
+            self.entries[entry_id] = {
+                "context": context,
+                "vector": self._unit(query_vector),
+                "answer": answer,
+                "created": time.time(),
+                "seconds": seconds,
+            }
+            self.by_context.setdefault(context, set()).add(entry_id)
+            while len(self.entries) > self.max_items:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, entry_id):
+        entry = self.entries.pop(entry_id)
+        ids = self.by_context[entry["context"]]
+        ids.discard(entry_id)
+        if not ids:
+            del self.by_context[entry["context"]]
+
+    def clear(self):
+        """Forget every answer (call after the index changed: chunk ids may now mean other text)."""
+        with self.lock:
+            self.entries.clear()
+            self.by_context.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "seconds_saved": round(self.seconds_saved, 1),
+            "items": len(self.entries),
+        }
+
+    def summary(self):
+        s = self.stats()
+        return (f"Response cache: {s['hits']} of {s['hits'] + s['misses']} questions answered from cache "
+                f"({s['hit_rate']:.0%}), {s['seconds_saved']}s of generation saved")
@@ -0,0 +1,97 @@
+"""Regression tests for app.py that run without Gradio, models or Ollama.
+
+The UI module and the embedding / cross-encoder models are replaced by
+fakes; everything else (index store, locks, caches, evaluation) is the real
+code, run in an empty temporary folder.
+
+    python -m pytest test_app.py
+"""
+import importlib.util
+import os
+import sys
+import threading
+import types
+from unittest import mock
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class FakeEmbedder:
+    tokenizer = None   # Chunker falls back to counting words
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def encode(self, texts, **kwargs):
+        return np.ones((len(texts), 8), dtype="float32")
+
+
+class FakeCrossEncoder:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def predict(self, pairs, **kwargs):
+        return np.zeros(len(pairs), dtype="float32")
+
+
+def load_app():
+    """Import app.py with a fake UI and fake models (in the current directory, where it keeps its files)."""
+    fakes = {
+        "gradio": mock.MagicMock(),
+        "sentence_transformers": types.SimpleNamespace(SentenceTransformer=FakeEmbedder,
+                                                       CrossEncoder=FakeCrossEncoder),
+    }
+    saved = {name: sys.modules.get(name) for name in fakes}
+    sys.modules.update(fakes)
+    sys.path.insert(0, HERE)
+    try:
+        spec = importlib.util.spec_from_file_location("app_under_test", os.path.join(HERE, "app.py"))
+        app = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(app)
+    finally:
+        sys.path.remove(HERE)
+        for name, module in saved.items():
+            if module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = module
+        # The project's own modules (index_store, ...) are imported again by the next project's tests
+        for name, module in list(sys.modules.items()):
+            if name != __name__ and os.path.dirname(os.path.abspath(getattr(module, "__file__", None) or "")) == HERE:
+                del sys.modules[name]
+    return app
+
+
+def finishes(function, seconds=30):
+    """function()'s result, failing the test if it takes longer than seconds (e.g. a deadlock)."""
+    outcome = {}
+
+    def run():
+        try:
+            outcome["result"] = function()
+        except Exception as e:
+            outcome["error"] = e
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(seconds)
+    assert not thread.is_alive(), f"{function.__name__}() did not finish within {seconds}s"
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
+
+
+def test_evaluation_without_saved_index(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "documents").mkdir()
+    (tmp_path / "test_set.csv").write_text("question,expected_behavior,category\n"
+                                           "What is RAG?,Explains retrieval,basics\n", encoding="utf-8")
+    app = load_app()
+
+    # Used to take the write lock inside its own read lock and hang forever
+    assert finishes(app.run_evaluation) == (None, "Please load documents first.")
+    # ... and to leave a waiting writer behind that blocked every later load and search
+    assert finishes(app.load_documents).startswith("No documents loaded")
+    assert finishes(lambda: app.search_batch(["What is RAG?"]))[0][2] == []
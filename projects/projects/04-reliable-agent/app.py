@@ -1,93 +1,198 @@
 import gradio as gr
 from sentence_transformers import SentenceTransformer
-import faiss
 import numpy as np
-from pypdf import PdfReader
 import os
-import ollama
 import pandas as pd
 from datetime import datetime
 import numexpr
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from index_store import IndexStore, parse_ranges, read_tags
+from embedding_cache import EmbeddingCache
+from extraction import extract_documents
+from chunker import Chunker
+from eval_runner import run_evaluation_rows
+from eval_cache import EvalCache, prompt_hash
+from streaming import stream_generate
+from llm_client import LLMClient
+from response_cache import ResponseCache
+from reranker import Reranker
+from session_memory import SessionMemory
+from intent_router import IntentRouter
 
 # ====================
 # CONFIGURATION
 # ====================
 EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
 DOCUMENTS_FOLDER = "documents"
-CHUNK_SIZE = 500
-CHUNK_OVERLAP = 100
+CHUNK_TOKENS = 200      # Max embedding-model tokens per chunk (all-MiniLM-L6-v2 reads 256)
+CHUNK_OVERLAP_TOKENS = 30  # Whole sentences repeated from the previous chunk, up to this many tokens
 TOP_K = 3
-MAX_HISTORY = 5
+HISTORY_TOKENS = 600    # History kept word for word in prompts; older turns are summarized
+MAX_SESSIONS = 500      # Conversations kept in memory (idle ones are dropped after SESSION_TIMEOUT)
+SESSION_TIMEOUT = 3600  # Seconds after which an idle conversation is forgotten
+ROUTER_TOOL_ABOVE = 0.6     # Similarity to a tool's examples at which it is used without asking the LLM
+ROUTER_NO_TOOL_BELOW = 0.35  # Similarity to every tool below which no tool is used; in between the LLM decides
+AGENT_WORKERS = 16      # Threads for tool decisions running next to retrieval (one per question in flight)
+TOOL_WORKERS = 32       # Threads for the tool calls themselves (a tool stuck past its timeout keeps one)
+TOOLS_TIMEOUT = 60      # Seconds an answer waits for the tool decision and tools before going without them
+EMBED_BATCH_SIZE = 256  # Chunks embedded per batch while loading
 LLM_MODEL = 'phi3.5'  # Better tool following & reasoning
+INDEX_FOLDER = "index"  # Saved index, only changed files get re-embedded
+INDEX_TYPE = "flat"     # "flat" (exact), "ivf_flat", "ivf_pq" or "hnsw" for big collections
+NPROBE = 16             # IVF: clusters searched per question (higher = better recall, slower)
+EF_SEARCH = 64          # HNSW: candidates kept per question (higher = better recall, slower)
+HYBRID_SEARCH = True    # BM25 keyword search next to vector search (finds exact terms like "Chapter 11")
+LEXICAL_PREFILTER = 0   # Queries whose words occur together in at most this many chunks skip FAISS (0 = off)
+EVAL_CONCURRENCY = 4    # LLM calls in flight during evaluation (set OLLAMA_NUM_PARALLEL to match)
+EVAL_CHECKPOINT = "evaluation_checkpoint.jsonl"  # Finished questions, so an interrupted run can resume
+EMBEDDING_CACHE = "cache/embeddings.sqlite"  # Every vector computed so far, keyed by text
+EVAL_CACHE = "cache/eval_results.sqlite"  # Earlier evaluation results, reused while their inputs are unchanged
+LLM_MAX_IN_FLIGHT = 4   # Requests sent to Ollama at once (set OLLAMA_NUM_PARALLEL to match)
+UI_CONCURRENCY = 16     # Questions Gradio handles at once; their LLM calls queue in llm_client
+LLM_QUEUE_TIMEOUT = 120 * UI_CONCURRENCY // LLM_MAX_IN_FLIGHT  # Seconds a request may wait for a slot: 2 min per round of requests ahead
+RESPONSE_CACHE_THRESHOLD = 0.95  # Cosine similarity at which two chat questions count as the same
+RESPONSE_CACHE_TTL = 24 * 3600   # Seconds a cached chat answer stays valid
+RESPONSE_CACHE_ITEMS = 1000      # Chat answers kept in memory (least recently used are dropped)
+RERANK = True           # Rerank a larger candidate pool with a cross-encoder before answering
+RERANK_MODEL = 'cross-encoder/ms-marco-MiniLM-L-6-v2'
+RERANK_POOL = 20        # Candidates retrieved per question for the reranker (more = better recall, slower)
 
 # Load embedding model
 embedder = SentenceTransformer(EMBEDDING_MODEL)
+embedding_cache = EmbeddingCache(embedder, EMBEDDING_MODEL, EMBEDDING_CACHE)
+# Chunks follow headings, paragraphs and sentences and are sized with the embedder's own tokenizer
+chunker = Chunker(embedder.tokenizer, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+eval_cache = EvalCache(EVAL_CACHE)
 
-# Global vector store
-index = None
-chunks = []
-metadata = []
-
-# Conversation history
-history = []
-
-def load_documents():
-    global index, chunks, metadata
-    chunks = []
-    metadata = []
-
-    for filename in os.listdir(DOCUMENTS_FOLDER):
-        path = os.path.join(DOCUMENTS_FOLDER, filename)
-        text = ""
-
-        if filename.endswith(".pdf"):
-            reader = PdfReader(path)
-            for page in reader.pages:
-                text += page.extract_text() or ""
-        elif filename.endswith((".txt", ".md")):
-            with open(path, "r", encoding="utf-8") as f:
-                text = f.read()
-
-        if not text.strip():
-            continue
-
-        for i in range(0, len(text), CHUNK_SIZE - CHUNK_OVERLAP):
-            chunk = text[i:i + CHUNK_SIZE]
-            chunks.append(chunk)
-            metadata.append({"file": filename, "start": i, "chunk_text": chunk})
-
-    if not chunks:
-        return "No documents loaded."
+# One shared connection pool to Ollama for chat users and the evaluation
+llm = LLMClient(max_in_flight=LLM_MAX_IN_FLIGHT, queue_timeout=LLM_QUEUE_TIMEOUT)
 
-    embeddings = embedder.encode(chunks, show_progress_bar=True)
-    embeddings = np.array(embeddings).astype('float32')
+# Chat answers to questions asked before (same meaning, same retrieved chunks)
+response_cache = ResponseCache(RESPONSE_CACHE_THRESHOLD, RESPONSE_CACHE_TTL, RESPONSE_CACHE_ITEMS)
 
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension)
-    index.add(embeddings)
+# Second stage: a cross-encoder picks the TOP_K best of RERANK_POOL candidates
+reranker = Reranker(RERANK_MODEL) if RERANK else None
 
-    return f"Loaded {len(chunks)} chunks."
+# Global vector store
+index = None
+store = IndexStore(INDEX_FOLDER, {"model": EMBEDDING_MODEL, "chunk_tokens": CHUNK_TOKENS,
+                                   "chunk_overlap_tokens": CHUNK_OVERLAP_TOKENS},
+                   INDEX_TYPE, NPROBE, EF_SEARCH, lexical=HYBRID_SEARCH)
+
+# Conversation history, one per browser session
+sessions = SessionMemory(HISTORY_TOKENS, MAX_SESSIONS, SESSION_TIMEOUT)
+
+def load_saved_index():
+    """Open the index saved by an earlier run (without checking for changed files)."""
+    global index
+    with store.lock.write():
+        store.load()
+        index = store.index
+    return index is not None
+
+def read_documents(changed):
+    # PDFs are parsed in parallel worker processes; a bad file is skipped
+    paths = [os.path.join(DOCUMENTS_FOLDER, filename) for filename, _ in changed]
+    for (filename, file_info), (path, pages, error) in zip(changed, extract_documents(paths)):
+        if error:
+            print(f"Skipping {filename}: {error}")
+            continue
+        yield filename, file_info, chunker.chunk_pages(pages)
 
-def search(question):
+def load_documents():
+    global index
+    # Searches wait until the store is consistent again (chunk ids may be renumbered on save)
+    with store.lock.write():
+        store.load()
+
+        # Only new or modified files are read and embedded again
+        changed, deleted = store.scan(DOCUMENTS_FOLDER)
+        store.remove_files(deleted + [filename for filename, _ in changed])
+
+        # Streamed: read -> chunk -> embed in batches -> add to index
+        store.ingest(read_documents(changed), embedding_cache.encode, EMBED_BATCH_SIZE)
+
+        # Tags from documents/tags.json, for filtering sources
+        store.set_tags(read_tags(DOCUMENTS_FOLDER))
+        store.save()
+        index = store.index
+
+        # Chunk ids now point at other text (or nowhere): cached answers are stale
+        if changed or deleted:
+            response_cache.clear()
+            if reranker is not None:
+                reranker.clear()
+
+        if index is None or not store.chunk_count():
+            return "No documents loaded."
+
+        return (f"Loaded {store.chunk_count()} chunks ({len(changed)} new or changed files, {len(deleted)} removed). "
+                f"{embedding_cache.summary()}. {response_cache.summary()}. {router.summary()}"
+                + (f". {reranker.summary()}" if reranker is not None else ""))
+
+def source_filters(files=None, tags=None, pages="", chapters=""):
+    """Filter settings from the UI as keyword arguments for store.filter_ids() (ValueError for bad ranges)."""
+    return {"files": files or None, "tags": tags or None,
+            "pages": parse_ranges(pages), "chapters": parse_ranges(chapters)}
+
+def source_choices():
+    """Refresh the file and tag lists of the source filter."""
     if index is None:
-        return "", ""
-
-    q_embedding = embedder.encode([question])[0].astype('float32')
-    distances, indices = index.search(np.array([q_embedding]), TOP_K)
+        load_saved_index()
+    with store.lock.read():
+        return gr.update(choices=sorted(store.files)), gr.update(choices=store.tag_names())
+
+def search_batch(questions, k=TOP_K, filters=None):
+    """Retrieve for many questions at once: one embedding pass and one index search.
+
+    Returns (context, sources, chunk_ids) per question, in the same order.
+    filters: keyword arguments for store.filter_ids() (see source_filters()), applied to every question.
+    """
+    if index is None and not load_saved_index():
+        return [("", "", [])] * len(questions)
+
+    # Any number of searches at a time; loading documents waits for them (and they for it)
+    with store.lock.read():
+        if store.index is None:   # Never load in here: a read lock can't become a write lock
+            return [("", "", [])] * len(questions)
+
+        # Only chunks of the chosen files / tags / pages / chapters are searched
+        ids = store.filter_ids(**filters) if filters else None
+        if ids is not None and not len(ids):
+            return [("", "", [])] * len(questions)
+
+        started = time.perf_counter()
+        q_embeddings = embedding_cache.encode(list(questions))
+        # Vector and keyword search at the same time, fused by reciprocal rank
+        pool = max(k, RERANK_POOL) if reranker is not None else k
+        scores, indices = store.hybrid_search(questions, np.asarray(q_embeddings), pool, LEXICAL_PREFILTER, ids)
+
+        # Cross-encoder scores all question / candidate pairs in one batch and keeps the best k
+        if reranker is not None:
+            reranker.add_time("retrieve", time.perf_counter() - started)
+            scores, indices = reranker.rerank(questions, indices, store.chunk_text, k)
+
+        results = []
+        for row in indices:
+            retrieved_chunks = []
+            retrieved_display = []
+            for idx in row:
+                if idx == -1:
+                    continue
+                chunk_info = store.chunk(idx)
+                retrieved_chunks.append(chunk_info.text)
+                chapter = f", chapter {chunk_info.chapter}" if chunk_info.chapter else ""
+                display_text = f"**From {chunk_info.file}** (page {chunk_info.page}{chapter}):\n{chunk_info.text[:300]}..."
+                retrieved_display.append(display_text)
+            results.append(("\n\n".join(retrieved_chunks), "\n\n---\n\n".join(retrieved_display),
+                            [int(idx) for idx in row if idx != -1]))
+        return results
 
-    retrieved_chunks = []
-    retrieved_display = []
-
-    for idx, dist in zip(indices[0], distances[0]):
-        if idx == -1:
-            continue
-        chunk_info = metadata[idx]
-        retrieved_chunks.append(chunk_info["chunk_text"])
-        display_text = f"**From {chunk_info['file']}** (chunk {chunk_info['start']}):\n{chunk_info['chunk_text'][:300]}..."
-        retrieved_display.append(display_text)
-
-    return "\n\n".join(retrieved_chunks), "\n\n---\n\n".join(retrieved_display)
+def search(question):
+    context, sources, _ = search_batch([question])[0]
+    return context, sources
 
 # ====================
 # TOOLS
@@ -100,38 +205,70 @@ def calculate(expression):
     except:
         return "Calculation error."
 
-def get_current_time():
+def get_current_time(input_text=""):
     return datetime.now().strftime("%Y-%m-%d %H:%M:%S WAT")
 
+WORD_OPERATORS = {r"multiplied by|times": "*", r"divided by|over": "/", r"plus|added to": "+", r"minus": "-"}
+
+def extract_expression(question):
+    """The math expression in a question ("15 times 23" -> "15 * 23"), or None."""
+    text = question.lower()
+    for words, symbol in WORD_OPERATORS.items():
+        text = re.sub(rf"\b({words})\b", f" {symbol} ", text)
+    match = re.search(r'[\d(][\d\s\.\+\-\*/()]*[\d)]', text)
+    if match and re.search(r'\d\s*[\+\-\*/]\s*[\d(]', match.group(0)):
+        return " ".join(match.group(0).split())
+    return None
+
+# timeout: seconds the agent waits for the tool before answering without it
+# examples / patterns / extract are used by the intent router to pick a tool without the LLM
 TOOLS = {
-    "calculate": calculate,
-    "get_current_time": get_current_time
+    "calculate": {
+        "function": calculate,
+        "timeout": 5,
+        "examples": ["What is 15 times 23?", "Multiply 12 by 7", "How much is 250 divided by 5?",
+                     "Add 340 and 125", "Calculate 18 percent of 200"],
+        "patterns": [r"\d+(\.\d+)?\s*(times|multiplied by|divided by|plus|minus)\s*\d+"],
+        "extract": extract_expression,
+    },
+    "get_current_time": {
+        "function": get_current_time,
+        "timeout": 2,
+        "examples": ["What time is it?", "What is today's date?", "What day is it today?",
+                     "Tell me the current time", "What's the date now?"],
+        "patterns": [r"\bwhat time is it\b", r"\bcurrent (time|date)\b", r"\btoday'?s date\b",
+                     r"\bwhat day is (it|today)\b"],
+    },
 }
 
-# ====================
-# AGENT LOGIC
-# ====================
-def agent(question):
-    global history
+# Decides tool / no tool from the question embedding; the LLM is only asked when it is unsure
+router = IntentRouter(TOOLS, embedding_cache.encode, ROUTER_TOOL_ABOVE, ROUTER_NO_TOOL_BELOW)
 
-    # Quick math safety net
-    math_match = re.search(r'\d+\s*[\+\-\*/xX]\s*\d+', question)
-    if math_match:
-        expr = math_match.group(0)
-        result = calculate(expr)
-        if "error" not in result.lower():
-            history.append({"role": "user", "content": question})
-            history.append({"role": "assistant", "content": f"Calculation: {result}"})
-            return f"Calculation: {result}", ""
-
-    history.append({"role": "user", "content": question})
-    if len(history) > MAX_HISTORY * 2:
-        history = history[-MAX_HISTORY * 2:]
+# Shared by all sessions, so a tool that hangs past its timeout does not block the answer.
+# Tool calls get their own pool: a decision waiting on its tools never waits for its own pool.
+agent_pool = ThreadPoolExecutor(max_workers=AGENT_WORKERS)
+tool_pool = ThreadPoolExecutor(max_workers=TOOL_WORKERS)
 
-    history_text = "\n".join([f"{msg['role'].capitalize()}: {msg['content']}" for msg in history])
+def run_tools(calls):
+    """Run (tool name, input) calls at the same time; returns one result line per call."""
+    started = time.perf_counter()
+    running = [(name, tool_pool.submit(TOOLS[name]["function"], input_text)) for name, input_text in calls
+               if name in TOOLS]
+    results = []
+    for name, future in running:
+        timeout = TOOLS[name]["timeout"]
+        try:
+            results.append(f"Tool {name} result: {future.result(max(0, started + timeout - time.perf_counter()))}")
+        except FutureTimeout:
+            results.append(f"Tool {name} did not answer within {timeout}s.")
+        except Exception:
+            results.append(f"Tool {name} call failed.")
+    return results
 
-    # Strict tool decision
-    tool_prompt = f"""You MUST reply with EXACTLY one of these, nothing else:
+# ====================
+# AGENT LOGIC
+# ====================
+TOOL_PROMPT = """You MUST reply with EXACTLY NO_TOOL, or one TOOL/INPUT pair per tool needed, nothing else:
 
 TOOL: calculate
 INPUT: the exact math expression (e.g. 15 * 23)
@@ -142,6 +279,7 @@ INPUT: none
 NO_TOOL
 
 Rules:
+- Give several TOOL/INPUT pairs only if the question needs several results (e.g. two calculations)
 - ALWAYS use calculate for ANY math, multiplication, addition, numbers together
 - Use get_current_time for time/date questions
 - Do NOT calculate yourself
@@ -152,27 +290,7 @@ History:
 
 Question: {question}"""
 
-    tool_decision = ollama.generate(model=LLM_MODEL, prompt=tool_prompt)['response'].strip()
-
-    tool_msg = ""
-    if tool_decision.startswith("TOOL:"):
-        try:
-            lines = tool_decision.splitlines()
-            tool_line = lines[0].strip()
-            tool_name = tool_line.split("TOOL: ")[1].strip()
-            input_line = lines[1].strip() if len(lines) > 1 else ""
-            input_text = input_line.split("INPUT: ")[1].strip() if "INPUT: " in input_line else ""
-
-            if tool_name in TOOLS:
-                tool_result = TOOLS[tool_name](input_text)
-                tool_msg = f"Tool {tool_name} result: {tool_result}"
-                history.append({"role": "assistant", "content": tool_msg})
-        except:
-            tool_msg = "Tool call failed."
-
-    context, sources = search(question)
-
-    prompt = f"""You are a reliable assistant for the AI Engineering book.
+ANSWER_PROMPT = """You are a reliable assistant for the AI Engineering book.
 Use ONLY context, history, and tool results.
 Be concise, accurate. Cite sources when possible.
 If no info, say: "I don't have enough information."
@@ -189,19 +307,138 @@ Question: {question}
 
 Answer (short, cite file/chunk when relevant):"""
 
+SUMMARY_PROMPT = """Summarize this conversation in at most 80 words.
+Keep names, numbers, facts the user gave and questions still open. Output only the summary.
+
+Earlier summary:
+{summary}
+
+New turns:
+{turns}
+
+Summary:"""
+
+def summarize_history(summary, turns):
+    return llm.generate(model=LLM_MODEL, prompt=SUMMARY_PROMPT.format(summary=summary or "(none)", turns=turns))['response']
+
+def parse_tool_decision(tool_decision):
+    """[(tool name, input), ...] from the LLM's "TOOL: ... / INPUT: ..." reply, [] for NO_TOOL."""
+    calls = []
+    for line in tool_decision.splitlines():
+        line = line.strip()
+        if line.startswith("TOOL:"):
+            calls.append([line.split("TOOL:")[1].strip(), ""])
+        elif line.startswith("INPUT:") and calls:
+            calls[-1][1] = line.split("INPUT:")[1].strip()
+    return [tuple(call) for call in calls]
+
+def decide_tools(question, history_text):
+    """Tool calls for a question: locally when the router is sure, otherwise the strict LLM prompt."""
+    route = router.route(question, embedding_cache.encode(question))
+    if route is not None:
+        return [route] if route[0] else []
+    tool_prompt = TOOL_PROMPT.format(history_text=history_text, question=question)
+    return parse_tool_decision(llm.generate(model=LLM_MODEL, prompt=tool_prompt)['response'].strip())
+
+def agent_stream(question, retrieved=None, use_cache=True, session_id=None, filters=None):
+    """Generator for Gradio: sources appear right after retrieval, then the answer grows token by token."""
+    # retrieved: (context, sources, chunk_ids) already looked up by search_batch()
+    # session_id: whose conversation this is (None = a one-off question without history)
+    # filters: which sources to search (see source_filters())
+    history = sessions.get(session_id)
+
+    # Quick math safety net
+    math_match = re.search(r'\d+\s*[\+\-\*/xX]\s*\d+', question)
+    if math_match:
+        expr = math_match.group(0)
+        result = calculate(expr)
+        if "error" not in result.lower():
+            history.add("user", question)
+            history.add("assistant", f"Calculation: {result}")
+            yield f"Calculation: {result}", ""
+            return
+
+    # Recent turns plus a summary of older ones: the same size however long the chat is
+    earlier_turns = history.text()   # Part of the answer prompt, so part of the response cache key
+    history.add("user", question)
+    history_text = history.text()
+
+    # Retrieval does not depend on the tool decision: decide (and run the tools) while retrieving
+    tools_started = time.perf_counter()
+    tools_done = agent_pool.submit(lambda: run_tools(decide_tools(question, history_text)))
+
+    # Sources go on screen while the model is still thinking
+    context, sources, chunk_ids = retrieved if retrieved else search_batch([question], filters=filters)[0]
+
+    # Same question in other words over the same chunks after the same earlier turns: reuse the
+    # earlier answer and skip the answer call (the question's embedding is already in the embedding cache)
+    q_vector = embedding_cache.encode(question)
+    use_cache = use_cache and bool(chunk_ids)
+    if use_cache:
+        cached = response_cache.lookup(q_vector, chunk_ids, earlier_turns)
+        if cached is not None:
+            print(response_cache.summary())
+            tools_done.cancel()
+            history.add("assistant", cached)
+            yield cached, sources
+            return
+    yield "", sources
+
+    try:
+        tool_results = tools_done.result(max(0, tools_started + TOOLS_TIMEOUT - time.perf_counter()))
+    except FutureTimeout:
+        print(f"Tool decision did not finish within {TOOLS_TIMEOUT}s")
+        tool_results = [f"Tools did not answer within {TOOLS_TIMEOUT}s."]
+    except Exception as e:
+        print(f"Tool decision failed: {e}")
+        tool_results = []
+    tool_msg = "\n".join(tool_results)
+    for line in tool_results:
+        history.add("assistant", line)
+
+    prompt = ANSWER_PROMPT.format(history_text=history_text, tool_msg=tool_msg, context=context, question=question)
+
+    started = time.perf_counter()
+    try:
+        # Time to first token and tokens/sec of every answer go to logs/generation_metrics.csv
+        final_answer = ""
+        for partial_answer in stream_generate(llm, LLM_MODEL, prompt):
+            final_answer = partial_answer.strip()
+            yield final_answer, sources
+        history.add("assistant", final_answer)
+    except Exception as e:
+        yield f"Error: {str(e)}", sources
+        return
+
+    # The answer is on screen; now fold turns that no longer fit into the summary
     try:
-        response = ollama.generate(model=LLM_MODEL, prompt=prompt)
-        final_answer = response['response'].strip()
-        history.append({"role": "assistant", "content": final_answer})
-        return final_answer, sources
+        history.compact(summarize_history)
     except Exception as e:
-        return f"Error: {str(e)}", sources
+        print(f"Could not summarize history: {e}")
+
+    # Answers built on a tool result (the time, a calculation) are not reusable
+    if use_cache and not tool_msg and final_answer:
+        response_cache.store(q_vector, chunk_ids, final_answer, time.perf_counter() - started, earlier_turns)
+
+def chat(question, files, tags, pages, chapters, request: gr.Request):
+    """Chat handler: every browser session has its own conversation."""
+    try:
+        filters = source_filters(files, tags, pages, chapters)
+    except ValueError as e:
+        yield f"Invalid filter: {e}", ""
+        return
+    yield from agent_stream(question, session_id=request.session_hash, filters=filters)
+
+def agent(question, retrieved=None):
+    """The complete answer at once (used by the evaluation, which always asks the model)."""
+    for final_answer, sources in agent_stream(question, retrieved, use_cache=False):
+        pass
+    return final_answer, sources
 
 # ====================
 # EVALUATION
 # ====================
-def judge_answer(question, answer_text, expected_behavior, model=LLM_MODEL):
-    prompt = f"""You are an impartial judge.
+JUDGE_PROMPT = """You are an impartial judge.
 Question: {question}
 AI Answer: {answer_text}
 Expected: {expected_behavior}
@@ -216,8 +453,11 @@ Output only:
 Score: X/5
 Reason: [short]"""
 
+def judge_answer(question, answer_text, expected_behavior, model=LLM_MODEL):
+    prompt = JUDGE_PROMPT.format(question=question, answer_text=answer_text, expected_behavior=expected_behavior)
+
     try:
-        response = ollama.generate(model=model, prompt=prompt)
+        response = llm.generate(model=model, prompt=prompt)
         return response['response'].strip()
     except:
         return "Judge error"
@@ -228,21 +468,38 @@ def run_evaluation():
     except FileNotFoundError:
         return None, "test_set.csv not found."
 
-    results = []
-
-    for idx, row in test_df.iterrows():
-        real_answer, sources = agent(row['question'])
-        score = judge_answer(row['question'], real_answer, row['expected_behavior'])
-        results.append({
-            'question': row['question'],
-            'category': row['category'],
-            'answer': real_answer,
-            'sources': sources,
-            'score': score
-        })
+    rows = test_df.to_dict("records")
+
+    # Retrieval for the whole test set in one batch, before any LLM call
+    if index is None and not load_saved_index():   # Before the read lock: opening needs the write lock
+        return None, "Please load documents first."
+    with store.lock.read():   # Chunk ids and their texts from the same version of the store
+        retrieved = search_batch([row['question'] for row in rows])
+
+        # A row is only re-run if its question, retrieved chunks, prompts or model changed
+        # (the router settings decide which questions get a tool, so they count as part of the prompts)
+        prompts = prompt_hash(TOOL_PROMPT, ANSWER_PROMPT, JUDGE_PROMPT, f"router {ROUTER_TOOL_ABOVE} {ROUTER_NO_TOOL_BELOW}")
+        cache_keys = [eval_cache.key(row['question'], row['expected_behavior'],
+                                     [store.chunk_text(i) for i in chunk_ids], prompts, LLM_MODEL, LLM_MODEL)
+                      for row, (_, _, chunk_ids) in zip(rows, retrieved)]
+
+    # Answers and judgements run concurrently; finished questions are checkpointed
+    results, stats = run_evaluation_rows(
+        rows,
+        generate=lambda i, row: agent(row['question'], retrieved[i]),
+        judge=lambda row, answer_text: judge_answer(row['question'], answer_text, row['expected_behavior']),
+        checkpoint=EVAL_CHECKPOINT,
+        concurrency=EVAL_CONCURRENCY,
+        cache=eval_cache,
+        cache_keys=cache_keys,
+    )
+    if reranker is not None:
+        print(reranker.summary())
 
     results_df = pd.DataFrame(results)
-    return results_df, "Evaluation complete!"
+    return results_df, (f"Evaluation complete! {stats['answered']} questions in {stats['seconds']}s "
+                        f"({stats['questions_per_minute']} questions/min, {stats['from_checkpoint']} from checkpoint, "
+                        f"{stats['from_cache']} unchanged and taken from the cache). {router.summary()}")
 
 # ====================
 # GRADIO UI
@@ -256,13 +513,23 @@ with gr.Blocks() as demo:
         status = gr.Textbox(label="Status", interactive=False)
 
         question = gr.Textbox(label="Your Question")
+        with gr.Accordion("Filter sources", open=False):
+            with gr.Row():
+                files_filter = gr.Dropdown(label="Files", multiselect=True, choices=[])
+                tags_filter = gr.Dropdown(label="Tags (documents/tags.json)", multiselect=True, choices=[])
+            with gr.Row():
+                pages_filter = gr.Textbox(label="Pages", placeholder="e.g. 10-40 or 100-")
+                chapters_filter = gr.Textbox(label="Chapters", placeholder="e.g. 3, 2-4 or 1,5,7")
         ask_btn = gr.Button("Ask")
 
         output = gr.Textbox(label="Answer", lines=8)
         sources_box = gr.Markdown(label="Sources")
 
-        load_btn.click(load_documents, outputs=status)
-        ask_btn.click(agent, inputs=question, outputs=[output, sources_box])
+        # Only one load at a time: it rewrites the saved index
+        load_btn.click(load_documents, outputs=status, concurrency_limit=1).then(
+            source_choices, outputs=[files_filter, tags_filter])
+        ask_btn.click(chat, inputs=[question, files_filter, tags_filter, pages_filter, chapters_filter],
+                      outputs=[output, sources_box])
 
     with gr.Tab("Evaluation"):
         gr.Markdown("Run offline test on test_set.csv")
@@ -274,6 +541,10 @@ with gr.Blocks() as demo:
             df, msg = run_evaluation()
             return df, msg
 
-        eval_btn.click(run_eval_ui, outputs=[eval_output, eval_status])
+        eval_btn.click(run_eval_ui, outputs=[eval_output, eval_status], concurrency_limit=1)
+
+    demo.load(source_choices, outputs=[files_filter, tags_filter])
 
-demo.launch()
\ No newline at end of file
+if __name__ == "__main__":
+    demo.queue(default_concurrency_limit=UI_CONCURRENCY)
+    demo.launch()
\ No newline at end of file
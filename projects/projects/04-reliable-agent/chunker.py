@@ -0,0 +1,169 @@
+"""Split documents into chunks along their structure, sized in model tokens.
+
+Fixed character windows cut words and sentences in half, ignore headings and
+pages, and leave a run of tiny chunks at the end of every document that each
+cost a full embedding. Chunker instead:
+- cuts the text into sentences / lines with one regex pass
+- counts the tokens of all of them in one batched call to the embedding
+  model's tokenizer (characters / 4 if there is none)
+- packs them into chunks of at most max_tokens, starting a new chunk at a
+  heading and preferring paragraph breaks once a chunk is 3/4 full
+- repeats up to overlap_tokens of whole sentences at the start of the next chunk
+- folds a last chunk shorter than min_tokens into the one before it
+Every chunk records its character start, page number, byte offset and chapter
+number ("Chapter 3" headings, 0 before the first one) in the document; pages
+are joined with a blank line between them.
+"""
+import re
+
+import numpy as np
+
+# A sentence (up to . ! ? followed by whitespace) or the rest of a line
+UNIT = re.compile(r"[^\n]*?[.!?]['\")\]]*(?=\s)|[^\n]+")
+# Markdown headings, "Chapter 3 ...", numbered titles ("2.1 Evaluation"), short ALL CAPS lines
+HEADING = re.compile(r"(#{1,6}\s+\S.*|(?i:chapter|section|part|appendix)\s+[\w.]+.*|\d+(\.\d+)*\.?\s+[A-Z].*"
+                     r"|[A-Z][A-Z0-9 ,:&'-]{3,})")
+CHAPTER = re.compile(r"(?i:chapter)\s+(\d+)")
+MAX_HEADING_CHARS = 80
+PAGE_SEPARATOR = "\n\n"
+
+# Break levels in front of a unit
+SENTENCE, LINE, PARAGRAPH, SECTION = 0, 1, 2, 3
+
+
+class Chunker:
+    """Structure-aware chunking; tokenizer is e.g. SentenceTransformer(...).tokenizer."""
+
+    def __init__(self, tokenizer=None, max_tokens=200, overlap_tokens=30, min_tokens=40):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.min_tokens = min_tokens
+
+    def count_tokens(self, texts):
+        if not texts:
+            return np.zeros(0, dtype="int64")
+        if self.tokenizer is None:
+            return np.array([len(text) for text in texts], dtype="int64") // 4 + 1
+        ids = self.tokenizer(texts, add_special_tokens=False)["input_ids"]
+        return np.array([len(i) for i in ids], dtype="int64")
+
+    def _units(self, text):
+        """Starts, ends, break levels, token counts and chapters of every sentence / line (long ones split)."""
+        starts, ends, levels, chapters = [], [], [], []
+        previous_end = 0
+        chapter = 0
+        for match in UNIT.finditer(text):
+            start, end = match.span()
+            line = match.group()
+            stripped = line.strip()
+            if not stripped:
+                continue
+            start += len(line) - len(line.lstrip())
+            end -= len(line) - len(line.rstrip())
+
+            gap = text[previous_end:start]
+            if gap.count("\n") >= 2:
+                level = PARAGRAPH
+            elif "\n" in gap or not previous_end:
+                level = LINE
+            else:
+                level = SENTENCE
+            # A heading is a whole short line
+            if level >= LINE and len(stripped) <= MAX_HEADING_CHARS and text[end:end + 1] in ("\n", "") \
+                    and not stripped.endswith((".", ",", ";")) and HEADING.fullmatch(stripped):
+                level = SECTION
+                number = CHAPTER.match(stripped)
+                if number:
+                    chapter = int(number.group(1))
+
+            starts.append(start)
+            ends.append(end)
+            levels.append(level)
+            chapters.append(chapter)
+            previous_end = end
+
+        tokens = self.count_tokens([text[s:e] for s, e in zip(starts, ends)])
+        if len(tokens) and tokens.max() > self.max_tokens:
+            return self._split_long(text, starts, ends, levels, tokens, chapters)
+        return np.array(starts, dtype="int64"), np.array(ends, dtype="int64"), levels, tokens, np.array(chapters)
+
+    def _split_long(self, text, starts, ends, levels, tokens, chapters):
+        """Cut units longer than max_tokens at spaces into roughly equal pieces."""
+        new_starts, new_ends, new_levels, new_chapters = [], [], [], []
+        for start, end, level, count, chapter in zip(starts, ends, levels, tokens, chapters):
+            # One extra piece keeps each of them safely under the limit after cutting at spaces
+            pieces = -(-int(count) // self.max_tokens) + (count > self.max_tokens)
+            cuts = [start]
+            for piece in range(1, pieces):
+                target = start + (end - start) * piece // pieces
+                space = text.rfind(" ", cuts[-1] + 1, target)
+                cuts.append(space + 1 if space > cuts[-1] else target)
+            cuts.append(end)
+            for piece, (piece_start, piece_end) in enumerate(zip(cuts, cuts[1:])):
+                new_starts.append(piece_start)
+                new_ends.append(piece_end)
+                new_levels.append(level if piece == 0 else SENTENCE)
+                new_chapters.append(chapter)
+        new_tokens = self.count_tokens([text[s:e] for s, e in zip(new_starts, new_ends)])
+        return (np.array(new_starts, dtype="int64"), np.array(new_ends, dtype="int64"), new_levels, new_tokens,
+                np.array(new_chapters))
+
+    def _pack(self, levels, tokens):
+        """[(first unit, end unit), ...] for every chunk."""
+        soft_limit = self.max_tokens * 3 // 4
+        ranges = []
+        first, used = 0, 0
+        for i, level in enumerate(levels):
+            count = int(tokens[i])
+            if i > first and (used + count > self.max_tokens
+                              or (level == SECTION and used >= self.min_tokens)
+                              or (level >= PARAGRAPH and used >= soft_limit)):
+                ranges.append((first, i))
+                # Overlap: whole sentences from the end of the last chunk, but never across a heading
+                new_first, back = i, 0
+                budget = min(self.overlap_tokens, self.max_tokens - count)
+                while level < SECTION and new_first - 1 > first and back + tokens[new_first - 1] <= budget:
+                    new_first -= 1
+                    back += int(tokens[new_first])
+                first, used = new_first, back
+            used += count
+        if len(levels):
+            ranges.append((first, len(levels)))
+
+        # A tiny tail would cost a whole embedding for a few words: fold it into the chunk before
+        if len(ranges) > 1 and tokens[ranges[-1][0]:ranges[-1][1]].sum() < self.min_tokens:
+            ranges[-2:] = [(ranges[-2][0], ranges[-1][1])]
+        return ranges
+
+    def chunk_pages(self, pages):
+        """Chunks of one document given the text of its pages.
+
+        Returns a list of dicts with "start" (character), "page" (1-based),
+        "byte_start" (UTF-8 byte offset), "chapter" and "chunk_text".
+        """
+        text = PAGE_SEPARATOR.join(pages)
+        starts, ends, levels, tokens, chapters = self._units(text)
+        if not len(starts):
+            return []
+        ranges = self._pack(levels, tokens)
+
+        chunk_starts = starts[[first for first, _ in ranges]]
+        chunk_chapters = chapters[[first for first, _ in ranges]]
+        chunk_ends = ends[[end - 1 for _, end in ranges]]
+
+        page_starts = np.cumsum([0] + [len(page) + len(PAGE_SEPARATOR) for page in pages[:-1]])
+        chunk_pages = np.searchsorted(page_starts, chunk_starts, side="right")
+
+        if text.isascii():
+            byte_starts = chunk_starts
+        else:
+            # UTF-8 length of every character, from its code point
+            code_points = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype="<u4")
+            char_bytes = 1 + (code_points >= 0x80) + (code_points >= 0x800) + (code_points >= 0x10000)
+            byte_starts = np.concatenate([[0], np.cumsum(char_bytes)])[chunk_starts]
+
+        return [{"start": int(start), "page": int(page), "byte_start": int(byte_start), "chapter": int(chapter),
+                 "chunk_text": text[start:end]}
+                for start, end, page, byte_start, chapter in zip(chunk_starts, chunk_ends, chunk_pages, byte_starts,
+                                                                 chunk_chapters)]
@@ -0,0 +1,131 @@
+"""Read PDFs in worker processes.
+
+pypdf is pure Python, so page.extract_text() is CPU-bound and reading files
+one after another leaves the other cores idle. extract_documents() spreads
+PDFs - and page ranges of big PDFs - over a process pool and yields results
+back in the original order. A PDF that crashes or hangs a worker is reported
+and skipped instead of stopping the whole load.
+"""
+import multiprocessing
+import os
+from collections import deque
+
+from pypdf import PdfReader
+
+PAGES_PER_TASK = 50                  # Big PDFs are split into page ranges of this size
+SPLIT_PDF_BYTES = 2 * 1024 * 1024    # ...if the file is larger than this
+TASK_TIMEOUT = 120                   # Seconds before a PDF is given up on
+
+
+def _read_pdf_pages(path, start=0, end=None):
+    """Runs in a worker: text of pages [start, end) of one PDF."""
+    reader = PdfReader(path)
+    return [page.extract_text() or "" for page in reader.pages[start:end]]
+
+
+def _read_text_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [f.read()]
+
+
+def _plan(path):
+    """Page ranges to read for one PDF (one range unless the file is big)."""
+    if os.path.getsize(path) <= SPLIT_PDF_BYTES:
+        return [(path, 0, None)]
+    page_count = len(PdfReader(path).pages)
+    return [(path, start, min(start + PAGES_PER_TASK, page_count))
+            for start in range(0, page_count, PAGES_PER_TASK)] or [(path, 0, None)]
+
+
+def _pool_context():
+    # Not fork: the apps already run threads (Gradio, torch, the LLM client), and a forked copy
+    # of a multi-threaded process can deadlock. forkserver forks workers from a clean process;
+    # Windows only has spawn. Both import the app's main module again, hence its __main__ guard.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def extract_documents(paths, workers=None, timeout=TASK_TIMEOUT):
+    """Yield (path, pages, error) for every path, in the same order as paths.
+
+    pages is a list with the text of each page (a text file is one page).
+    If a file can't be read, pages is None and error says why.
+    """
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    context = _pool_context()
+    pool = context.Pool(workers)
+    max_in_flight = workers * 2
+    queued = deque()       # One entry per file: {"path", "tasks": [[args, async_result]], "error"}
+    paths = iter(paths)
+
+    def submit(task):
+        task[1] = pool.apply_async(_read_pdf_pages, task[0])
+
+    def fill():
+        in_flight = sum(len(item["tasks"]) for item in queued)
+        while in_flight < max_in_flight:
+            path = next(paths, None)
+            if path is None:
+                return
+            item = {"path": path, "tasks": [], "error": None}
+            if path.lower().endswith(".pdf"):
+                try:
+                    item["tasks"] = [[args, None] for args in _plan(path)]
+                except Exception as e:
+                    item["error"] = str(e)
+                for task in item["tasks"]:
+                    submit(task)
+            queued.append(item)
+            in_flight += len(item["tasks"])
+
+    try:
+        fill()
+        while queued:
+            item = queued.popleft()
+            path = item["path"]
+            if item["error"]:
+                yield path, None, item["error"]
+            elif not item["tasks"]:
+                try:
+                    yield path, _read_text_file(path), None
+                except Exception as e:
+                    yield path, None, str(e)
+            else:
+                pages, error = [], None
+                for args, result in item["tasks"]:
+                    try:
+                        pages.extend(result.get(timeout))
+                    except multiprocessing.TimeoutError:
+                        error = f"timed out after {timeout}s (or crashed a worker)"
+                        # The stuck worker can only be stopped by replacing the pool;
+                        # work that is already finished is kept, the rest is sent again
+                        pool.terminate()
+                        pool = context.Pool(workers)
+                        for other in queued:
+                            for task in other["tasks"]:
+                                if not (task[1].ready() and task[1].successful()):
+                                    submit(task)
+                        break
+                    except Exception as e:
+                        error = str(e)
+                        break
+                if error:
+                    yield path, None, error
+                else:
+                    yield path, pages, None
+            fill()
+    finally:
+        pool.terminate()
+
+
+def read_pages(path, timeout=TASK_TIMEOUT):
+    """Text of each page of one file. Big PDFs are read in parallel page ranges."""
+    if not path.lower().endswith(".pdf"):
+        return _read_text_file(path)
+    if os.path.getsize(path) <= SPLIT_PDF_BYTES:
+        return _read_pdf_pages(path)
+    for _, pages, error in extract_documents([path], timeout=timeout):
+        if error:
+            raise RuntimeError(error)
+        return pages
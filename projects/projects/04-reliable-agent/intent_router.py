@@ -0,0 +1,90 @@
+"""Decide locally whether a question needs a tool, before asking the LLM.
+
+Asking the model "which tool?" costs a full generate call per question, and
+for most questions the answer is "none". IntentRouter decides in milliseconds:
+1. a tool's regex patterns match -> that tool
+2. the question embedding is far from every tool's examples -> no tool
+3. it is very close to one tool's examples -> that tool
+Otherwise it is not sure and returns None, and the LLM decides as before.
+A tool can only be chosen locally if its "extract" function finds the tool
+input in the question (e.g. the expression for a calculator).
+"""
+import re
+import threading
+
+import numpy as np
+
+
+class IntentRouter:
+    """Regex + embedding-similarity tool router.
+
+    tools: {name: {"examples": [...], "patterns": [regex, ...], "extract": question -> input or None, ...}}
+    encode: texts -> embeddings (the app's embedding cache).
+    """
+
+    def __init__(self, tools, encode, tool_above=0.6, no_tool_below=0.35):
+        self.encode = encode
+        self.tool_above = tool_above
+        self.no_tool_below = no_tool_below
+        self.tools = {}
+        for name, tool in tools.items():
+            examples = self._unit(encode(tool.get("examples") or [tool["description"]]))
+            patterns = [re.compile(pattern, re.IGNORECASE) for pattern in tool.get("patterns", [])]
+            extract = tool.get("extract") or (lambda question: "")
+            self.tools[name] = (examples, patterns, extract)
+
+        self.lock = threading.Lock()
+        self.by_rule = 0
+        self.by_similarity = 0
+        self.by_llm = 0
+
+    @staticmethod
+    def _unit(vectors):
+        vectors = np.atleast_2d(np.asarray(vectors, dtype="float32"))
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    def _count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def route(self, question, q_vector=None):
+        """(tool name, tool input) or (None, "") for no tool; None if the LLM should decide."""
+        for name, (_, patterns, extract) in self.tools.items():
+            if any(pattern.search(question) for pattern in patterns):
+                tool_input = extract(question)
+                if tool_input is not None:
+                    self._count("by_rule")
+                    return name, tool_input
+
+        if self.tools:
+            query = self._unit(q_vector if q_vector is not None else self.encode(question))[0]
+            similarity = {name: float((examples @ query).max()) for name, (examples, _, _) in self.tools.items()}
+            best = max(similarity, key=similarity.get)
+
+            if similarity[best] < self.no_tool_below:
+                self._count("by_similarity")
+                return None, ""
+            if similarity[best] >= self.tool_above:
+                tool_input = self.tools[best][2](question)
+                if tool_input is not None:
+                    self._count("by_similarity")
+                    return best, tool_input
+
+        self._count("by_llm")
+        return None
+
+    def stats(self):
+        decided = self.by_rule + self.by_similarity
+        total = decided + self.by_llm
+        return {
+            "questions": total,
+            "by_rule": self.by_rule,
+            "by_similarity": self.by_similarity,
+            "by_llm": self.by_llm,
+            "llm_calls_avoided": round(decided / total, 3) if total else 0.0,
+        }
+
+    def summary(self):
+        s = self.stats()
+        return (f"Intent router: {s['by_rule'] + s['by_similarity']} of {s['questions']} tool decisions made locally "
+                f"({s['llm_calls_avoided']:.0%} of LLM tool calls avoided)")
@@ -0,0 +1,162 @@
+"""One shared, asyncio-based client for every call to Ollama.
+
+Calling ollama.generate() from each Gradio handler opens a new connection
+per request and lets any number of users pile onto the Ollama server at once.
+LLMClient runs a single ollama.AsyncClient (one pooled HTTP connection set)
+on an event loop in a background thread:
+- at most max_in_flight requests are sent to Ollama at the same time
+- up to max_queue more wait for a slot; beyond that, or after waiting
+  queue_timeout seconds, LLMBusyError is raised instead of piling up more
+  (by default as long as a full queue ahead of the request could take)
+- a request (or a stream that stops sending tokens) is cancelled after timeout seconds
+
+generate(), chat() and generate_stream() can be called from any thread
+(Gradio runs plain handlers in worker threads); they hand the work to the
+coroutines agenerate() / achat() / agenerate_stream() on the client's loop.
+Point OLLAMA_HOST at stub_ollama.py to load-test it without a model.
+"""
+import asyncio
+import queue
+import threading
+from contextlib import asynccontextmanager
+
+import ollama
+
+
+class LLMBusyError(RuntimeError):
+    """Raised when too many requests are already waiting for the model."""
+
+
+_END = object()
+
+
+class LLMClient:
+    """Bounded, pooled access to one Ollama server, usable from sync and async code."""
+
+    def __init__(self, host=None, max_in_flight=4, max_queue=32, timeout=300, queue_timeout=None):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        if queue_timeout is None:
+            # The last one queued waits for max_queue / max_in_flight rounds of requests, each up to timeout
+            queue_timeout = timeout * -(-max_queue // max_in_flight)
+        self.queue_timeout = queue_timeout
+
+        # Only ever touched from the loop thread
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="llm-client", daemon=True).start()
+
+        async def setup():
+            self.slots = asyncio.Semaphore(max_in_flight)
+            self.client = ollama.AsyncClient(host=host, timeout=timeout)
+
+        self._run(setup())
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    @asynccontextmanager
+    async def _slot(self):
+        # Backpressure: refuse new work instead of letting the queue grow without limit
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise LLMBusyError(f"{self.waiting} requests already waiting for the model, try again shortly")
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise LLMBusyError(f"No free model slot after {self.queue_timeout}s, try again shortly") from None
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+
+    async def _call(self, request):
+        async with self._slot():
+            try:
+                response = await asyncio.wait_for(request(), self.timeout)
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                raise TimeoutError(f"Model did not answer within {self.timeout}s") from None
+            self.completed += 1
+            return response
+
+    # --------------------
+    # Async API
+    # --------------------
+    async def agenerate(self, model, prompt, **kwargs):
+        return await self._call(lambda: self.client.generate(model=model, prompt=prompt, **kwargs))
+
+    async def achat(self, model, messages, **kwargs):
+        return await self._call(lambda: self.client.chat(model=model, messages=messages, **kwargs))
+
+    async def agenerate_stream(self, model, prompt, **kwargs):
+        """Yield Ollama's chunks as they arrive; holds one slot for the whole answer."""
+        async with self._slot():
+            chunks = await asyncio.wait_for(self.client.generate(model=model, prompt=prompt, stream=True, **kwargs),
+                                            self.timeout)
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    self.timed_out += 1
+                    raise TimeoutError(f"Model sent nothing for {self.timeout}s") from None
+                yield chunk
+            self.completed += 1
+
+    # --------------------
+    # Sync API (same return values as ollama.generate / ollama.chat)
+    # --------------------
+    def generate(self, model, prompt, **kwargs):
+        return self._run(self.agenerate(model, prompt, **kwargs))
+
+    def chat(self, model, messages, **kwargs):
+        return self._run(self.achat(model, messages, **kwargs))
+
+    def generate_stream(self, model, prompt, **kwargs):
+        """Like ollama.generate(stream=True): an iterator of chunks, fed from the event loop."""
+        chunks = queue.Queue()
+
+        async def pump():
+            try:
+                async for chunk in self.agenerate_stream(model, prompt, **kwargs):
+                    chunks.put(chunk)
+                chunks.put(_END)
+            except Exception as e:
+                chunks.put(e)
+
+        task = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                item = chunks.get()
+                if item is _END:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # The reader stopped early (e.g. the user left): free the slot
+            task.cancel()
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+        }
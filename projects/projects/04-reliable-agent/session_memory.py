@@ -0,0 +1,117 @@
+"""Conversation memory per chat session, with a fixed prompt cost.
+
+One global history list mixes up every user's conversation and grows the
+prompt with every turn. Here each Gradio session gets its own Conversation:
+- the newest turns are kept word for word, as many as fit in token_budget
+- older turns are folded into a short running summary by the LLM (compact()),
+  so the history part of a prompt stays about the same size however long the chat gets
+Tokens are estimated as characters / 4, close enough for budgeting.
+Sessions unused for idle_timeout seconds, or beyond max_sessions, are dropped.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+class Conversation:
+    """One chat: a running summary of old turns plus the recent turns verbatim."""
+
+    def __init__(self, token_budget=600):
+        self.token_budget = token_budget
+        self.summary_budget = token_budget // 3  # Room the summary may take from the budget
+        self.summary = ""
+        self.turns = []  # {"role", "content", "tokens"}
+        self.compacting = False
+        self.last_used = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, role, content):
+        with self.lock:
+            self.turns.append({"role": role, "content": content, "tokens": estimate_tokens(content)})
+            self.last_used = time.time()
+
+    def _window_start(self):
+        """Index of the oldest turn that still fits in the budget next to the summary."""
+        budget = self.token_budget - estimate_tokens(self.summary)
+        start = len(self.turns)
+        used = 0
+        for i in range(len(self.turns) - 1, -1, -1):
+            used += self.turns[i]["tokens"]
+            if used > budget:
+                break
+            start = i
+        # The newest turn is always shown, even if it is longer than the budget on its own
+        return min(start, max(len(self.turns) - 1, 0))
+
+    def text(self):
+        """History for a prompt: summary of older turns, then the recent turns."""
+        with self.lock:
+            lines = [f"Summary of earlier conversation: {self.summary}"] if self.summary else []
+            lines += [f"{turn['role'].capitalize()}: {turn['content']}" for turn in self.turns[self._window_start():]]
+        return "\n".join(lines)
+
+    def compact(self, summarize):
+        """Fold the turns that fell out of the window into the summary.
+
+        summarize(previous_summary, turns_text) returns the new summary (one LLM call);
+        nothing happens while every turn still fits.
+        """
+        with self.lock:
+            if self.compacting:
+                return
+            old = self.turns[:self._window_start()]
+            if not old:
+                return
+            self.compacting = True
+            previous = self.summary
+
+        try:
+            summary = summarize(previous, "\n".join(f"{turn['role'].capitalize()}: {turn['content']}" for turn in old))
+        finally:
+            with self.lock:
+                self.compacting = False
+
+        with self.lock:
+            # Keep the summary itself within its share of the budget
+            self.summary = summary.strip()[:self.summary_budget * 4]
+            # New turns may have been added meanwhile; the folded ones are still at the front
+            del self.turns[:len(old)]
+
+
+class SessionMemory:
+    """Conversations keyed by session id (Gradio's request.session_hash)."""
+
+    def __init__(self, token_budget=600, max_sessions=500, idle_timeout=3600):
+        self.token_budget = token_budget
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, session_id):
+        """The conversation of a session; session_id None gives a fresh one that is not kept."""
+        if session_id is None:
+            return Conversation(self.token_budget)
+
+        with self.lock:
+            # Forget idle sessions (least recently used are at the front)
+            now = time.time()
+            while self.sessions:
+                oldest = next(iter(self.sessions.values()))
+                if now - oldest.last_used <= self.idle_timeout and len(self.sessions) < self.max_sessions:
+                    break
+                self.sessions.popitem(last=False)
+
+            conversation = self.sessions.get(session_id)
+            if conversation is None:
+                conversation = self.sessions[session_id] = Conversation(self.token_budget)
+            self.sessions.move_to_end(session_id)
+            conversation.last_used = now
+            return conversation
+
+    def __len__(self):
+        return len(self.sessions)
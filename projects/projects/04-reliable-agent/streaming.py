@@ -0,0 +1,61 @@
+"""Stream answers from Ollama token by token and record how fast they came.
+
+With stream=False nothing is shown until the whole answer exists, which on a
+CPU can take half a minute. stream_generate() yields the answer as it grows,
+so a Gradio generator handler can update the textbox while the model is
+still writing. Requests go through the app's shared LLMClient. For every
+request the time to first token and the tokens per second are appended to
+logs/generation_metrics.csv.
+"""
+import csv
+import os
+import threading
+import time
+from datetime import datetime
+
+METRICS_LOG = "logs/generation_metrics.csv"
+METRICS_COLUMNS = ["timestamp", "model", "time_to_first_token_s", "tokens", "tokens_per_sec", "total_s"]
+
+_log_lock = threading.Lock()
+
+
+def stream_generate(llm, model, prompt, log_path=METRICS_LOG):
+    """Yield the answer so far every time Ollama sends more of it (llm is an LLMClient)."""
+    started = time.perf_counter()
+    first_token = None
+    text = ""
+    pieces = 0
+    final = {}
+    for chunk in llm.generate_stream(model, prompt):
+        if chunk["response"]:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+            text += chunk["response"]
+            pieces += 1
+            yield text
+        if chunk.get("done"):
+            final = chunk
+    total = time.perf_counter() - started
+
+    # Ollama reports the exact token count and generation time in its last message
+    tokens = final.get("eval_count") or pieces
+    generating = (final.get("eval_duration") or 0) / 1e9 or total - (first_token or 0)
+    record_metrics(log_path, {
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "model": model,
+        "time_to_first_token_s": round(first_token if first_token is not None else total, 3),
+        "tokens": tokens,
+        "tokens_per_sec": round(tokens / generating, 1) if generating > 0 else 0.0,
+        "total_s": round(total, 3),
+    })
+
+
+def record_metrics(log_path, row):
+    with _log_lock:
+        os.makedirs(os.path.dirname(log_path) or ".", exist_ok=True)
+        new_file = not os.path.exists(log_path)
+        with open(log_path, "a", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=METRICS_COLUMNS)
+            if new_file:
+                writer.writeheader()
+            writer.writerow(row)
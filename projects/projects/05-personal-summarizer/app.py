@@ -1,42 +1,59 @@
+import argparse
 import gradio as gr
-from pypdf import PdfReader
 import os
-import ollama
+import time
 import pandas as pd
 from datetime import datetime
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
+from embedding_cache import EmbeddingCache
+from extraction import read_pages
+from llm_client import LLMClient
+from map_reduce import MapReduceSummarizer, SectionCache
+from log_store import LogStore
+from scoring import SummaryScorer
+from folder_job import content_hash, folder_files, format_seconds, run_folder_job
 
 # ────────────────────────────────────────────────
 # SETTINGS ─ DO NOT CHANGE THESE
 # ────────────────────────────────────────────────
-LOG_FILE = "logs/summaries_log.csv"
+LOG_FILE = "logs/summaries_log.csv"          # Old CSV log, imported into LOG_DB once
+LOG_DB = "logs/summaries.sqlite"             # Every summary and its scores
 JUDGE_MODEL = 'phi3.5'           # ← change to 'tinyllama' if phi3.5 is too slow
 DOCUMENTS_FOLDER = "documents"
+EMBEDDING_MODEL = 'all-MiniLM-L6-v2'
+EMBEDDING_CACHE = "cache/embeddings.sqlite"   # Documents are embedded once, not once per summary
+LLM_MAX_IN_FLIGHT = 2                         # Summaries sent to Ollama at once (set OLLAMA_NUM_PARALLEL to match)
+UI_CONCURRENCY = 8                            # Uploads handled at once; their LLM calls queue in llm_client
+LLM_QUEUE_TIMEOUT = 120 * UI_CONCURRENCY // LLM_MAX_IN_FLIGHT  # Seconds a request may wait for a slot: 2 min per round of requests ahead
+SECTION_CHARS = 6000                          # Longer documents are summarized section by section, then combined
+SECTION_WORDS = 150                           # Length of each section summary
+SECTION_CACHE = "cache/section_summaries.sqlite"  # Section summaries by content hash, reused across styles/lengths
+SCORING_CHUNK_CHARS = 1000                    # Documents are scored as chunks of this size, embedded once
+FOLDER_WORKERS = 2                            # Files of a folder job summarized at once
 
-# Create logs folder automatically
-os.makedirs("logs", exist_ok=True)
-
-# Create log file if it doesn't exist
-if not os.path.exists(LOG_FILE):
-    pd.DataFrame(columns=[
-        'timestamp', 'filename', 'summary_length', 'summary_style',
-        'summary', 'faithfulness', 'completeness', 'conciseness', 'overall'
-    ]).to_csv(LOG_FILE, index=False)
+# Summary log (SQLite; creates the logs folder and imports the old CSV log the first time)
+log_store = LogStore(LOG_DB, legacy_csv=LOG_FILE)
 
 # Load embedding model for scoring
-embedder = SentenceTransformer('all-MiniLM-L6-v2')
+embedder = SentenceTransformer(EMBEDDING_MODEL)
+embedding_cache = EmbeddingCache(embedder, EMBEDDING_MODEL, EMBEDDING_CACHE)
+# Summary sentences are matched against document chunks, all summaries of a document in one batch
+scorer = SummaryScorer(embedding_cache.encode, SCORING_CHUNK_CHARS)
+
+# One shared connection pool to Ollama for every user
+llm = LLMClient(max_in_flight=LLM_MAX_IN_FLIGHT, queue_timeout=LLM_QUEUE_TIMEOUT)
+
+# Long documents: sections summarized in parallel (as many as Ollama runs at once), then combined
+summarizer = MapReduceSummarizer(llm, JUDGE_MODEL, SectionCache(SECTION_CACHE), SECTION_CHARS, SECTION_WORDS,
+                                 workers=LLM_MAX_IN_FLIGHT)
 
 def read_document(file_path):
     """Read text from PDF or text file."""
     if file_path.endswith(".pdf"):
         try:
-            reader = PdfReader(file_path)
-            text = ""
-            for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-            return text.strip()
+            # Big PDFs are read in parallel page ranges
+            pages = read_pages(file_path)
+            return "\n".join(page for page in pages if page).strip()
         except Exception as e:
             return f"PDF reading error: {str(e)}"
     elif file_path.endswith((".txt", ".md")):
@@ -47,60 +64,62 @@ def read_document(file_path):
             return f"Text reading error: {str(e)}"
     return "Unsupported file type. Please upload PDF, TXT or MD."
 
-def generate_summary(text, length="medium", style="paragraph"):
-    """Generate summary with chosen length and style."""
-    length_desc = {
-        "short": "2-4 sentences",
-        "medium": "5-8 sentences",
-        "detailed": "10-15 sentences or bullet points"
-    }
-    style_desc = {
-        "paragraph": "in clear paragraphs",
-        "bullets": "in bullet points",
-        "executive": "executive style – key takeaways first",
-        "technical": "technical style – focus on concepts and terms"
-    }
+LENGTHS = {
+    "short": "2-4 sentences",
+    "medium": "5-8 sentences",
+    "detailed": "10-15 sentences or bullet points"
+}
+STYLES = {
+    "paragraph": "in clear paragraphs",
+    "bullets": "in bullet points",
+    "executive": "executive style – key takeaways first",
+    "technical": "technical style – focus on concepts and terms"
+}
 
-    prompt = f"""Summarize the following text from the AI Engineering book.
-Keep the summary {length_desc.get(length, "medium")} long.
-Present it {style_desc.get(style, "in paragraphs")}.
-Be accurate, objective, faithful to the original. No hallucinations or added information.
+def summary_prompt(length, style):
+    """Final prompt builder for one length and style.
 
-Text:
-{text[:12000]}
+    The document comes first and the instructions last, so every variant of a
+    document starts with the same prompt prefix and Ollama can reuse its KV cache.
+    """
+    def final_prompt(text, from_sections):
+        source = ("The text above is a list of summaries of consecutive parts of one document, in order.\n"
+                  "Combine them into a single summary of the whole document.\n" if from_sections else "")
+        return f"""Text from the AI Engineering book:
+{text}
+
+{source}Summarize the text above.
+Keep the summary {LENGTHS.get(length, "medium")} long.
+Present it {STYLES.get(style, "in paragraphs")}.
+Be accurate, objective, faithful to the original. No hallucinations or added information.
 
 Summary:"""
+    return final_prompt
 
+def generate_summary(text, length="medium", style="paragraph"):
+    """Generate summary with chosen length and style (of the whole text, however long)."""
     try:
-        response = ollama.generate(model=JUDGE_MODEL, prompt=prompt)
-        return response['response'].strip()
+        # Only the final step depends on length and style; section summaries come from the cache
+        return summarizer.summarize(text, summary_prompt(length, style))
     except Exception as e:
         return f"Summary generation error: {str(e)}"
 
-def evaluate_summary(original, summary):
-    """Score summary quality using similarity + heuristics."""
-    if not summary or "error" in summary.lower():
-        return {"faithfulness": 0, "completeness": 0, "conciseness": 0, "overall": 0}
-
-    orig_emb = embedder.encode(original)
-    sum_emb = embedder.encode(summary)
-    faithfulness = util.cos_sim(orig_emb, sum_emb)[0][0].item() * 5
-
-    completeness = min(5, (len(summary.split()) / max(1, len(original.split()) / 15)) * 5)
-
-    ideal_ratio = 0.15
-    ratio = len(summary) / max(1, len(original))
-    conciseness = 5 - abs(ratio - ideal_ratio) * 30
-    conciseness = max(1, min(5, conciseness))
+def generate_summaries(text, variants):
+    """One summary per (length, style) in variants; sections are summarized once for all of them."""
+    try:
+        results = summarizer.summarize_variants(text, [summary_prompt(length, style) for length, style in variants])
+    except Exception as e:
+        return [f"Summary generation error: {str(e)}"] * len(variants)
+    return [f"Summary generation error: {str(result)}" if isinstance(result, Exception) else result
+            for result in results]
 
-    overall = (faithfulness + completeness + conciseness) / 3
+def evaluate_summaries(original, summaries):
+    """Score several summaries of one document together (similarity to its chunks + heuristics)."""
+    return scorer.score(original, summaries)
 
-    return {
-        "faithfulness": round(faithfulness, 1),
-        "completeness": round(completeness, 1),
-        "conciseness": round(conciseness, 1),
-        "overall": round(overall, 1)
-    }
+def evaluate_summary(original, summary):
+    """Score summary quality using similarity + heuristics."""
+    return evaluate_summaries(original, [summary])[0]
 
 def summarize_and_evaluate(file, length, style):
     """Main function: read file → summarize → evaluate → log."""
@@ -117,7 +136,17 @@ def summarize_and_evaluate(file, length, style):
     scores = evaluate_summary(text, summary)
 
     # Log the result
-    log_row = pd.DataFrame([{
+    log_summary(file_path, text, length, style, summary, scores)
+
+    return (
+        summary,
+        f"Faithfulness: {scores['faithfulness']}/5\nCompleteness: {scores['completeness']}/5\nConciseness: {scores['conciseness']}/5\nOverall: {scores['overall']}/5",
+        text[:400] + "..." if len(text) > 400 else text,
+        f"Summary logged at {datetime.now().strftime('%H:%M:%S')} | {embedding_cache.summary()} | {summarizer.summary()}"
+    )
+
+def log_summary(file_path, text, length, style, summary, scores):
+    log_store.add({
         'timestamp': datetime.now().isoformat(),
         'filename': os.path.basename(file_path),
         'summary_length': length,
@@ -126,32 +155,84 @@ def summarize_and_evaluate(file, length, style):
         'faithfulness': scores['faithfulness'],
         'completeness': scores['completeness'],
         'conciseness': scores['conciseness'],
-        'overall': scores['overall']
-    }])
-    log_row.to_csv(LOG_FILE, mode='a', header=False, index=False)
+        'overall': scores['overall'],
+        'content_hash': content_hash(text),
+    })
 
-    return (
-        summary,
-        f"Faithfulness: {scores['faithfulness']}/5\nCompleteness: {scores['completeness']}/5\nConciseness: {scores['conciseness']}/5\nOverall: {scores['overall']}/5",
-        text[:400] + "..." if len(text) > 400 else text,
-        f"Summary logged at {datetime.now().strftime('%H:%M:%S')}"
-    )
+def compare_variants(file, lengths, styles):
+    """Batch mode: every chosen length x style of one file, generated together and compared in a table."""
+    if not file:
+        return pd.DataFrame(), "Please upload a file first."
+    variants = [(length, style) for length in lengths for style in styles]
+    if not variants:
+        return pd.DataFrame(), "Choose at least one length and one style."
+
+    # Read once for all variants
+    file_path = file.name
+    text = read_document(file_path)
+    if "error" in text.lower():
+        return pd.DataFrame(), text
+
+    started = time.perf_counter()
+    summaries = generate_summaries(text, variants)
+    # All variants scored in one batch against the document's chunks
+    all_scores = evaluate_summaries(text, summaries)
+    for (length, style), summary, scores in zip(variants, summaries, all_scores):
+        log_summary(file_path, text, length, style, summary, scores)
+
+    table = pd.DataFrame([{"length": length, "style": style, **scores, "words": len(summary.split()),
+                           "summary": summary}
+                          for (length, style), summary, scores in zip(variants, summaries, all_scores)])
+    table = table.sort_values("overall", ascending=False, kind="stable")
+    return table, (f"{len(variants)} variants in {time.perf_counter() - started:.1f}s | "
+                   f"{embedding_cache.summary()} | {summarizer.summary()}")
+
+def summarize_folder(folder=DOCUMENTS_FOLDER, length="medium", style="paragraph", workers=FOLDER_WORKERS):
+    """Summarize every file in folder; yields (progress message, table of results) after each file.
+
+    Files already summarized with this length and style are skipped, so a stopped job resumes.
+    """
+    if not os.path.isdir(folder):
+        yield f"Folder not found: {folder}", pd.DataFrame()
+        return
+    paths = folder_files(folder)
+    if not paths:
+        yield f"No PDF, TXT or MD files in {folder}.", pd.DataFrame()
+        return
+
+    def summarize_one(path, text):
+        summary = generate_summary(text, length, style)
+        if summary.startswith("Summary generation error"):
+            raise RuntimeError(summary)  # Not logged: retried on the next run
+        scores = evaluate_summary(text, summary)
+        log_summary(path, text, length, style, summary, scores)
+        return scores
+
+    rows = []
+    for progress in run_folder_job(paths, summarize_one, lambda key: log_store.has_summary(key, length, style), workers):
+        result = progress["result"]
+        rows.append({"file": os.path.basename(progress["path"]), "status": progress["status"],
+                     "overall": result["overall"] if isinstance(result, dict) else None,
+                     "note": result if isinstance(result, str) else ""})
+        eta = format_seconds(progress["eta"]) if progress["eta"] is not None else "?"
+        yield (f"{progress['finished']}/{progress['total']} files: {progress['summarized']} summarized, "
+               f"{progress['skipped']} already done, {progress['failed']} failed | "
+               f"elapsed {format_seconds(progress['elapsed'])}, ETA {eta}"), pd.DataFrame(rows)
 
 def load_dashboard():
     """Load summary history and stats for dashboard."""
-    try:
-        df = pd.read_csv(LOG_FILE)
-        if df.empty:
-            return "No summaries logged yet.", pd.DataFrame()
-        stats = {
-            "Total summaries": len(df),
-            "Average overall score": round(df['overall'].mean(), 2),
-            "Best faithfulness": round(df['faithfulness'].max(), 2),
-            "Worst completeness": round(df['completeness'].min(), 2)
-        }
-        return pd.DataFrame([stats]), df.tail(10)
-    except:
-        return "No log file found yet.", pd.DataFrame()
+    # Totals are kept up to date on every insert: no need to read the whole history
+    totals = log_store.totals()
+    if not totals["count"]:
+        return "No summaries logged yet.", pd.DataFrame()
+    rounded = lambda value: round(value, 2) if value is not None else None
+    stats = {
+        "Total summaries": totals["count"],
+        "Average overall score": rounded(totals["average_overall"]),
+        "Best faithfulness": rounded(totals["best_faithfulness"]),
+        "Worst completeness": rounded(totals["worst_completeness"])
+    }
+    return pd.DataFrame([stats]), log_store.recent(10)
 
 # ────────────────────────────────────────────────
 # GRADIO INTERFACE
@@ -172,6 +253,28 @@ with gr.Blocks() as demo:
     preview = gr.Textbox(label="Document Preview (first 400 chars)", lines=5)
     status = gr.Textbox(label="Status", interactive=False)
 
+    with gr.Tab("Compare variants"):
+        gr.Markdown("Summarize the uploaded file in several lengths and styles at once and compare the scores.")
+        lengths_input = gr.CheckboxGroup(list(LENGTHS), value=list(LENGTHS), label="Lengths")
+        styles_input = gr.CheckboxGroup(list(STYLES), value=list(STYLES), label="Styles")
+        compare_btn = gr.Button("Generate & Compare")
+        compare_table = gr.Dataframe(label="Variants (best overall score first)", wrap=True)
+        compare_status = gr.Textbox(label="Status", interactive=False)
+
+        compare_btn.click(compare_variants, inputs=[file_input, lengths_input, styles_input],
+                          outputs=[compare_table, compare_status])
+
+    with gr.Tab("Folder"):
+        gr.Markdown("Summarize every file in a folder with the length & style above. "
+                    "Files already summarized with these settings are skipped, so a stopped job continues where it was.")
+        folder_input = gr.Textbox(value=DOCUMENTS_FOLDER, label="Folder")
+        folder_btn = gr.Button("Summarize Folder")
+        folder_status = gr.Textbox(label="Progress", interactive=False)
+        folder_table = gr.Dataframe(label="Files")
+
+        folder_btn.click(summarize_folder, inputs=[folder_input, length_dropdown, style_dropdown],
+                         outputs=[folder_status, folder_table], concurrency_limit=1)
+
     with gr.Tab("Dashboard"):
         gr.Markdown("History of summaries and scores")
         refresh_btn = gr.Button("Refresh Dashboard")
@@ -189,4 +292,17 @@ with gr.Blocks() as demo:
 # ────────────────────────────────────────────────
 # START THE APP
 # ────────────────────────────────────────────────
-demo.launch(server_name="127.0.0.1", server_port=7860)
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Personal Summarizer (starts the web UI unless --folder is given)")
+    parser.add_argument("--folder", help="summarize every file in this folder without the UI, then exit")
+    parser.add_argument("--length", choices=list(LENGTHS), default="medium")
+    parser.add_argument("--style", choices=list(STYLES), default="paragraph")
+    parser.add_argument("--workers", type=int, default=FOLDER_WORKERS)
+    args = parser.parse_args()
+    if args.folder:
+        for message, table in summarize_folder(args.folder, args.length, args.style, args.workers):
+            print(f"{message} | {table.iloc[-1]['file']}: {table.iloc[-1]['status']}" if len(table) else message)
+        raise SystemExit(0)
+
+    demo.queue(default_concurrency_limit=UI_CONCURRENCY)
+    demo.launch(server_name="127.0.0.1", server_port=7860)
\ No newline at end of file
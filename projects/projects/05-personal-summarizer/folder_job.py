@@ -0,0 +1,93 @@
+"""Summarize every document in a folder, with progress and resume.
+
+run_folder_job() is used by the "Folder" tab and by `python app.py --folder`:
+- files are read in parallel worker processes (extraction.extract_documents)
+- each file's text is hashed; if a summary of that exact text with the
+  chosen settings is already in the log, the file is skipped
+- the others are summarized by a pool of `workers` threads, and each result
+  is logged as soon as it is ready
+- a progress dict (counts, elapsed time, ETA) is yielded after every file
+Because finished files are in the log, a job that was interrupted simply
+continues with the files that are still missing when it is started again.
+Failed files are not logged, so they are retried on the next run.
+"""
+import hashlib
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from extraction import extract_documents
+
+SUPPORTED_FILES = (".pdf", ".txt", ".md")
+
+
+def folder_files(folder):
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder)
+                  if name.lower().endswith(SUPPORTED_FILES))
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h {minutes:02d}m" if hours else f"{minutes}m {seconds:02d}s"
+
+
+def run_folder_job(paths, summarize, already_done, workers=2):
+    """Yield a progress dict after every file of paths.
+
+    summarize(path, text) summarizes and logs one file and returns its scores
+    (raising on failure); already_done(content_hash) tells whether that text was
+    summarized with the job's settings before. Progress dicts have "path",
+    "status" (summarized / skipped / failed), "result", "finished", "total",
+    "summarized", "skipped", "failed", "elapsed" and "eta" (seconds or None).
+    """
+    counts = {"summarized": 0, "skipped": 0, "failed": 0}
+    started = time.perf_counter()
+    queued_hashes = set()   # Two files with the same text are summarized once
+    pool = ThreadPoolExecutor(workers)
+    pending = {}            # future -> path
+
+    def progress(path, status, result):
+        counts[status] += 1
+        finished = sum(counts.values())
+        # Skipped files take no time: estimate from the files that were actually summarized
+        done_with_model = counts["summarized"] + counts["failed"]
+        remaining = len(paths) - finished
+        elapsed = time.perf_counter() - started
+        eta = elapsed / done_with_model * remaining if done_with_model else None
+        return {"path": path, "status": status, "result": result, "finished": finished, "total": len(paths),
+                **counts, "elapsed": elapsed, "eta": eta if remaining else 0.0}
+
+    def collect(block):
+        done, _ = wait(list(pending), timeout=None if block else 0, return_when=FIRST_COMPLETED)
+        for future in done:
+            path = pending.pop(future)
+            try:
+                yield progress(path, "summarized", future.result())
+            except Exception as e:
+                yield progress(path, "failed", str(e))
+
+    try:
+        for path, pages, error in extract_documents(paths):
+            if error:
+                yield progress(path, "failed", error)
+                continue
+            text = "\n".join(page for page in pages if page).strip()
+            key = content_hash(text)
+            if not text or key in queued_hashes or already_done(key):
+                yield progress(path, "skipped", "empty" if not text else "already summarized")
+                continue
+            queued_hashes.add(key)
+            pending[pool.submit(summarize, path, text)] = path
+
+            # Keep a couple of files per worker queued; report whatever has finished meanwhile
+            yield from collect(block=len(pending) >= workers * 2)
+        while pending:
+            yield from collect(block=True)
+    finally:
+        # Stopped early (Ctrl+C, UI cancel): drop queued files, they are picked up on the next run
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,114 @@
+"""Summary log in SQLite, with the dashboard numbers kept up to date on insert.
+
+Appending to a CSV and re-reading all of it (summary texts included) for
+every dashboard refresh gets slower with every summary ever made. Here:
+- every summary is one row in `summaries`, indexed by time and by
+  (content hash, length, style) to find earlier summaries of a document
+- a trigger updates the single row of `totals` (count, score sum, best and
+  worst scores) in the same transaction as each insert, so the dashboard
+  reads one row plus the last few summaries, however long the history is
+- the database runs in WAL mode: the dashboard reads while summaries are
+  written, and several processes (the app and a batch job) can write to it
+The old logs/summaries_log.csv is imported once, the first time the store opens.
+"""
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+
+COLUMNS = ["timestamp", "filename", "summary_length", "summary_style", "summary",
+           "faithfulness", "completeness", "conciseness", "overall", "content_hash"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS summaries (
+    id INTEGER PRIMARY KEY,
+    timestamp TEXT, filename TEXT, summary_length TEXT, summary_style TEXT, summary TEXT,
+    faithfulness REAL, completeness REAL, conciseness REAL, overall REAL,
+    content_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS summaries_by_time ON summaries (timestamp);
+CREATE INDEX IF NOT EXISTS summaries_by_document ON summaries (content_hash, summary_length, summary_style);
+
+CREATE TABLE IF NOT EXISTS totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    count INTEGER, overall_sum REAL, best_faithfulness REAL, worst_completeness REAL
+);
+INSERT OR IGNORE INTO totals VALUES (0, 0, 0.0, NULL, NULL);
+
+CREATE TRIGGER IF NOT EXISTS summaries_totals AFTER INSERT ON summaries BEGIN
+    UPDATE totals SET
+        count = count + 1,
+        overall_sum = overall_sum + COALESCE(NEW.overall, 0),
+        best_faithfulness = MAX(COALESCE(best_faithfulness, NEW.faithfulness),
+                                COALESCE(NEW.faithfulness, best_faithfulness)),
+        worst_completeness = MIN(COALESCE(worst_completeness, NEW.completeness),
+                                 COALESCE(NEW.completeness, worst_completeness))
+    WHERE id = 0;
+END;
+
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+INSERT = f"INSERT INTO summaries ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+
+
+class LogStore:
+    """Append-only summary log with O(1) dashboard statistics."""
+
+    def __init__(self, path="logs/summaries.sqlite", legacy_csv=None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # timeout: wait for another writer (e.g. a batch job) instead of failing with "database is locked"
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.db.commit()
+        self.lock = threading.Lock()
+        if legacy_csv:
+            self._import_csv(legacy_csv)
+
+    def _import_csv(self, path):
+        """Copy the rows of the old CSV log in once (the CSV itself is left as it is)."""
+        if not os.path.exists(path):
+            return
+        with self.lock, self.db:
+            # Write lock first: a second process opening the store at the same time waits, then skips
+            self.db.execute("BEGIN IMMEDIATE")
+            if self.db.execute("SELECT 1 FROM meta WHERE key = 'imported_csv'").fetchone():
+                return
+            df = pd.read_csv(path).reindex(columns=COLUMNS).astype(object)
+            df = df.where(df.notna(), None)
+            self.db.executemany(INSERT, df.itertuples(index=False, name=None))
+            self.db.execute("INSERT INTO meta VALUES ('imported_csv', ?)", (path,))
+        print(f"Imported {len(df)} summaries from {path}")
+
+    def add(self, row):
+        """Log one summary; row is a dict with the COLUMNS keys (missing ones are stored as NULL)."""
+        with self.lock, self.db:
+            self.db.execute(INSERT, [row.get(column) for column in COLUMNS])
+
+    def has_summary(self, content_hash, length, style):
+        """Whether this document text was already summarized with this length and style."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT 1 FROM summaries WHERE content_hash = ? AND summary_length = ? AND summary_style = ? LIMIT 1",
+                (content_hash, length, style)).fetchone() is not None
+
+    def totals(self):
+        """Count, average overall score, best faithfulness and worst completeness of every summary logged."""
+        with self.lock:
+            count, overall_sum, best, worst = self.db.execute(
+                "SELECT count, overall_sum, best_faithfulness, worst_completeness FROM totals WHERE id = 0").fetchone()
+        return {
+            "count": count,
+            "average_overall": overall_sum / count if count else None,
+            "best_faithfulness": best,
+            "worst_completeness": worst,
+        }
+
+    def recent(self, n=10):
+        """The last n summaries, oldest first."""
+        with self.lock:
+            rows = self.db.execute(f"SELECT {', '.join(COLUMNS)} FROM summaries ORDER BY id DESC LIMIT ?",
+                                   (n,)).fetchall()
+        return pd.DataFrame(rows[::-1], columns=COLUMNS)
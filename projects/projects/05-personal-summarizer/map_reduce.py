@@ -0,0 +1,163 @@
+"""Summarize documents of any length: summarize sections, then combine.
+
+Sending only the first 12000 characters leaves most of a book unsummarized.
+MapReduceSummarizer instead:
+- splits the text into sections of at most section_chars, at paragraph and
+  then sentence boundaries
+- summarizes the sections concurrently ("map"), at most `workers` at a time
+- if the section summaries together are still too long, summarizes those
+  again the same way, until they fit in one prompt
+- writes the final summary from them ("reduce") with the caller's prompt,
+  which carries the chosen length and style
+Section summaries don't depend on length or style and are cached in SQLite
+by a hash of (model, prompt, section text), so trying another style or
+length - or summarizing the same document again - only re-runs the reduce
+step. Texts that fit in one section go straight to the final prompt.
+summarize_variants() does the sections once for several final prompts (e.g.
+every length x style) and runs those final calls concurrently.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+
+MAP_PROMPT = """Summarize this section of a longer document from the AI Engineering book.
+Keep every key idea, definition, number and name. Be faithful to the text; add nothing.
+Write at most {words} words.
+
+Section:
+{text}
+
+Section summary:"""
+
+
+def split_sections(text, max_chars):
+    """Consecutive sections of at most max_chars, cut between paragraphs, else between sentences."""
+    pieces = []
+    for paragraph in PARAGRAPH_BREAK.split(text):
+        paragraph = paragraph.strip()
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in SENTENCE_END.split(paragraph):
+            # A "sentence" longer than a whole section (no punctuation, e.g. a table) is cut hard
+            pieces.extend(sentence[start:start + max_chars] for start in range(0, len(sentence), max_chars))
+
+    sections, current = [], ""
+    for piece in pieces:
+        if not piece:
+            continue
+        if current and len(current) + 2 + len(piece) > max_chars:
+            sections.append(current)
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        sections.append(current)
+    return sections
+
+
+class SectionCache:
+    """Section summaries in SQLite, keyed on sha256(model, map prompt, section text)."""
+
+    def __init__(self, path="cache/section_summaries.sqlite"):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, summary TEXT)")
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(model, prompt, text):
+        return hashlib.sha256(f"{model}\n{prompt}\n{text}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT summary FROM summaries WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key, summary):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO summaries (key, summary) VALUES (?, ?)", (key, summary))
+            self.db.commit()
+
+
+class MapReduceSummarizer:
+    """Hierarchical summarization through an LLMClient, with cached section summaries."""
+
+    def __init__(self, llm, model, cache=None, section_chars=6000, section_words=150, workers=2):
+        self.llm = llm
+        self.model = model
+        self.cache = cache
+        self.section_chars = section_chars
+        self.section_words = section_words
+        # Shared by all requests: never more than `workers` section calls waiting on the model
+        self.pool = ThreadPoolExecutor(workers)
+        self.lock = threading.Lock()
+        self.sections = 0
+        self.cached_sections = 0
+
+    def _summarize_section(self, text):
+        prompt = MAP_PROMPT.format(words=self.section_words, text=text)
+        key = SectionCache.key(self.model, prompt, text) if self.cache else None
+        summary = self.cache.get(key) if self.cache else None
+        with self.lock:
+            self.sections += 1
+            self.cached_sections += summary is not None
+        if summary is None:
+            summary = self._generate(prompt)
+            if self.cache and summary:
+                self.cache.put(key, summary)
+        return summary
+
+    def _generate(self, prompt):
+        return self.llm.generate(model=self.model, prompt=prompt)['response'].strip()
+
+    def prepare(self, text):
+        """(text for the final prompt, from_sections): the text itself if it fits, else its section summaries."""
+        from_sections = False
+        while len(text) > self.section_chars:
+            sections = split_sections(text, self.section_chars)
+            summaries = list(self.pool.map(self._summarize_section, sections))
+            combined = "\n\n".join(f"[Part {i}] {summary}" for i, summary in enumerate(summaries, 1))
+            shrunk = len(combined) < len(text)
+            text, from_sections = combined, True
+            if not shrunk:
+                break  # Another round would not get any shorter
+        return text, from_sections
+
+    def summarize(self, text, final_prompt):
+        """Summary of the whole text.
+
+        final_prompt(text, from_sections) builds the reduce prompt; from_sections
+        is True when text is made of section summaries rather than the document.
+        """
+        return self._generate(final_prompt(*self.prepare(text)))
+
+    def summarize_variants(self, text, final_prompts):
+        """summarize() for several final prompts at once; returns a summary (or the exception) per prompt."""
+        text, from_sections = self.prepare(text)
+        futures = [self.pool.submit(self._generate, final_prompt(text, from_sections)) for final_prompt in final_prompts]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stats(self):
+        return {
+            "sections": self.sections,
+            "cached_sections": self.cached_sections,
+            "cache_rate": round(self.cached_sections / self.sections, 3) if self.sections else 0.0,
+        }
+
+    def summary(self):
+        s = self.stats()
+        return f"Section summaries: {s['cached_sections']} of {s['sections']} from cache ({s['cache_rate']:.0%})"
@@ -0,0 +1,92 @@
+"""Score summaries against the document they summarize, many at once.
+
+One embedding of a whole book says little about whether a sentence of the
+summary is supported by it, and re-embedding the whole document for every
+summary is the slowest part of scoring. SummaryScorer instead:
+- splits the document into chunks and embeds them once; the unit chunk
+  vectors are kept per document (by content hash) for the next summaries
+- splits every summary into sentences and embeds the sentences of all
+  summaries in one encode call
+- compares all summary sentences with all chunks in one matrix product:
+  faithfulness is the mean, over a summary's sentences, of the best
+  matching chunk (is every statement backed by some part of the document?)
+The length-based completeness and conciseness scores are computed for all
+summaries at once with NumPy as well.
+"""
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from map_reduce import split_sections
+
+SUMMARY_SENTENCE = re.compile(r"(?<=[.!?])\s+|\n+")
+IDEAL_RATIO = 0.15    # Summary length / document length that counts as perfectly concise
+
+
+def _unit(vectors):
+    vectors = np.atleast_2d(np.asarray(vectors, dtype="float32"))
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+class SummaryScorer:
+    """Batched summary scoring; encode is texts -> embeddings (the app's embedding cache)."""
+
+    def __init__(self, encode, chunk_chars=1000, max_documents=32):
+        self.encode = encode
+        self.chunk_chars = chunk_chars
+        self.max_documents = max_documents
+        self.documents = OrderedDict()   # sha256 of the text -> unit chunk vectors
+        self.lock = threading.Lock()
+
+    def document_vectors(self, text):
+        """Unit vectors of the document's chunks, embedded once per document."""
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        with self.lock:
+            if key in self.documents:
+                self.documents.move_to_end(key)
+                return self.documents[key]
+        vectors = _unit(self.encode(split_sections(text, self.chunk_chars) or [text]))
+        with self.lock:
+            self.documents[key] = vectors
+            while len(self.documents) > self.max_documents:
+                self.documents.popitem(last=False)
+        return vectors
+
+    def score(self, original, summaries):
+        """One dict of scores (faithfulness, completeness, conciseness, overall, 0-5) per summary."""
+        valid = [bool(summary) and "error" not in summary.lower() for summary in summaries]
+        sentences = [[s.strip() for s in SUMMARY_SENTENCE.split(summary) if s.strip()] or [summary] if ok else []
+                     for summary, ok in zip(summaries, valid)]
+
+        faithfulness = np.zeros(len(summaries))
+        all_sentences = [sentence for parts in sentences for sentence in parts]
+        if all_sentences:
+            chunks = self.document_vectors(original)
+            # Every summary sentence against every chunk in one product; keep each sentence's best chunk
+            best = (_unit(self.encode(all_sentences)) @ chunks.T).max(axis=1)
+            counts = np.array([len(parts) for parts in sentences])
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            has_sentences = counts > 0
+            faithfulness[has_sentences] = np.add.reduceat(best, starts[has_sentences]) / counts[has_sentences] * 5
+
+        words = np.array([len(summary.split()) for summary in summaries])
+        completeness = np.minimum(5, words / max(1, len(original.split()) / 15) * 5)
+        ratio = np.array([len(summary) for summary in summaries]) / max(1, len(original))
+        conciseness = np.clip(5 - np.abs(ratio - IDEAL_RATIO) * 30, 1, 5)
+        overall = (faithfulness + completeness + conciseness) / 3
+
+        results = []
+        for i, ok in enumerate(valid):
+            if not ok:
+                results.append({"faithfulness": 0, "completeness": 0, "conciseness": 0, "overall": 0})
+                continue
+            results.append({
+                "faithfulness": round(float(faithfulness[i]), 1),
+                "completeness": round(float(completeness[i]), 1),
+                "conciseness": round(float(conciseness[i]), 1),
+                "overall": round(float(overall[i]), 1),
+            })
+        return results
@@ -1,9 +1,10 @@
 import gradio as gr
-from pypdf import PdfReader
+from extraction import read_pages
+from llm_client import LLMClient
 import os
-import ollama
 import re
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # ====================
@@ -12,19 +13,21 @@ from datetime import datetime
 CHAPTER_FOLDER = "chapters"
 OUTPUT_FOLDER = "outputs"
 JUDGE_MODEL = 'phi3.5'  # or 'tinyllama' if slower computer
+LLM_MAX_IN_FLIGHT = 2   # Requests sent to Ollama at once (set OLLAMA_NUM_PARALLEL to match)
+UI_CONCURRENCY = 8      # Chapters handled at once; their LLM calls queue in llm_client
+LLM_QUEUE_TIMEOUT = 120 * UI_CONCURRENCY // LLM_MAX_IN_FLIGHT  # Seconds a request may wait for a slot: 2 min per round of requests ahead
 
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# One shared connection pool to Ollama for every user
+llm = LLMClient(max_in_flight=LLM_MAX_IN_FLIGHT, queue_timeout=LLM_QUEUE_TIMEOUT)
+
 def read_chapter(file_path):
     if file_path.endswith(".pdf"):
         try:
-            reader = PdfReader(file_path)
-            text = ""
-            for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-            return text.strip()
+            # Big PDFs are read in parallel page ranges
+            pages = read_pages(file_path)
+            return "\n".join(page for page in pages if page).strip()
         except Exception as e:
             return f"Error reading PDF: {str(e)}"
     elif file_path.endswith((".txt", ".md")):
@@ -60,7 +63,7 @@ Text:
 {text[:8000]}"""
 
     try:
-        response = ollama.generate(model=JUDGE_MODEL, prompt=prompt)
+        response = llm.generate(model=JUDGE_MODEL, prompt=prompt)
         raw = response['response'].strip()
         if raw.startswith("```json"):
             raw = raw.split("```json")[1].split("```")[0].strip()
@@ -84,13 +87,13 @@ Text:
 {text[:8000]}"""
 
     try:
-        response = ollama.generate(model=JUDGE_MODEL, prompt=prompt)
+        response = llm.generate(model=JUDGE_MODEL, prompt=prompt)
         raw = response['response'].strip()
         if raw.startswith("```json"):
             raw = raw.split("```json")[1].split("```")[0].strip()
         return json.loads(raw)
     except:
-        return [{"type": "error", "question": "Quiz generation failed", "options": null, "correct": "", "explanation": ""}]
+        return [{"type": "error", "question": "Quiz generation failed", "options": None, "correct": "", "explanation": ""}]
 
 def generate_study_pack(file):
     if not file:
@@ -102,8 +105,12 @@ def generate_study_pack(file):
         return text, "", "", ""
 
     outline = extract_outline(text)
-    cards = generate_concept_cards(text)
-    quiz = generate_quiz(text)
+
+    # Cards and quiz don't depend on each other, so both requests are sent at once
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        cards_job = pool.submit(generate_concept_cards, text)
+        quiz_job = pool.submit(generate_quiz, text)
+        cards, quiz = cards_job.result(), quiz_job.result()
 
     # Format output
     cards_html = "<h3>Key Concept Cards</h3><ul>"
@@ -159,4 +166,6 @@ with gr.Blocks() as demo:
         outputs=[outline_output, cards_output, quiz_output, download_status]
     )
 
-demo.launch(server_name="127.0.0.1", server_port=7860)
\ No newline at end of file
+if __name__ == "__main__":
+    demo.queue(default_concurrency_limit=UI_CONCURRENCY)
+    demo.launch(server_name="127.0.0.1", server_port=7860)
\ No newline at end of file
@@ -0,0 +1,174 @@
+"""A fake Ollama server for load-testing the apps without a model.
+
+It answers /api/generate and /api/chat (streaming or not) with filler text
+after a configurable delay and token rate, and handles requests in parallel
+like the real server with OLLAMA_NUM_PARALLEL set.
+
+    python stub_ollama.py                    # serve on http://127.0.0.1:11435
+    OLLAMA_HOST=http://127.0.0.1:11435 python app.py
+
+    python stub_ollama.py --load-test        # hammer LLMClient against the stub and report
+"""
+import argparse
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = "local models answer questions about the book using retrieved context and cite their sources".split()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, so the client's connection pool is exercised
+    first_token_delay = 0.2        # Seconds before the first token (prompt processing)
+    tokens_per_sec = 50.0
+    answer_tokens = 40
+
+    def log_message(self, format, *args):
+        pass  # Quiet: a load test makes thousands of requests
+
+    def do_GET(self):
+        # The ollama client and curl use GET / as a health check
+        self._send_json({"status": "Ollama stub is running"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path not in ("/api/generate", "/api/chat"):
+            self._send_json({"error": f"{self.path} not supported by the stub"}, status=404)
+            return
+
+        started = time.perf_counter()
+        time.sleep(self.first_token_delay)
+        tokens = [WORDS[i % len(WORDS)] + " " for i in range(self.answer_tokens)]
+        chat = self.path == "/api/chat"
+
+        def message(text, done):
+            body = {"model": request.get("model", "stub"),
+                    "created_at": datetime.now(timezone.utc).isoformat(), "done": done}
+            if chat:
+                body["message"] = {"role": "assistant", "content": text}
+            else:
+                body["response"] = text
+            if done:
+                body.update(done_reason="stop", eval_count=len(tokens),
+                            eval_duration=int(len(tokens) / self.tokens_per_sec * 1e9),
+                            total_duration=int((time.perf_counter() - started) * 1e9))
+            return body
+
+        if request.get("stream", True):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for token in tokens:
+                    time.sleep(1 / self.tokens_per_sec)
+                    self._send_chunk(json.dumps(message(token, False)) + "\n")
+                self._send_chunk(json.dumps(message("", True)) + "\n")
+                self._send_chunk("")  # Zero-length chunk ends the response
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True  # The client stopped reading (user left mid-answer)
+        else:
+            time.sleep(len(tokens) / self.tokens_per_sec)
+            self._send_json(message("".join(tokens).strip(), True))
+
+    def _send_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def start_stub(port=11435, first_token_delay=0.2, tokens_per_sec=50.0, answer_tokens=40):
+    """Run the stub in a background thread. Returns the server (call .shutdown() to stop)."""
+    handler = type("Handler", (StubHandler,), {"first_token_delay": first_token_delay,
+                                               "tokens_per_sec": tokens_per_sec,
+                                               "answer_tokens": answer_tokens})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def load_test(port, users, requests, max_in_flight, max_queue, stream):
+    """users threads (like Gradio workers) send requests through one LLMClient; prints latency and throughput."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    from llm_client import LLMBusyError, LLMClient
+
+    client = LLMClient(host=f"http://127.0.0.1:{port}", max_in_flight=max_in_flight, max_queue=max_queue)
+    latencies, first_tokens, rejected, failed = [], [], [0], [0]
+    lock = threading.Lock()
+
+    def one_request(i):
+        started = time.perf_counter()
+        try:
+            if stream:
+                first = None
+                for _ in client.generate_stream("stub", f"question {i}"):
+                    if first is None:
+                        first = time.perf_counter() - started
+            else:
+                client.generate("stub", f"question {i}")
+                first = time.perf_counter() - started
+        except LLMBusyError:
+            with lock:
+                rejected[0] += 1
+            return
+        except Exception:
+            with lock:
+                failed[0] += 1
+            return
+        with lock:
+            latencies.append(time.perf_counter() - started)
+            first_tokens.append(first)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        list(pool.map(one_request, range(requests)))
+    seconds = time.perf_counter() - started
+
+    def percentile(values, p):
+        return sorted(values)[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+    print(f"{requests} requests from {users} users, max_in_flight={max_in_flight}, max_queue={max_queue}, "
+          f"stream={stream}")
+    print(f"  completed {len(latencies)}, rejected (busy) {rejected[0]}, failed {failed[0]}")
+    print(f"  throughput {len(latencies) / seconds:.1f} requests/s over {seconds:.1f}s")
+    print(f"  latency p50 {percentile(latencies, 0.5):.2f}s  p95 {percentile(latencies, 0.95):.2f}s")
+    print(f"  first token p50 {percentile(first_tokens, 0.5):.2f}s  p95 {percentile(first_tokens, 0.95):.2f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Ollama server for load tests.")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--first-token-delay", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0)
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--load-test", action="store_true", help="run a load test through LLMClient and exit")
+    parser.add_argument("--users", type=int, default=32, help="load test: concurrent callers")
+    parser.add_argument("--requests", type=int, default=200, help="load test: total requests")
+    parser.add_argument("--max-in-flight", type=int, default=4, help="load test: LLMClient max_in_flight")
+    parser.add_argument("--max-queue", type=int, default=32, help="load test: LLMClient max_queue")
+    parser.add_argument("--no-stream", action="store_true", help="load test: use generate() instead of streaming")
+    args = parser.parse_args()
+
+    server = start_stub(args.port, args.first_token_delay, args.tokens_per_sec, args.answer_tokens)
+    if args.load_test:
+        load_test(args.port, args.users, args.requests, args.max_in_flight, args.max_queue, not args.no_stream)
+        server.shutdown()
+    else:
+        print(f"Ollama stub listening on http://127.0.0.1:{args.port} (Ctrl+C to stop)")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()